@@ -2,23 +2,245 @@
 # Imports
 #----------------------------------------------------------------------------#
 import dateutil.parser
-import babel, logging
-from flask import Flask, render_template, request, flash, redirect, url_for, jsonify
+import babel, babel.dates, logging, base64, json, re, threading, functools, csv, io, click, os, zlib, time
+from flask import Flask, render_template, request, flash, redirect, url_for, jsonify, g, has_request_context, session, abort
+from flask import Response, stream_with_context, Markup
 from flask_moment import Moment
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 from flask_migrate import Migrate
 from logging import Formatter, FileHandler
 from forms import VenueForm, ArtistForm, ShowForm, AlbumForm, SongForm
 from sqlalchemy.sql import func
-from sqlalchemy import case, inspect
-from datetime import datetime
+from sqlalchemy import case, inspect, and_, or_, tuple_, event, text, select, literal_column, literal, bindparam, exists, DDL
+from sqlalchemy import exc
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql.expression import UpdateBase
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import selectinload, load_only, raiseload, make_transient_to_detached, sessionmaker
+from datetime import datetime, timedelta
+from itertools import islice, count
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+#----------------------------------------------------------------------------#
+# Connection Pool.
+#----------------------------------------------------------------------------#
+# engines are created with the DB_* pool settings of config.py, and each pool is
+# metered: checkouts, time spent waiting for a connection, overflow and connections
+# opened and closed. The counters are served at /metrics/pool and logged every
+# DB_POOL_LOG_INTERVAL seconds, slow waits and exhausted pools as warnings.
+
+class PoolMetrics:
+    """Counters of a connection pool, kept up to date by its events."""
+
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.checked_out = 0
+        self.peak_checked_out = 0
+        self.peak_overflow = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.timeouts = 0
+        self.connects = 0
+        self.closes = 0
+        self.invalidations = 0
+        self.logged_at = time.monotonic()
+        event.listen(pool, 'connect', self.on_connect)
+        event.listen(pool, 'checkout', self.on_checkout)
+        event.listen(pool, 'checkin', self.on_checkin)
+        event.listen(pool, 'close', self.on_close)
+        event.listen(pool, 'close_detached', self.on_close)
+        event.listen(pool, 'invalidate', self.on_invalidate)
+
+    def on_connect(self, dbapi_connection, record):
+        with self.lock:
+            self.connects += 1
+
+    def on_close(self, dbapi_connection, record=None):
+        with self.lock:
+            self.closes += 1
+
+    def on_invalidate(self, dbapi_connection, record, exception):
+        with self.lock:
+            self.invalidations += 1
+
+    def on_checkout(self, dbapi_connection, record, proxy):
+        with self.lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.peak_checked_out = max(self.peak_checked_out, self.checked_out)
+            if isinstance(self.pool, QueuePool):
+                self.peak_overflow = max(self.peak_overflow, self.pool.overflow())
+            due = app.config['DB_POOL_LOG_INTERVAL'] and time.monotonic() - self.logged_at >= app.config['DB_POOL_LOG_INTERVAL']
+            if due:
+                self.logged_at = time.monotonic()
+        if due:
+            app.logger.info('pool %s: %s', self.name, json.dumps(self.snapshot()))
+
+    def on_checkin(self, dbapi_connection, record):
+        with self.lock:
+            self.checked_out = max(0, self.checked_out - 1)
+
+    def waited(self, seconds):
+        with self.lock:
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+        if seconds >= app.config['DB_POOL_SLOW_WAIT']:
+            app.logger.warning('pool %s: waited %.3fs for a connection: %s', self.name, seconds, json.dumps(self.snapshot()))
+
+    def timed_out(self):
+        with self.lock:
+            self.timeouts += 1
+        app.logger.warning('pool %s: no connection available: %s', self.name, json.dumps(self.snapshot()))
+
+    def snapshot(self):
+        with self.lock:
+            data = {
+                'checkouts': self.checkouts,
+                'checked_out': self.checked_out,
+                'peak_checked_out': self.peak_checked_out,
+                'wait_seconds_total': round(self.wait_total, 6),
+                'wait_seconds_max': round(self.wait_max, 6),
+                'wait_seconds_mean': round(self.wait_total / self.checkouts, 6) if self.checkouts else 0,
+                'timeouts': self.timeouts,
+                'connects': self.connects,
+                'closes': self.closes,
+                'invalidations': self.invalidations,
+            }
+        if isinstance(self.pool, QueuePool):
+            data.update(size=self.pool.size(), idle=self.pool.checkedin(),
+                        overflow=self.pool.overflow(), peak_overflow=self.peak_overflow)
+        return data
+
+class MeteredQueuePool(QueuePool):
+    """QueuePool that reports how long each checkout waited for a connection (including
+    opening a new one) and when none could be had in time."""
+
+    metrics = None
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            if self.metrics:
+                self.metrics.timed_out()
+            raise
+        if self.metrics:
+            self.metrics.waited(time.perf_counter() - start)
+        return connection
+
+    def recreate(self):
+        #engine.dispose() swaps the pool for a new one, which keeps the event listeners
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        if self.metrics:
+            self.metrics.pool = pool
+        return pool
+
+# metrics of each engine's pool by name
+pool_metrics = OrderedDict()
+
+def pool_options(config, sa_url):
+    #create_engine options of the DB_* settings. SQLite files aren't pooled
+    if sa_url.drivername.startswith('sqlite'):
+        return {}
+    options = {
+        'poolclass': MeteredQueuePool,
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_pre_ping': config['DB_POOL_PRE_PING'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+    }
+    if sa_url.drivername.startswith('postgresql') and config['DB_STATEMENT_TIMEOUT_MS']:
+        options['connect_args'] = {'options': f"-c statement_timeout={config['DB_STATEMENT_TIMEOUT_MS']}"}
+    return options
+
+class AppSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy whose engines use the pool settings of the config and are metered,
+    and whose sessions read from the replicas (see Read Replicas)."""
+
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def create_engine(self, sa_url, engine_opts):
+        options = dict(engine_opts)
+        for key, value in pool_options(app.config, sa_url).items():
+            if key == 'connect_args':
+                value = dict(options.get('connect_args', {}), **value)
+            options[key] = value
+        engine = super().create_engine(sa_url, options)
+        name = sa_url.__to_string__(hide_password=True)
+        pool_metrics[name] = PoolMetrics(name, engine.pool)
+        engine.pool.metrics = pool_metrics[name]
+        return engine
+
+#----------------------------------------------------------------------------#
+# Read Replicas.
+#----------------------------------------------------------------------------#
+# the replica binds of REPLICA_URLS (see config.py) serve the read only pages. A view
+# decorated with @replica_reads picks a replica, in turn or the least loaded, and its
+# session reads from it until it writes, then sticks to the primary. A client that just
+# committed a change reads from the primary for REPLICA_MAX_LAG seconds, so the page
+# it's redirected to shows its own write.
+
+replica_turn = count()
+
+def replica_binds():
+    return sorted(i for i in app.config.get('SQLALCHEMY_BINDS') or () if i.startswith('replica'))
+
+def replica_load(bind):
+    #connections of the replica's pool in use
+    metrics = getattr(db.get_engine(app, bind=bind).pool, 'metrics', None)
+    return metrics.checked_out if metrics else 0
+
+def choose_replica():
+    binds = replica_binds()
+    if not binds:
+        return None
+    start = next(replica_turn) % len(binds)
+    binds = binds[start:] + binds[:start]
+    if app.config['REPLICA_SELECTION'] == 'least_load':
+        #ties go to the next replica in turn
+        return min(binds, key=replica_load)
+    return binds[0]
+
+def replica_reads(view):
+    """Serve the reads of a view from a replica, unless the client just wrote."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if session.get('primary_until', 0) <= time.time():
+            g.replica = choose_replica()
+        return view(*args, **kwargs)
+    return wrapper
+
+def reading_replica():
+    return has_request_context() and g.get('replica')
+
+class RoutingSession(SignallingSession):
+    """Session reading from the request's replica until it flushes or executes a write."""
+
+    def get_bind(self, mapper=None, clause=None):
+        replica = reading_replica()
+        if replica and not self.info.get('wrote'):
+            if not self._flushing and not isinstance(clause, UpdateBase):
+                return db.get_engine(self.app, bind=replica)
+            self.info['wrote'] = True
+        return super().get_bind(mapper, clause)
+
 #----------------------------------------------------------------------------#
 # App Config.
 #----------------------------------------------------------------------------#
 app = Flask(__name__)
 moment = Moment(app)
 app.config.from_object('config')
-db = SQLAlchemy(app)
+db = AppSQLAlchemy(app)
 migrate = Migrate(app, db)
 
 #----------------------------------------------------------------------------#
@@ -26,12 +248,12 @@ migrate = Migrate(app, db)
 #----------------------------------------------------------------------------#
 venue_genres = db.Table('venue_genres',
     db.Column('venue_id', db.Integer, db.ForeignKey('Venue.id', onupdate="CASCADE", ondelete="CASCADE"), primary_key=True),
-    db.Column('genre_id', db.Integer, db.ForeignKey('Genre.id'), primary_key=True)
+    db.Column('genre_id', db.Integer, db.ForeignKey('Genre.id'), primary_key=True, index=True)
 )
 
 artist_genres = db.Table('artist_genres',
     db.Column('artist_id', db.Integer, db.ForeignKey('Artist.id'), primary_key=True),
-    db.Column('genre_id', db.Integer, db.ForeignKey('Genre.id'), primary_key=True)
+    db.Column('genre_id', db.Integer, db.ForeignKey('Genre.id'), primary_key=True, index=True)
 )
 
 class Genre(db.Model):
@@ -45,11 +267,16 @@ class Genre(db.Model):
     
 class Venue(db.Model):
     __tablename__ = 'Venue'
+    __table_args__ = (
+        db.Index('ix_Venue_city_state', 'city', 'state'),
+        db.Index('ix_Venue_num_upcoming_shows_id', 'num_upcoming_shows', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
-    city = db.Column(db.String(120), nullable=False)
-    state = db.Column(db.String(120), nullable=False)
+    # the area summaries recount the area a venue leaves, so its old city/state are loaded when set
+    city = db.column_property(db.Column(db.String(120), nullable=False), active_history=True)
+    state = db.column_property(db.Column(db.String(120), nullable=False), active_history=True)
     address = db.Column(db.String(120), nullable=False)
     phone = db.Column(db.String(120), nullable=False)
     image_link = db.Column(db.String(500), nullable=True)
@@ -57,6 +284,10 @@ class Venue(db.Model):
     website = db.Column(db.String(120), nullable=True)
     seeking_talent = db.Column(db.Boolean, nullable=False)
     seeking_description = db.Column(db.String, nullable=True)
+    # show counters, kept up to date as shows are booked (see Show Counters)
+    num_upcoming_shows = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    num_past_shows = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    next_show_time = db.Column(db.DateTime, nullable=True, index=True)
     shows = db.relationship('Show', backref='venue')
     genres = db.relationship('Genre', secondary=venue_genres, cascade='all, delete',
                              backref=db.backref('genres', lazy=True))
@@ -64,24 +295,21 @@ class Venue(db.Model):
     def __repr__(self):
         return f'<{self.id} {self.name}>'
     
-    def upcoming_show_count(self):
-        return sum([1 if i.upcoming_show() else 0 for i in self.shows])
-    
-    def past_show_count(self):
-        return sum([0 if i.upcoming_show() else 1 for i in self.shows])
-    
     def venue_dict(self):
+        #the venue's columns and genres with its show counts and limited show lists, for its detail page
+        summary = show_summary(Venue, [self.id])[self.id]
         dict_obj = {c.key: getattr(self, c.key) for c in inspect(self).mapper.column_attrs}
         dict_obj['genres'] = [i.name for i in self.genres]
         dict_obj['genre_ids'] = [i.id for i in self.genres]
-        dict_obj['upcoming_shows_count'] = self.upcoming_show_count()
-        dict_obj['past_shows_count'] = self.past_show_count()
-        dict_obj['past_shows'] = [i.show_dict() for i in self.shows if i.upcoming_show() == False]
-        dict_obj['upcoming_shows'] = [i.show_dict() for i in self.shows if i.upcoming_show()]
+        dict_obj.update(summary)
         return dict_obj
 
 class Artist(db.Model):
     __tablename__ = 'Artist'
+    __table_args__ = (
+        db.Index('ix_Artist_name_id', 'name', 'id'),
+        db.Index('ix_Artist_num_upcoming_shows_id', 'num_upcoming_shows', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
@@ -93,6 +321,10 @@ class Artist(db.Model):
     website = db.Column(db.String(120), nullable=True)
     seeking_venue = db.Column(db.Boolean, nullable=False)
     seeking_description = db.Column(db.String, nullable=True)
+    # show counters, kept up to date as shows are booked (see Show Counters)
+    num_upcoming_shows = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    num_past_shows = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    next_show_time = db.Column(db.DateTime, nullable=True, index=True)
     shows = db.relationship('Show', backref='artist')
     genres = db.relationship('Genre', secondary=artist_genres,
                              backref=db.backref('artistgenres', lazy=True))
@@ -102,56 +334,42 @@ class Artist(db.Model):
     def __repr__(self):
         return f'<{self.id} {self.name}>'
 
-    def upcoming_show_count(self):
-        return sum([1 if i.upcoming_show() else 0 for i in self.shows])
-    
-    def past_show_count(self):
-        return sum([0 if i.upcoming_show() else 1 for i in self.shows])
-    
     def artist_dict(self):
+        #the artist's columns and genres with its show counts and limited show lists, for its detail page
+        summary = show_summary(Artist, [self.id])[self.id]
         dict_obj = {c.key: getattr(self, c.key) for c in inspect(self).mapper.column_attrs}
         dict_obj['genres'] = [i.name for i in self.genres]
         dict_obj['genre_ids'] = [i.id for i in self.genres]
-        dict_obj['upcoming_shows_count'] = self.upcoming_show_count()
-        dict_obj['past_shows_count'] = self.past_show_count()
-        dict_obj['past_shows'] = [i.show_dict() for i in self.shows if i.upcoming_show() == False]
-        dict_obj['upcoming_shows'] = [i.show_dict() for i in self.shows if i.upcoming_show()]
+        dict_obj.update(summary)
         dict_obj['albums'] = [i.album_dict() for i in self.albums]
         dict_obj['songs'] = [i.name for i in self.songs if i.album_id == None]
         return dict_obj
 
 class Show(db.Model):
     __tablename__ = 'Show'
+    __table_args__ = (
+        db.Index('ix_Show_venue_id_start_time', 'venue_id', 'start_time'),
+        db.Index('ix_Show_artist_id_start_time', 'artist_id', 'start_time'),
+        db.Index('ix_Show_start_time_id', 'start_time', 'id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
-    venue_id = db.Column(db.Integer, db.ForeignKey('Venue.id'))
-    artist_id = db.Column(db.Integer, db.ForeignKey('Artist.id'))
+    # the counters and area summaries recount the venue/artist a show leaves, so the old ids are loaded when set
+    venue_id = db.column_property(db.Column(db.Integer, db.ForeignKey('Venue.id')), active_history=True)
+    artist_id = db.column_property(db.Column(db.Integer, db.ForeignKey('Artist.id')), active_history=True)
     start_time = db.Column(db.DateTime, nullable=False)
     end_time = db.Column(db.DateTime, nullable=False)
     
     def __repr__(self):
         return f'<{self.id} {self.venue_id} {self.start_time}>'
     
-    def upcoming_show(self):
-        if self.start_time >= datetime.now():
-            return True
-        else:
-            return False
-    
-    def show_dict(self):
-        venue_dict = {'venue_' + c.key: getattr(self.venue, c.key) for c in inspect(self.venue).mapper.column_attrs}
-        artist_dict = {'artist_' + c.key: getattr(self.artist, c.key) for c in inspect(self.artist).mapper.column_attrs}
-        dict_obj = {**venue_dict, **artist_dict}
-        dict_obj['start_time'] = self.start_time.strftime('%Y-%m-%d %H:%M:%S')
-        return dict_obj
-    
 class Album(db.Model):
     __tablename__ = 'Album'
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
     release_date = db.Column(db.DateTime, nullable=True)
-    artist_id = db.Column(db.Integer, db.ForeignKey('Artist.id'), nullable=True)
+    artist_id = db.Column(db.Integer, db.ForeignKey('Artist.id'), nullable=True, index=True)
     songs = db.relationship('Song', backref='albumsong')
     
     def __repr__(self):
@@ -159,7 +377,6 @@ class Album(db.Model):
 
     def album_dict(self):
         dict_obj = {c.key: getattr(self, c.key) for c in inspect(self).mapper.column_attrs}
-        dict_obj['release_date'] = self.release_date.strftime('%Y-%m-%d %H:%M:%S')
         dict_obj['songs'] = [i.name for i in self.songs]
         return dict_obj
 
@@ -169,72 +386,2182 @@ class Song(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
     release_date = db.Column(db.DateTime, nullable=True)
-    album_id = db.Column(db.Integer, db.ForeignKey('Album.id'), nullable=True)
-    artist_id = db.Column(db.Integer, db.ForeignKey('Artist.id'))
+    album_id = db.Column(db.Integer, db.ForeignKey('Album.id'), nullable=True, index=True)
+    artist_id = db.Column(db.Integer, db.ForeignKey('Artist.id'), index=True)
     
     def __repr__(self):
         return f'<{self.id} {self.name}>'
 
+#----------------------------------------------------------------------------#
+# Loader Strategies.
+#----------------------------------------------------------------------------#
+# named eager loading plans for each view, so a page fetches its whole object graph
+# in a fixed number of queries instead of lazy loading per show, album and song.
+# plans are built lazily because backrefs like Show.artist only exist once the mappers are configured
+# shows are not part of the plans, they are partitioned and limited in the database by show_summary
+# cards load only the columns card_dicts reads, and no relationship: touching one raises instead of
+# lazy loading per card
+CARD_COLUMNS = ('id', 'name', 'image_link', 'city', 'state', 'num_upcoming_shows', 'num_past_shows', 'next_show_time')
+LOADER_OPTIONS = {
+    'venue_detail': {
+        Venue: lambda: [selectinload(Venue.genres)],
+    },
+    'artist_detail': {
+        Artist: lambda: [selectinload(Artist.genres),
+                         selectinload(Artist.albums).selectinload(Album.songs),
+                         selectinload(Artist.songs)],
+    },
+    'card': {
+        Venue: lambda: [load_only(*CARD_COLUMNS), raiseload('*')],
+        Artist: lambda: [load_only(*CARD_COLUMNS), raiseload('*')],
+    },
+}
+
+def query_for(model, view):
+    #get the model's query with the eager loading options of the given view applied
+    return model.query.options(*LOADER_OPTIONS[view][model]())
+
+#----------------------------------------------------------------------------#
+# Projections.
+#----------------------------------------------------------------------------#
+class Projection:
+    """The fields a view shows, fetched as plain column rows and returned as namedtuples.
+
+    Fields are columns of the model, otherwise columns of the joined model whose prefix
+    they start with (e.g. 'artist_name' is Artist.name joined through Show.artist_id).
+    Rows skip the ORM identity map and only carry the columns the view needs.
+    """
+
+    def __init__(self, name, model, fields, joins=None):
+        self.model = model
+        self.fields = fields
+        self.joins = joins or {}
+        self.record = namedtuple(name, fields)
+
+    def column(self, field):
+        if hasattr(self.model, field):
+            return getattr(self.model, field).label(field)
+        for prefix, (model, key) in self.joins.items():
+            if field.startswith(prefix):
+                return getattr(model, field[len(prefix):]).label(field)
+        raise KeyError(field)
+
+    def query(self):
+        query = db.session.query(*[self.column(i) for i in self.fields]).select_from(self.model)
+        for prefix, (model, key) in self.joins.items():
+            if any(i.startswith(prefix) and not hasattr(self.model, i) for i in self.fields):
+                query = query.join(model, model.id == key)
+        return query
+
+    def records(self, rows):
+        return [self.record._make(i) for i in rows]
+
+# the fields of venue and artist name cards
+CARD_PROJECTIONS = {
+    Venue: Projection('VenueCard', Venue, ('id', 'name', 'image_link', 'city', 'state')),
+    Artist: Projection('ArtistCard', Artist, ('id', 'name', 'image_link', 'city', 'state')),
+}
+
+SHOW_JOINS = {
+    'venue_': (Venue, Show.venue_id),
+    'artist_': (Artist, Show.artist_id),
+}
+# the show fields of each view
+SHOW_PROJECTIONS = {
+    'listing': Projection('ShowListing', Show, ('id', 'start_time', 'venue_id', 'venue_name',
+                                                'artist_id', 'artist_name', 'artist_image_link'), SHOW_JOINS),
+    'venue_detail': Projection('VenueShow', Show, ('id', 'start_time', 'venue_id', 'artist_id',
+                                                   'artist_name', 'artist_image_link'), SHOW_JOINS),
+    'artist_detail': Projection('ArtistShow', Show, ('id', 'start_time', 'artist_id', 'venue_id',
+                                                     'venue_name', 'venue_image_link'), SHOW_JOINS),
+}
+
+#----------------------------------------------------------------------------#
+# Change Tracking.
+#----------------------------------------------------------------------------#
+# in-process caches and indexes need to know what a commit changed. Rows flushed in a
+# transaction are recorded as Change tuples (with a snapshot of their loaded column values,
+# since the objects are expired once committed) and handed to every commit listener
+# after the commit succeeds. Rolled back changes are dropped.
+Change = namedtuple('Change', ['op', 'model', 'id', 'values'])
+commit_listeners = []
+
+def on_commit(listener):
+    #register a function to call with the list of changes of every successful commit
+    commit_listeners.append(listener)
+    return listener
+
+def record_change(session, change):
+    #record a change made outside of a flush, e.g. by a bulk or core statement
+    session.info.setdefault('changes', []).append(change)
+
+@event.listens_for(db.session, 'after_flush')
+def record_changes(session, flush_context):
+    changes = session.info.setdefault('changes', [])
+    for op, objs in (('insert', session.new), ('update', session.dirty), ('delete', session.deleted)):
+        for obj in objs:
+            state = inspect(obj)
+            values = {c.key: state.dict[c.key] for c in state.mapper.column_attrs if c.key in state.dict}
+            changes.append(Change(op, type(obj), state.identity[0] if state.identity else values.get('id'), values))
+
+@event.listens_for(db.session, 'after_commit')
+def dispatch_changes(session):
+    changes = session.info.pop('changes', [])
+    if changes:
+        for listener in commit_listeners:
+            listener(changes)
+
+@on_commit
+def stick_to_primary(changes):
+    #the client reads its own writes from the primary until the replicas have caught up
+    if has_request_context() and replica_binds():
+        session['primary_until'] = time.time() + app.config['REPLICA_MAX_LAG']
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def drop_changes(session, previous_transaction):
+    session.info.pop('changes', None)
+
+#----------------------------------------------------------------------------#
+# Show Partitioning.
+#----------------------------------------------------------------------------#
+# for each side of a show: the foreign key on Show and the projection of its detail page
+SHOW_SIDES = {
+    Venue: ('venue_id', 'venue_detail'),
+    Artist: ('artist_id', 'artist_detail'),
+}
+
+# times are stored naive, as wall-clock times in BABEL_DEFAULT_TIMEZONE (the zone pages render
+# them in), so "now" and the times given with an offset are converted to it
+APP_TIMEZONE = babel.dates.get_timezone(app.config['BABEL_DEFAULT_TIMEZONE'])
+
+def local_now():
+    return datetime.now(APP_TIMEZONE).replace(tzinfo=None)
+
+def local_time(value):
+    return value.astimezone(APP_TIMEZONE).replace(tzinfo=None) if value is not None and value.tzinfo is not None else value
+
+def request_now():
+    #evaluate "now" once per request so every upcoming/past split on a page agrees
+    if not has_request_context():
+        return local_now()
+    if 'now' not in g:
+        g.now = local_now()
+    return g.now
+
+def show_counts(model, ids, now=None):
+    #the upcoming and past show counts of each venue/artist, read from their show counters.
+    #counters whose next show has started since the last advance-shows are counted from Show
+    counts = {i: (0, 0) for i in ids}
+    if not ids:
+        return counts
+    counts.update(counter_counts(model, db.session.query(
+        model.id, model.num_upcoming_shows, model.num_past_shows, model.next_show_time).filter(model.id.in_(ids)), now))
+    return counts
+
+def counter_counts(model, rows, now=None):
+    #the upcoming and past show counts of (id, num_upcoming_shows, num_past_shows, next_show_time) rows,
+    #recounting from Show the ones whose next show has started since the last advance-shows
+    now = now or request_now()
+    counts = {}
+    stale = []
+    for id, upcoming, past, next_show_time in rows:
+        if next_show_time is not None and next_show_time < now:
+            stale.append(id)
+        else:
+            counts[id] = (upcoming, past)
+    if stale:
+        counts.update(count_shows(model, stale, now))
+    return counts
+
+def count_shows(model, ids, now=None):
+    #count the upcoming and past shows of each venue/artist in a single grouped query
+    fk = getattr(Show, SHOW_SIDES[model][0])
+    now = now or request_now()
+    counts = {i: (0, 0) for i in ids}
+    query = db.session.query(fk,
+                             func.sum(case([(Show.start_time >= now, 1)], else_=0)),
+                             func.sum(case([(Show.start_time < now, 1)], else_=0))
+                             ).filter(fk.in_(ids)).group_by(fk)
+    for key, upcoming, past in query:
+        counts[key] = (int(upcoming or 0), int(past or 0))
+    return counts
+
+def show_lists(model, ids, upcoming, now=None, limit=None):
+    #get the next (or most recent) shows of each venue/artist, at most limit per entity,
+    #as records of the entity's detail page projection
+    fk_name, view = SHOW_SIDES[model]
+    projection = SHOW_PROJECTIONS[view]
+    fk = getattr(Show, fk_name)
+    now = now or request_now()
+    limit = limit or app.config['SHOWS_PER_SECTION']
+    lists = {i: [] for i in ids}
+    if not ids:
+        return lists
+    if upcoming:
+        when, order = Show.start_time >= now, Show.start_time.asc()
+    else:
+        when, order = Show.start_time < now, Show.start_time.desc()
+    query = projection.query()
+    if len(ids) == 1:
+        #a single entity can be ordered and limited directly
+        query = query.filter(fk == ids[0], when).order_by(order, Show.id).limit(limit)
+    else:
+        #rank each entity's shows with a window function and keep the first few of each
+        rank = func.row_number().over(partition_by=fk, order_by=(order, Show.id)).label('rank')
+        ranked = db.session.query(Show.id.label('id'), rank).filter(fk.in_(ids), when).subquery()
+        query = query.join(ranked, Show.id == ranked.c.id).filter(ranked.c.rank <= limit).order_by(fk, order, Show.id)
+    for show in projection.records(query):
+        lists[getattr(show, fk_name)].append(show)
+    return lists
+
+def card_dicts(model, entities, now=None):
+    #name cards of venues/artists with their show counts, read from the show counters
+    counts = counter_counts(model, [(i.id, i.num_upcoming_shows, i.num_past_shows, i.next_show_time)
+                                    for i in entities], now)
+    return [{'id': i.id,
+             'name': i.name,
+             'city': i.city,
+             'state': i.state,
+             'image_link': i.image_link,
+             'num_upcoming_shows': counts[i.id][0],
+             'num_past_shows': counts[i.id][1]
+             } for i in entities]
+
+def show_summary(model, ids, now=None, limit=None):
+    #counts plus the limited upcoming and past show lists of each venue/artist, keyed by id
+    now = now or request_now()
+    counts = show_counts(model, ids, now)
+    upcoming = show_lists(model, ids, True, now, limit)
+    past = show_lists(model, ids, False, now, limit)
+    return {i: {'upcoming_shows_count': counts[i][0],
+                'past_shows_count': counts[i][1],
+                'upcoming_shows': upcoming[i],
+                'past_shows': past[i]
+                } for i in ids}
+
+#----------------------------------------------------------------------------#
+# Area Summaries.
+#----------------------------------------------------------------------------#
+# venue_area_summary holds each city/state with its venue count, upcoming show count and
+# next show time, so the venues page lists areas without aggregating Show. Venue changes
+# recount the areas they touch and new shows are counted in, within the same transaction.
+# An area's counts are exact while its next show is upcoming; `flask roll-areas`, run
+# every few minutes, recounts the areas whose next show has started since.
+
+class VenueAreaSummary(db.Model):
+    __tablename__ = 'venue_area_summary'
+
+    city = db.Column(db.String(120), primary_key=True)
+    state = db.Column(db.String(120), primary_key=True)
+    venue_count = db.Column(db.Integer, nullable=False)
+    upcoming_show_count = db.Column(db.Integer, nullable=False)
+    next_show_time = db.Column(db.DateTime, nullable=True, index=True)
+
+    def __repr__(self):
+        return f'<{self.city}, {self.state}>'
+
+area_summary = VenueAreaSummary.__table__
+
+def count_areas(areas=None, now=None):
+    #select of the summary rows of the given (city, state) areas, or of every area, from Venue and Show
+    now = now or request_now()
+    query = select([Venue.city, Venue.state,
+                    func.count(Venue.id.distinct()).label('venue_count'),
+                    func.count(Show.id).label('upcoming_show_count'),
+                    func.min(Show.start_time).label('next_show_time')]
+                   ).select_from(Venue.__table__.outerjoin(Show.__table__, and_(Show.venue_id == Venue.id,
+                                                                                 Show.start_time >= now))
+                   ).group_by(Venue.city, Venue.state)
+    if areas is not None:
+        query = query.where(tuple_(Venue.city, Venue.state).in_(list(areas)))
+    return query
+
+def refresh_areas(connection, areas=None, now=None):
+    #recount the given areas (all of them when None) from scratch. The rows are upserted, so
+    #transactions recounting the same area don't collide on its key. On Postgres they're locked
+    #first (in order), so the recount of the later transaction sees what the earlier one committed
+    if areas is not None:
+        areas = sorted({tuple(i) for i in areas})
+        if not areas:
+            return
+    keys = ['city', 'state', 'venue_count', 'upcoming_show_count', 'next_show_time']
+    counts = count_areas(areas, now)
+    area_key = tuple_(area_summary.c.city, area_summary.c.state)
+    if connection.dialect.name == 'postgresql':
+        if areas is None:
+            connection.execute(text('LOCK TABLE venue_area_summary IN EXCLUSIVE MODE'))
+        else:
+            connection.execute(postgresql.insert(area_summary).values(
+                [{'city': i, 'state': j, 'venue_count': 0, 'upcoming_show_count': 0} for i, j in areas]
+            ).on_conflict_do_nothing())
+            connection.execute(select([area_summary.c.city]).where(area_key.in_(areas)).order_by(
+                area_summary.c.city, area_summary.c.state).with_for_update())
+        insert = postgresql.insert(area_summary).from_select(keys, counts)
+        insert = insert.on_conflict_do_update(index_elements=keys[:2],
+                                              set_={i: insert.excluded[i] for i in keys[2:]})
+    else:
+        #SQLite serializes writes, replacing the rows is enough
+        insert = area_summary.insert().prefix_with('OR REPLACE').from_select(keys, counts)
+    connection.execute(insert)
+    #areas left without venues
+    delete = area_summary.delete().where(~exists().where(and_(Venue.city == area_summary.c.city,
+                                                              Venue.state == area_summary.c.state)))
+    if areas is not None:
+        delete = delete.where(area_key.in_(areas))
+    connection.execute(delete)
+
+def count_new_shows(connection, shows, now=None):
+    #count inserted shows ({'venue_id', 'start_time'} dicts) into the summary of their venue's area
+    now = now or request_now()
+    by_venue = {}
+    for show in shows:
+        if show['venue_id'] is not None and show['start_time'] >= now:
+            shows_counted, first = by_venue.get(show['venue_id'], (0, show['start_time']))
+            by_venue[show['venue_id']] = (shows_counted + 1, min(first, show['start_time']))
+    if not by_venue:
+        return
+    venue = bindparam('venue')
+    first = bindparam('first')
+    update = area_summary.update().where(and_(
+        area_summary.c.city == select([Venue.city]).where(Venue.id == venue).as_scalar(),
+        area_summary.c.state == select([Venue.state]).where(Venue.id == venue).as_scalar(),
+    )).values(
+        upcoming_show_count=area_summary.c.upcoming_show_count + bindparam('count'),
+        next_show_time=case([(area_summary.c.next_show_time == None, first),
+                             (area_summary.c.next_show_time > first, first)],
+                            else_=area_summary.c.next_show_time),
+    )
+    connection.execute(update, [{'venue': k, 'count': v[0], 'first': v[1]} for k, v in by_venue.items()])
+
+def old_values(obj, *keys):
+    #the values of the attributes before this flush changed them, with the current ones
+    state = inspect(obj)
+    values = []
+    for key in keys:
+        history = state.attrs[key].history
+        values.append(list(history.deleted) + [state.dict.get(key)] if history.deleted else [state.dict.get(key)])
+    return values
+
+@event.listens_for(db.session, 'after_flush')
+def update_area_summaries(session, flush_context):
+    areas = set()
+    venue_ids = set()
+    new_shows = []
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, Venue):
+            cities, states = old_values(obj, 'city', 'state')
+            areas.update((i, j) for i in cities for j in states if i is not None and j is not None)
+        elif isinstance(obj, Show):
+            if obj in session.new:
+                new_shows.append({'venue_id': obj.venue_id, 'start_time': obj.start_time})
+            else:
+                venue_ids.update(i for i in old_values(obj, 'venue_id')[0] if i is not None)
+    connection = session.connection()
+    if venue_ids:
+        areas.update(tuple(i) for i in connection.execute(
+            select([Venue.city, Venue.state]).where(Venue.id.in_(venue_ids))))
+    if areas and new_shows:
+        #the recount already counted the new shows of venues in the recounted areas
+        recounted = {id for id, city, state in connection.execute(
+            select([Venue.id, Venue.city, Venue.state]).where(Venue.id.in_({i['venue_id'] for i in new_shows})))
+            if (city, state) in areas}
+        new_shows = [i for i in new_shows if i['venue_id'] not in recounted]
+    refresh_areas(connection, areas)
+    count_new_shows(connection, new_shows)
+
+def roll_areas(connection, now=None):
+    #recount the areas whose next show has started, returning how many were
+    now = now or local_now()
+    areas = connection.execute(select([area_summary.c.city, area_summary.c.state]
+                                      ).where(area_summary.c.next_show_time < now)).fetchall()
+    refresh_areas(connection, areas, now)
+    return len(areas)
+
+@app.cli.command('roll-areas')
+@click.option('--all', 'rebuild', is_flag=True, help='Recount every area instead.')
+def roll_areas_command(rebuild):
+    """Recount the venue areas whose next show has started."""
+    connection = db.session.connection()
+    if rebuild:
+        refresh_areas(connection, now=local_now())
+        click.echo('every area recounted')
+    else:
+        click.echo(f'{roll_areas(connection)} areas rolled forward')
+    db.session.commit()
+
+def venue_areas(per_area=None):
+    #list every city/state from the area summaries with its venues.
+    #per_area limits how many venues (by name) are listed for each area, None lists all of them
+    now = request_now()
+    areas = db.session.query(VenueAreaSummary).order_by(VenueAreaSummary.state, VenueAreaSummary.city).all()
+    #like the venue counters, areas whose next show has started since the last roll-areas are recounted
+    stale = [(i.city, i.state) for i in areas if i.next_show_time is not None and i.next_show_time < now]
+    recounted = ({(i.city, i.state): i for i in db.session.execute(count_areas(stale, now))} if stale else {})
+    venues = db.session.query(Venue.city, Venue.state, Venue.id, Venue.name, Venue.num_upcoming_shows,
+                              Venue.num_past_shows, Venue.next_show_time,
+                              func.row_number().over(partition_by=(Venue.city, Venue.state),
+                                                     order_by=(Venue.name, Venue.id)).label('rank')).subquery()
+    query = db.session.query(venues)
+    if per_area is not None:
+        query = query.filter(venues.c.rank <= per_area)
+    rows = query.order_by(venues.c.state, venues.c.city, venues.c.rank).all() if per_area != 0 else []
+    counts = counter_counts(Venue, [(i.id, i.num_upcoming_shows, i.num_past_shows, i.next_show_time) for i in rows], now)
+    listed = {}
+    for row in rows:
+        listed.setdefault((row.city, row.state), []).append({"id": row.id,
+                                                             "name": row.name,
+                                                             "num_upcoming_shows": counts[row.id][0]})
+    return [{"city": i.city,
+             "state": i.state,
+             "venue_count": i.venue_count,
+             "upcoming_shows_count": recounted.get((i.city, i.state), i).upcoming_show_count,
+             "next_show_time": recounted.get((i.city, i.state), i).next_show_time,
+             "venues": listed.get((i.city, i.state), [])
+             } for i in areas]
+
+#----------------------------------------------------------------------------#
+# Show Counters.
+#----------------------------------------------------------------------------#
+# venues and artists carry their upcoming and past show counts and next show time, so
+# pages and listings count shows without reading Show. Booked shows are counted in
+# within the writing transaction, edited and deleted shows have their venue and artist
+# recounted. A venue's counters are exact while its next show is upcoming:
+# `flask advance-shows`, run every few minutes, recounts the ones whose next show has
+# started, and `flask check-show-counters` recounts everything and repairs any drift.
+
+def add_show_counters(connection, shows, now=None):
+    #count inserted shows ({'venue_id', 'artist_id', 'start_time'} dicts) into their venue's and artist's counters
+    now = now or request_now()
+    for model, (fk_name, view) in SHOW_SIDES.items():
+        by_id = {}
+        for show in shows:
+            id = show[fk_name]
+            if id is None:
+                continue
+            upcoming, past, first = by_id.get(id, (0, 0, None))
+            if show['start_time'] >= now:
+                upcoming += 1
+                first = min(first, show['start_time']) if first else show['start_time']
+            else:
+                past += 1
+            by_id[id] = (upcoming, past, first)
+        if not by_id:
+            continue
+        table = model.__table__
+        first = bindparam('first', type_=db.DateTime)
+        update = table.update().where(table.c.id == bindparam('entity')).values(
+            num_upcoming_shows=table.c.num_upcoming_shows + bindparam('upcoming'),
+            num_past_shows=table.c.num_past_shows + bindparam('past'),
+            next_show_time=case([(first == None, table.c.next_show_time),
+                                 (table.c.next_show_time == None, first),
+                                 (table.c.next_show_time > first, first)],
+                                else_=table.c.next_show_time),
+        )
+        connection.execute(update, [{'entity': k, 'upcoming': v[0], 'past': v[1], 'first': v[2]}
+                                    for k, v in by_id.items()])
+
+def counted_shows(model, now):
+    #correlated subqueries of the upcoming count, past count and next show time of each row of model
+    fk = getattr(Show, SHOW_SIDES[model][0])
+    table = model.__table__
+    return {
+        'num_upcoming_shows': select([func.count(Show.id)]).where(and_(fk == table.c.id, Show.start_time >= now)).as_scalar(),
+        'num_past_shows': select([func.count(Show.id)]).where(and_(fk == table.c.id, Show.start_time < now)).as_scalar(),
+        'next_show_time': select([func.min(Show.start_time)]).where(and_(fk == table.c.id, Show.start_time >= now)).as_scalar(),
+    }
+
+def refresh_show_counters(connection, model, where=None, now=None):
+    #recount the counters of the venues/artists matching where (all of them when None), returning how many
+    update = model.__table__.update().values(counted_shows(model, now or request_now()))
+    if where is not None:
+        update = update.where(where)
+    return connection.execute(update).rowcount
+
+@event.listens_for(db.session, 'after_flush')
+def update_show_counters(session, flush_context):
+    new_shows = []
+    recount = {model: set() for model in SHOW_SIDES}
+    for obj in session.new | session.dirty | session.deleted:
+        if not isinstance(obj, Show):
+            continue
+        if obj in session.new:
+            new_shows.append({'venue_id': obj.venue_id, 'artist_id': obj.artist_id, 'start_time': obj.start_time})
+            continue
+        for model, (fk_name, view) in SHOW_SIDES.items():
+            recount[model].update(i for i in old_values(obj, fk_name)[0] if i is not None)
+    connection = session.connection()
+    add_show_counters(connection, new_shows)
+    for model, ids in recount.items():
+        if ids:
+            refresh_show_counters(connection, model, model.id.in_(ids))
+
+def advance_shows(connection, now=None):
+    #recount the venues/artists whose next show has started, returning how many of each were
+    now = now or local_now()
+    return {model: refresh_show_counters(connection, model, model.next_show_time < now, now) for model in SHOW_SIDES}
+
+@app.cli.command('advance-shows')
+def advance_shows_command():
+    """Move the shows that have started from the upcoming counters and summaries to the past ones."""
+    connection = db.session.connection()
+    now = local_now()
+    for model, advanced in advance_shows(connection, now).items():
+        click.echo(f'{advanced} {model.__tablename__.lower()} counters advanced')
+    click.echo(f'{roll_areas(connection, now)} areas rolled forward')
+    db.session.commit()
+
+@app.cli.command('check-show-counters')
+@click.option('--dry-run', is_flag=True, help='Only report the drifting counters.')
+def check_show_counters_command(dry_run):
+    """Recount the show counters of every venue and artist and repair the ones that drifted."""
+    connection = db.session.connection()
+    now = local_now()
+    for model in SHOW_SIDES:
+        table = model.__table__
+        counted = counted_shows(model, now)
+        drifted = [i for (i,) in connection.execute(select([table.c.id]).where(
+            (table.c.num_upcoming_shows != counted['num_upcoming_shows']) |
+            (table.c.num_past_shows != counted['num_past_shows']) |
+            table.c.next_show_time.is_distinct_from(counted['next_show_time'])))]
+        click.echo(f'{len(drifted)} {model.__tablename__.lower()} counters drifted' +
+                   (f': {", ".join(map(str, drifted[:20]))}' + (' ...' if len(drifted) > 20 else '') if drifted else ''))
+        if drifted and not dry_run:
+            refresh_show_counters(connection, model, model.id.in_(drifted), now)
+    db.session.commit()
+
+#----------------------------------------------------------------------------#
+# Search Index.
+#----------------------------------------------------------------------------#
+# venues and artists are searched on name, city, state and genre names. On Postgres each
+# table has a tsvector search_vector column with a GIN index, on SQLite they share the
+# search_index FTS5 table. Neither is mapped on the models, they are kept up to date by
+# update_search_index whenever a venue or artist is flushed. Names containing the term
+# anywhere match too, ranked after the full text matches; on Postgres a trigram index
+# on the names serves that part.
+
+# the association table of each searchable model and its key column
+SEARCH_GENRES = {
+    Venue: (venue_genres, 'venue_id'),
+    Artist: (artist_genres, 'artist_id'),
+}
+
+search_index = db.table('search_index', db.column('rowid'), db.column('kind'), db.column('entity_id'))
+
+for model in SEARCH_GENRES:
+    event.listen(model.__table__, 'after_create', DDL(
+        'ALTER TABLE "%(table)s" ADD COLUMN search_vector tsvector; '
+        'CREATE INDEX "ix_%(table)s_search_vector" ON "%(table)s" USING gin (search_vector); '
+        'CREATE EXTENSION IF NOT EXISTS pg_trgm; '
+        'CREATE INDEX "ix_%(table)s_name_trgm" ON "%(table)s" USING gin (name gin_trgm_ops)'
+        ).execute_if(dialect='postgresql'))
+event.listen(db.metadata, 'after_create', DDL(
+    'CREATE VIRTUAL TABLE IF NOT EXISTS search_index '
+    'USING fts5(kind UNINDEXED, entity_id UNINDEXED, name, city, state, genres)'
+    ).execute_if(dialect='sqlite'))
+
+def update_search_index(connection, model, ids, deleted=()):
+    #rebuild the search entries of the given venues/artists from their current rows
+    genres, key = SEARCH_GENRES[model]
+    names = {'table': model.__tablename__, 'genres': genres.name, 'key': key}
+    if connection.dialect.name == 'postgresql':
+        if ids:
+            #the name is weighted above the location and genres when ranking
+            connection.execute(text('''
+                UPDATE "%(table)s" SET search_vector =
+                    setweight(to_tsvector('simple', coalesce(name, '')), 'A') ||
+                    setweight(to_tsvector('simple', coalesce(city, '') || ' ' || coalesce(state, '') || ' ' ||
+                        coalesce((SELECT string_agg(g.name, ' ') FROM %(genres)s a JOIN "Genre" g ON g.id = a.genre_id
+                                  WHERE a.%(key)s = "%(table)s".id), '')), 'B')
+                WHERE id IN :ids''' % names).bindparams(bindparam('ids', expanding=True)), ids=list(ids))
+    elif connection.dialect.name == 'sqlite':
+        stale = list(ids) + list(deleted)
+        if stale:
+            connection.execute(text('DELETE FROM search_index WHERE kind = :kind AND entity_id IN :ids'
+                                    ).bindparams(bindparam('ids', expanding=True)), kind=model.__tablename__, ids=stale)
+        if ids:
+            connection.execute(text('''
+                INSERT INTO search_index (kind, entity_id, name, city, state, genres)
+                SELECT :kind, e.id, e.name, e.city, e.state,
+                       (SELECT group_concat(g.name, ' ') FROM %(genres)s a JOIN "Genre" g ON g.id = a.genre_id
+                        WHERE a.%(key)s = e.id)
+                FROM "%(table)s" e WHERE e.id IN :ids''' % names
+                ).bindparams(bindparam('ids', expanding=True)), kind=model.__tablename__, ids=list(ids))
+
+@event.listens_for(db.session, 'after_flush')
+def index_flushed_entities(session, flush_context):
+    #reindex venues/artists created or edited (including their genres) in this flush
+    for model in SEARCH_GENRES:
+        ids = {i.id for i in session.new | session.dirty if isinstance(i, model)}
+        deleted = {i.id for i in session.deleted if isinstance(i, model)}
+        if ids or deleted:
+            update_search_index(session.connection(), model, ids - deleted, deleted)
+
+# score of the matches found by name substring only, ranked after every full text match
+SUBSTRING_SCORE = 1
+
+def search_query(model, term):
+    #query matching venues/artists against term with a score to order by (lower is better).
+    #every word of the term is matched as a prefix, so "Music Hop" finds "The Musical Hop", and
+    #names containing the term match as well, so "usic" finds it too. rows are (entity, score) tuples
+    words = re.findall(r'\w+', term.lower())
+    query = query_for(model, 'card')
+    if not term.strip():
+        #nothing to match on: list everything by name
+        return query.add_columns(model.name.label('score'))
+    escaped = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    contains = model.name.ilike(f'%{escaped}%', escape='\\')
+    dialect = db.engine.dialect.name
+    if not words or dialect not in ('postgresql', 'sqlite'):
+        #no words to look up (or no index on this database): match names only, by name
+        return query.filter(contains).add_columns(model.name.label('score'))
+    if dialect == 'postgresql':
+        vector = literal_column(f'"{model.__tablename__}".search_vector', type_=TSVECTOR)
+        tsquery = func.to_tsquery('simple', ' & '.join(f'{i}:*' for i in words))
+        matches = vector.op('@@')(tsquery)
+        score = case([(matches, -func.ts_rank(vector, tsquery))], else_=SUBSTRING_SCORE)
+        return query.filter(or_(matches, contains)).add_columns(score.label('score'))
+    fts = literal_column('search_index')
+    hits = select([search_index.c.entity_id, func.bm25(fts).label('rank')]
+                  ).where(fts.op('MATCH')(' '.join(f'"{i}"*' for i in words))
+                  ).where(search_index.c.kind == model.__tablename__).alias('hits')
+    return query.outerjoin(hits, hits.c.entity_id == model.id).filter(or_(hits.c.entity_id != None, contains)
+        ).add_columns(func.coalesce(hits.c.rank, SUBSTRING_SCORE).label('score'))
+
+def search_page(model, term, cursor=None):
+    #get a page of search results ordered by rank, with the total number of matches
+    query = search_query(model, term)
+    score = query.column_descriptions[-1]['expr']
+    rows, next_cursor = keyset_page(query, [score, model.id], cursor, key=lambda row: [row.score, row[0].id])
+    return [i[0] for i in rows], next_cursor, query.order_by(None).count()
+
+@app.cli.command('reindex-search')
+def reindex_search():
+    """Rebuild the search index of every venue and artist."""
+    for model in SEARCH_GENRES:
+        ids = [i for (i,) in db.session.query(model.id)]
+        update_search_index(db.session.connection(), model, ids, ids)
+    db.session.commit()
+
+#----------------------------------------------------------------------------#
+# Autocomplete.
+#----------------------------------------------------------------------------#
+class SuggestionIndex:
+    """In-memory prefix trie over the words of venue, artist or genre names."""
+
+    class Node:
+        __slots__ = ('children', 'ids')
+
+        def __init__(self):
+            self.children = {}
+            self.ids = set()
+
+    def __init__(self):
+        self.root = self.Node()
+        self.names = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def words(name):
+        return set(re.findall(r'\w+', (name or '').lower()))
+
+    def add(self, id, name):
+        with self.lock:
+            self._remove(id)
+            self.names[id] = name
+            for word in self.words(name):
+                node = self.root
+                for char in word:
+                    node = node.children.setdefault(char, self.Node())
+                    node.ids.add(id)
+
+    def remove(self, id):
+        with self.lock:
+            self._remove(id)
+
+    def _remove(self, id):
+        name = self.names.pop(id, None)
+        for word in self.words(name):
+            node = self.root
+            path = []
+            for char in word:
+                path.append((node, char))
+                node = node.children[char]
+                node.ids.discard(id)
+            #prune the branches no name goes through anymore
+            for parent, char in reversed(path):
+                if parent.children[char].ids:
+                    break
+                del parent.children[char]
+
+    def suggest(self, query, limit):
+        #names with a word starting with each word of the query, names starting with the query first
+        words = re.findall(r'\w+', query.lower())
+        if not words:
+            return []
+        with self.lock:
+            matches = None
+            for word in words:
+                node = self.root
+                for char in word:
+                    node = node.children.get(char)
+                    if node is None:
+                        return []
+                matches = set(node.ids) if matches is None else matches & node.ids
+            found = [(i, self.names[i]) for i in matches]
+        query = query.lower()
+        found.sort(key=lambda i: (not i[1].lower().startswith(query), i[1].lower(), i[0]))
+        return [{'id': i, 'name': name} for i, name in found[:limit]]
+
+# one index per kind of name
+SUGGESTION_MODELS = {
+    'venue': Venue,
+    'artist': Artist,
+    'genre': Genre,
+}
+
+class SuggestionCatalog:
+    """Process-wide suggestion indexes, built from the database on first use.
+
+    This process' commits are applied to the indexes by the listener below, including the
+    ones committed while the indexes are being built, which are replayed on them before
+    they're served. Names committed by other processes show up once the indexes are
+    SUGGESTION_INDEX_TTL seconds old and rebuilt.
+    """
+
+    def __init__(self):
+        self.indexes = None
+        self.built_at = 0
+        #changes committed during a build, None when no build is running
+        self.pending = None
+        self.lock = threading.Lock()
+        self.build_lock = threading.Lock()
+
+    def fresh(self):
+        return (self.indexes is not None and
+                time.monotonic() - self.built_at < app.config['SUGGESTION_INDEX_TTL'])
+
+    def invalidate(self):
+        with self.lock:
+            self.indexes = None
+
+    def get(self):
+        with self.lock:
+            if self.fresh():
+                return self.indexes
+        with self.build_lock:
+            with self.lock:
+                if self.fresh():
+                    return self.indexes
+                self.pending = []
+                built_at = time.monotonic()
+            try:
+                indexes = {}
+                for kind, model in SUGGESTION_MODELS.items():
+                    indexes[kind] = SuggestionIndex()
+                    for id, name in db.session.query(model.id, model.name):
+                        indexes[kind].add(id, name)
+            except Exception:
+                with self.lock:
+                    self.pending = None
+                raise
+            with self.lock:
+                self.apply(indexes, self.pending)
+                self.pending = None
+                self.indexes = indexes
+                self.built_at = built_at
+                return indexes
+
+    def update(self, changes):
+        with self.lock:
+            if self.pending is not None:
+                self.pending.extend(changes)
+            if self.indexes is not None:
+                self.apply(self.indexes, changes)
+
+    @staticmethod
+    def apply(indexes, changes):
+        kinds = {model: kind for kind, model in SUGGESTION_MODELS.items()}
+        for change in changes:
+            index = indexes.get(kinds.get(change.model))
+            if index is None or change.id is None:
+                continue
+            if change.op == 'delete':
+                index.remove(change.id)
+            elif 'name' in change.values:
+                index.add(change.id, change.values['name'])
+
+suggestion_catalog = SuggestionCatalog()
+
+@on_commit
+def update_suggestions(changes):
+    suggestion_catalog.update(changes)
+
+#----------------------------------------------------------------------------#
+# Genre Catalog.
+#----------------------------------------------------------------------------#
+class GenreCatalog:
+    """Process-wide cache of the genres offered on the venue and artist forms.
+
+    Committing a genre bumps the version, and the next reader reloads the catalog. Genres
+    committed by other processes show up once the catalog is GENRE_CATALOG_TTL seconds
+    old, or as soon as a form submits one.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self.loaded_version = None
+        self.loaded_at = 0
+        self.by_id = {}
+        self.lock = threading.Lock()
+
+    def invalidate(self):
+        with self.lock:
+            self.version += 1
+
+    def load(self):
+        with self.lock:
+            if (self.loaded_version == self.version and
+                    time.monotonic() - self.loaded_at < app.config['GENRE_CATALOG_TTL']):
+                return self.by_id
+            version = self.version
+            loaded_at = time.monotonic()
+        #keep detached copies, built from plain rows so no object of the current session is touched,
+        #that can be merged into any session without a query
+        genres = []
+        for id, name in db.session.query(Genre.id, Genre.name).order_by(Genre.name):
+            genre = Genre(id=id, name=name)
+            make_transient_to_detached(genre)
+            genres.append(genre)
+        with self.lock:
+            #a genre committed while loading leaves the catalog stale for the next reader
+            self.by_id = {i.id: i for i in genres}
+            self.loaded_version = version
+            self.loaded_at = loaded_at
+            return self.by_id
+
+    def choices(self, submitted=()):
+        #the genre choices of a form, ordered by name and followed by the "Other" choice.
+        #submitted are the ids the form was posted with, one the catalog lacks (a genre another
+        #process added) reloads it so the choice is valid
+        by_id = self.load()
+        if any(i.isdigit() and int(i) not in by_id and int(i) != 0 for i in submitted):
+            self.invalidate()
+            by_id = self.load()
+        return [(i.id, i.name) for i in by_id.values()] + [(0, 'Other')]
+
+    def genres(self, ids):
+        #Genre objects of the given ids in the current session, ignoring ids that aren't genres (like "Other")
+        by_id = self.load()
+        return [db.session.merge(by_id[i], load=False) for i in sorted(set(ids)) if i in by_id]
+
+genre_catalog = GenreCatalog()
+
+@on_commit
+def invalidate_genre_catalog(changes):
+    if any(i.model is Genre for i in changes):
+        genre_catalog.invalidate()
+
+#----------------------------------------------------------------------------#
+# Bookings.
+#----------------------------------------------------------------------------#
+# shows book the interval [start_time, end_time), so back to back shows don't conflict.
+# Overlaps are looked up on the (venue_id, start_time) and (artist_id, start_time) indexes:
+# since no show is longer than MAX_SHOW_HOURS, only shows starting in the window
+# (start - MAX_SHOW_HOURS, end) can overlap, whatever the size of the booking history.
+# On Postgres, exclusion constraints over tsrange(start_time, end_time) make double
+# booking impossible even under concurrent inserts; on SQLite the conditional insert in
+# book_show is atomic since SQLite serializes writes. The window misses shows longer than
+# MAX_SHOW_HOURS, so the migration adding the constraints refuses to run while any exist.
+BOOKING_CONSTRAINTS = {
+    'venue': 'Show_venue_id_no_overlap',
+    'artist': 'Show_artist_id_no_overlap',
+}
+
+for side, name in BOOKING_CONSTRAINTS.items():
+    event.listen(Show.__table__, 'after_create', DDL(
+        'CREATE EXTENSION IF NOT EXISTS btree_gist; '
+        'ALTER TABLE "Show" ADD CONSTRAINT "%(name)s" '
+        'EXCLUDE USING gist (%(side)s_id WITH =, tsrange(start_time, end_time) WITH &&)',
+        context={'name': name, 'side': side}).execute_if(dialect='postgresql'))
+
+class BookingConflict(Exception):
+    """Raised when a show overlaps a show already booked for its venue or artist."""
+
+    def __init__(self, side):
+        super().__init__(f'the {side} is already booked at that time')
+        self.side = side
+
+class InvalidBooking(ValueError):
+    """Raised for a show that can't be booked whatever the schedule, e.g. of an unknown venue."""
+
+def overlapping(side, id, start_time, end_time):
+    #the condition matching shows of the venue/artist that overlap [start_time, end_time)
+    earliest = start_time - timedelta(hours=app.config['MAX_SHOW_HOURS'])
+    return and_(getattr(Show, side + '_id') == id,
+                Show.start_time > earliest,
+                Show.start_time < end_time,
+                Show.end_time > start_time)
+
+def booking_conflict(venue_id, artist_id, start_time, end_time):
+    #which side of a show ('venue' or 'artist') is already booked at that time, or None
+    for side, id in (('venue', venue_id), ('artist', artist_id)):
+        if db.session.query(exists().where(overlapping(side, id, start_time, end_time))).scalar():
+            return side
+    return None
+
+def book_show(venue_id, artist_id, start_time, end_time):
+    #insert the show unless its venue or artist is already booked at that time,
+    #raising BookingConflict if it is, or InvalidBooking if it can't be booked at all. The caller commits
+    if end_time <= start_time:
+        raise InvalidBooking('the end time must be after the start time')
+    if end_time - start_time > timedelta(hours=app.config['MAX_SHOW_HOURS']):
+        raise InvalidBooking(f"shows can't be longer than {app.config['MAX_SHOW_HOURS']} hours")
+    for model, id in ((Venue, venue_id), (Artist, artist_id)):
+        if not db.session.query(exists().where(model.id == id)).scalar():
+            raise InvalidBooking(f'there is no {model.__name__.lower()} with the ID {id}')
+    values = select([literal(venue_id, db.Integer), literal(artist_id, db.Integer),
+                     literal(start_time, db.DateTime), literal(end_time, db.DateTime)]
+                    ).where(~exists().where(overlapping('venue', venue_id, start_time, end_time))
+                    ).where(~exists().where(overlapping('artist', artist_id, start_time, end_time)))
+    insert = Show.__table__.insert().from_select(['venue_id', 'artist_id', 'start_time', 'end_time'], values)
+    try:
+        inserted = db.session.execute(insert).rowcount
+    except IntegrityError as e:
+        #a concurrent booking got in first and the exclusion constraint rejected this one
+        for side, name in BOOKING_CONSTRAINTS.items():
+            if name in str(e.orig):
+                raise BookingConflict(side)
+        raise
+    if not inserted:
+        raise BookingConflict(booking_conflict(venue_id, artist_id, start_time, end_time) or 'venue')
+    #the insert bypasses the ORM, so count it into its counters and area and let the commit listeners know about it
+    show = {'venue_id': venue_id, 'artist_id': artist_id, 'start_time': start_time}
+    add_show_counters(db.session.connection(), [show])
+    count_new_shows(db.session.connection(), [show])
+    record_change(db.session, Change('insert', Show, None, {'venue_id': venue_id, 'artist_id': artist_id,
+                                                           'start_time': start_time, 'end_time': end_time}))
+
+def busy_intervals(sides, start, end):
+    #the times in [start, end) when any of the (side, id) venues/artists has a show, as sorted
+    #disjoint (start, end) intervals: their shows come from one query on the (side_id, start_time)
+    #indexes, sorted by start time, and are merged in a single sweep
+    shows = db.session.query(Show.start_time, Show.end_time).filter(
+        or_(*[overlapping(side, id, start, end) for side, id in sides])).order_by(Show.start_time)
+    busy = []
+    for show_start, show_end in shows:
+        show_start, show_end = max(show_start, start), min(show_end, end)
+        if busy and show_start <= busy[-1][1]:
+            #overlaps or touches the current interval
+            busy[-1][1] = max(busy[-1][1], show_end)
+        else:
+            busy.append([show_start, show_end])
+    return [tuple(i) for i in busy]
+
+def free_intervals(busy, start, end, min_length=None):
+    #the gaps of [start, end) between the busy intervals, keeping those at least min_length long
+    min_length = min_length or timedelta(0)
+    free = []
+    cursor = start
+    for busy_start, busy_end in busy + [(end, end)]:
+        if busy_start > cursor and busy_start - cursor >= min_length:
+            free.append((cursor, busy_start))
+        cursor = max(cursor, busy_end)
+    return free
+
+#----------------------------------------------------------------------------#
+# Page Cache.
+#----------------------------------------------------------------------------#
+class PageCache:
+    """LRU cache of rendered detail pages, bounded by the total size of the cached html.
+
+    Each page is stored with the entities it shows, as ('venue', id) or ('artist', id)
+    keys, and with the time it goes stale. Committing a change to one of those entities
+    drops the page, and a page is never served past its stale time.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.pages = OrderedDict()
+        self.dependents = {}
+        self.invalidated_at = float('-inf')
+        self.lock = threading.Lock()
+
+    def get(self, key, now):
+        with self.lock:
+            entry = self.pages.get(key)
+            if entry is None:
+                return None
+            html, stale_at, deps = entry
+            if stale_at <= now:
+                self._drop(key)
+                return None
+            self.pages.move_to_end(key)
+            return html
+
+    def set(self, key, html, stale_at, deps):
+        size = len(html)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            self._drop(key)
+            self.pages[key] = (html, stale_at, deps)
+            self.size += size
+            for dep in deps:
+                self.dependents.setdefault(dep, set()).add(key)
+            #evict the least recently used pages until the cache fits
+            while self.size > self.max_bytes:
+                self._drop(next(iter(self.pages)))
+
+    def invalidate(self, dep):
+        with self.lock:
+            self.invalidated_at = time.monotonic()
+            for key in list(self.dependents.get(dep, ())):
+                self._drop(key)
+
+    def clear(self):
+        with self.lock:
+            self.pages.clear()
+            self.dependents.clear()
+            self.size = 0
+
+    def _drop(self, key):
+        entry = self.pages.pop(key, None)
+        if entry is None:
+            return
+        html, stale_at, deps = entry
+        self.size -= len(html)
+        for dep in deps:
+            keys = self.dependents.get(dep)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.dependents[dep]
+
+page_cache = PageCache(app.config['PAGE_CACHE_MAX_BYTES'])
+
+# the cached pages showing each kind of changed row: (page kind, id column) pairs
+PAGE_DEPENDENCIES = {
+    Venue: [('venue', 'id')],
+    Artist: [('artist', 'id')],
+    Show: [('venue', 'venue_id'), ('artist', 'artist_id')],
+    Album: [('artist', 'artist_id')],
+    Song: [('artist', 'artist_id')],
+}
+
+# key of the home page listings of the newest venues and artists, which new ones change
+HOME_LISTINGS = ('home', 0)
+
+@on_commit
+def invalidate_pages(changes):
+    for change in changes:
+        for kind, key in PAGE_DEPENDENCIES.get(change.model, ()):
+            id = change.id if key == 'id' else change.values.get(key)
+            if id is not None:
+                page_cache.invalidate((kind, int(id)))
+        if change.op == 'insert' and change.model in (Venue, Artist):
+            page_cache.invalidate(HOME_LISTINGS)
+
+def cached_page(key, render):
+    #serve a page from the page cache, rendering and caching it on a miss. render returns
+    #the html, the ('venue'/'artist', id) keys of the entities shown and when the page goes
+    #stale (None if it only changes with its entities)
+    if '_flashes' in session:
+        #pages showing flashed messages are for one user only
+        return render()[0]
+    return cached_fragment(key, render)
+
+def cached_fragment(key, render):
+    #cache html shared by every user, e.g. a part of a page, the same way as a page
+    if not app.config['PAGE_CACHE_MAX_BYTES']:
+        return render()[0]
+    now = local_now()
+    html = page_cache.get(key, now)
+    if html is None:
+        html, deps, stale_at = render()
+        if reading_replica() and time.monotonic() - page_cache.invalidated_at < app.config['REPLICA_MAX_LAG']:
+            #the replica may not have the change that dropped the page yet
+            return html
+        #bound how long a page can be served after a change committed by another worker
+        expires = now + timedelta(seconds=app.config['PAGE_CACHE_TTL'])
+        page_cache.set(key, html, min(expires, stale_at) if stale_at else expires, deps | {key})
+    return html
+
+def next_show_time(shows):
+    #start time of the first of the upcoming shows, when the page showing them goes stale
+    return shows[0].start_time if shows else None
+
+#----------------------------------------------------------------------------#
+# Pagination.
+#----------------------------------------------------------------------------#
+# listings are paginated by keyset: the cursor holds the ordering key of the last row of
+# the previous page, so deep pages cost the same as the first one (no OFFSET scans)
+
+def page_size():
+    #page size from the request, capped so a client can't ask for an unbounded page
+    size = request.values.get('limit', app.config['PAGE_SIZE'], type=int)
+    return max(1, min(size, app.config['MAX_PAGE_SIZE']))
+
+def encode_cursor(values):
+    values = [i.isoformat() if isinstance(i, datetime) else i for i in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_cursor(cursor, keys):
+    #decode a cursor back into values for the key columns, returning None if it is malformed
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if len(values) != len(keys):
+            return None
+        return [datetime.fromisoformat(v) if isinstance(k.type, db.DateTime) else v for k, v in zip(keys, values)]
+    except (ValueError, TypeError):
+        return None
+
+def keyset_page(query, keys, cursor=None, limit=None, key=None, descending=False):
+    #get the page of query after cursor, ordered by keys (which must end with a unique column).
+    #key gets the key values of a row when they aren't attributes of it (e.g. a computed score).
+    #returns the rows and the cursor of the next page, or None on the last page
+    limit = limit or page_size()
+    key = key or (lambda row: [getattr(row, k.key) for k in keys])
+    values = decode_cursor(cursor, keys) if cursor else None
+    if values is not None:
+        after = tuple_(*keys) < tuple_(*values) if descending else tuple_(*keys) > tuple_(*values)
+        query = query.filter(after)
+    rows = query.order_by(*[i.desc() for i in keys] if descending else keys).limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor(key(last))
+
+#----------------------------------------------------------------------------#
+# JSON API.
+#----------------------------------------------------------------------------#
+# read only /api/v1 resources. Records are fetched as projections of the requested
+# fields only (?fields=id,name), related objects are added with ?include= and loaded
+# with one query per include for the whole page, and collections are keyset paginated by id
+# (venues and artists also by upcoming show count with ?sort=popular).
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+def api_response(payload, status=200):
+    #encode with orjson when it's installed, it handles datetimes natively
+    if orjson is not None:
+        body = orjson.dumps(payload)
+    else:
+        body = json.dumps(payload, default=json_default, separators=(',', ':'))
+    return Response(body, status=status, mimetype='application/json')
+
+def api_error(message, status):
+    return api_response({'error': message}, status)
+
+class ApiError(Exception):
+    """Raised for a request the API can't answer, returned as a JSON error."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+@functools.lru_cache(maxsize=256)
+def api_projection(model, fields):
+    return Projection(model.__name__ + 'Record', model, fields)
+
+def api_columns(model):
+    return tuple(c.key for c in inspect(model).column_attrs)
+
+def record_dicts(records):
+    return [i._asdict() for i in records]
+
+def include_genres(model, records):
+    #genre names of each venue/artist
+    genres, key = SEARCH_GENRES[model]
+    fk = getattr(genres.c, key)
+    result = {i.id: [] for i in records}
+    query = db.session.query(fk, Genre.name).join(Genre, Genre.id == genres.c.genre_id
+                                                  ).filter(fk.in_(list(result))).order_by(Genre.name)
+    for id, name in query:
+        result[id].append(name)
+    return result
+
+def include_show_counts(model, records):
+    #upcoming and past show counts of each venue/artist, from the show counters
+    counts = show_counts(model, [i.id for i in records])
+    return {id: {'upcoming_shows_count': upcoming, 'past_shows_count': past} for id, (upcoming, past) in counts.items()}
+
+def include_shows(model, records):
+    #show counts and the limited upcoming/past show lists of each venue/artist
+    summaries = show_summary(model, [i.id for i in records])
+    return {id: {k: record_dicts(v) if isinstance(v, list) else v for k, v in summary.items()}
+            for id, summary in summaries.items()}
+
+def include_children(child, fk_name, songs=False, where=None):
+    #loader of the child rows (all their columns) of each record, e.g. the albums of an artist.
+    #songs adds the song names of each child album
+    def load(model, records):
+        fk = getattr(child, fk_name)
+        result = {i.id: [] for i in records}
+        projection = api_projection(child, api_columns(child))
+        query = projection.query().filter(fk.in_(list(result)))
+        if where is not None:
+            query = query.filter(where)
+        children = record_dicts(projection.records(query.order_by(child.id)))
+        if songs and children:
+            names = include_children(Song, 'album_id')(Album, [projection.record(**i) for i in children])
+            for i in children:
+                i['songs'] = [j['name'] for j in names[i['id']]]
+        for i in children:
+            result[i[fk_name]].append(i)
+        return result
+    return load
+
+def include_parent(parent, fk_name):
+    #loader of the parent row (all its columns) of each record, e.g. the venue of a show
+    def load(model, records):
+        ids = {getattr(i, fk_name) for i in records} - {None}
+        projection = api_projection(parent, api_columns(parent))
+        rows = {i['id']: i for i in record_dicts(projection.records(projection.query().filter(parent.id.in_(ids))))}
+        return {i.id: rows.get(getattr(i, fk_name)) for i in records}
+    return load
+
+# each resource: its model and the includes it offers, as (loader, fields the loader reads)
+API_RESOURCES = {
+    'venues': (Venue, {
+        'genres': (include_genres, ()),
+        'show_counts': (include_show_counts, ()),
+        'shows': (include_shows, ()),
+    }),
+    'artists': (Artist, {
+        'genres': (include_genres, ()),
+        'show_counts': (include_show_counts, ()),
+        'shows': (include_shows, ()),
+        'albums': (include_children(Album, 'artist_id', songs=True), ()),
+        'songs': (include_children(Song, 'artist_id', where=Song.album_id == None), ()),
+    }),
+    'shows': (Show, {
+        'venue': (include_parent(Venue, 'venue_id'), ('venue_id',)),
+        'artist': (include_parent(Artist, 'artist_id'), ('artist_id',)),
+    }),
+    'albums': (Album, {
+        'artist': (include_parent(Artist, 'artist_id'), ('artist_id',)),
+        'songs': (include_children(Song, 'album_id'), ()),
+    }),
+    'genres': (Genre, {}),
+}
+
+def api_request(resource):
+    #the model, fetched fields, returned fields and includes of an api request
+    if resource not in API_RESOURCES:
+        raise ApiError(f'unknown resource {resource}', 404)
+    model, includes = API_RESOURCES[resource]
+    columns = api_columns(model)
+    fields = tuple(i for i in request.args.get('fields', '').split(',') if i) or columns
+    unknown = [i for i in fields if i not in columns]
+    if unknown:
+        raise ApiError(f'unknown fields: {", ".join(unknown)}')
+    include = tuple(i for i in request.args.get('include', '').split(',') if i)
+    unknown = [i for i in include if i not in includes]
+    if unknown:
+        raise ApiError(f'unknown includes: {", ".join(unknown)}')
+    sort = request.args.get('sort')
+    if sort is not None and (sort != 'popular' or model not in (Venue, Artist)):
+        raise ApiError(f'{resource} can\'t be sorted by {sort}')
+    keys = ('num_upcoming_shows', 'id') if sort else ('id',)
+    #the sort keys are always fetched, for pagination, as well as the fields the includes read
+    fetched = keys + tuple(dict.fromkeys(i for i in fields + sum((includes[j][1] for j in include), ()) if i not in keys))
+    return model, api_projection(model, fetched), fields, [(i, includes[i][0]) for i in include]
+
+def api_dicts(model, records, fields, include):
+    data = [{i: getattr(r, i) for i in fields} for r in records]
+    for name, loader in include:
+        loaded = loader(model, records) if records else {}
+        for item, record in zip(data, records):
+            item[name] = loaded.get(record.id)
+    return data
+
+#----------------------------------------------------------------------------#
+# Background Jobs.
+#----------------------------------------------------------------------------#
+# heavy writes run as jobs: a row of the Job table, so they survive a restart and can
+# be retried, run by a thread pool of JOB_WORKERS threads. The route enqueues the job and
+# answers 202 with its id, and /jobs/<id> reports its progress. A job is claimed with a
+# conditional update so only one worker (in any process) runs it. Failed jobs are
+# retried JOB_MAX_ATTEMPTS times, and jobs left queued or running by a stopped process
+# are picked up again on startup.
+
+class Job(db.Model):
+    __tablename__ = 'Job'
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    args = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True)
+    done = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer, nullable=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+    def __repr__(self):
+        return f'<{self.id} {self.kind} {self.status}>'
+
+    def job_dict(self):
+        dict_obj = {c.key: getattr(self, c.key) for c in inspect(self).mapper.column_attrs if c.key != 'args'}
+        dict_obj['args'] = json.loads(self.args)
+        dict_obj['progress'] = round(self.done / self.total, 3) if self.total else (1.0 if self.status == 'done' else 0.0)
+        return dict_obj
+
+# the function running each kind of job, called with the job id and the job's arguments
+job_handlers = {}
+
+def job_handler(kind):
+    def register(handler):
+        job_handlers[kind] = handler
+        return handler
+    return register
+
+def report_progress(job_id, done, total=None):
+    #record how far a job got, committed with the work it did
+    values = {'done': done, 'updated_at': datetime.now()}
+    if total is not None:
+        values['total'] = total
+    db.session.query(Job).filter(Job.id == job_id).update(values, synchronize_session=False)
+
+class JobRunner:
+    """Runs the jobs of the Job table on a lazily started thread pool."""
+
+    def __init__(self):
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def enqueue(self, kind, **args):
+        #store a job and run it once committed, returning it
+        job = Job(kind=kind, args=json.dumps(args, default=json_default))
+        db.session.add(job)
+        db.session.commit()
+        self.submit(job.id)
+        return job
+
+    def submit(self, job_id, delay=0):
+        if delay:
+            timer = threading.Timer(delay, self.submit, [job_id])
+            timer.daemon = True
+            timer.start()
+            return
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=app.config['JOB_WORKERS'], thread_name_prefix='job')
+        self.executor.submit(self.run, job_id)
+
+    def run(self, job_id, inline=False):
+        #run the job, then schedule its retry if it failed. inline waits for the retries and runs
+        #them in this thread, for a process that exits once its jobs are done
+        while True:
+            with app.app_context():
+                try:
+                    retry_delay = self.run_job(job_id)
+                except Exception:
+                    app.logger.exception('job %s could not be run', job_id)
+                    return
+                finally:
+                    db.session.remove()
+            if retry_delay is None:
+                return
+            if not inline:
+                self.submit(job_id, delay=retry_delay)
+                return
+            time.sleep(retry_delay)
+
+    def run_job(self, job_id):
+        #run a queued job, returning the delay before its retry if it failed and can be retried
+        claimed = db.session.query(Job).filter(Job.id == job_id, Job.status == 'queued').update(
+            {'status': 'running', 'attempts': Job.attempts + 1, 'updated_at': datetime.now()},
+            synchronize_session=False)
+        db.session.commit()
+        if not claimed:
+            return
+        job = db.session.query(Job).get(job_id)
+        try:
+            job_handlers[job.kind](job_id, **json.loads(job.args))
+        except Exception as e:
+            db.session.rollback()
+            retry = job.attempts < app.config['JOB_MAX_ATTEMPTS']
+            app.logger.exception('job %s (%s) failed, attempt %s', job_id, job.kind, job.attempts)
+            db.session.query(Job).filter(Job.id == job_id).update(
+                {'status': 'queued' if retry else 'failed', 'error': str(e), 'updated_at': datetime.now()},
+                synchronize_session=False)
+            db.session.commit()
+            return app.config['JOB_RETRY_DELAY'] * job.attempts if retry else None
+        db.session.query(Job).filter(Job.id == job_id).update(
+            {'status': 'done', 'error': None, 'updated_at': datetime.now()}, synchronize_session=False)
+        db.session.commit()
+
+    def resume(self):
+        #requeue the jobs a stopped process left running and run every queued job
+        stale = datetime.now() - timedelta(seconds=app.config['JOB_STALE_SECONDS'])
+        db.session.query(Job).filter(Job.status == 'running', Job.updated_at < stale).update(
+            {'status': 'queued'}, synchronize_session=False)
+        db.session.commit()
+        for (job_id,) in db.session.query(Job.id).filter(Job.status == 'queued').order_by(Job.id):
+            self.submit(job_id)
+
+job_runner = JobRunner()
+
+@app.before_first_request
+def resume_jobs():
+    job_runner.resume()
+
+@app.cli.command('run-jobs')
+def run_jobs_command():
+    """Run the queued jobs in this process and wait for them to finish."""
+    job_ids = [i for (i,) in db.session.query(Job.id).filter(Job.status == 'queued').order_by(Job.id)]
+    db.session.remove()
+    for job_id in job_ids:
+        job_runner.run(job_id, inline=True)
+        click.echo(f'job {job_id}: {db.session.query(Job).get(job_id).status}')
+
+@job_handler('delete_venue')
+def delete_venue_job(job_id, venue_id):
+    #delete the venue's shows one batch per transaction, so no lock is held for long, then the venue
+    batch_size = app.config['JOB_BATCH_SIZE']
+    area = db.session.query(Venue.city, Venue.state).filter(Venue.id == venue_id).first()
+    total = db.session.query(func.count(Show.id)).filter(Show.venue_id == venue_id).scalar() + 1
+    done = 0
+    while True:
+        shows = db.session.query(Show.id, Show.artist_id).filter(Show.venue_id == venue_id
+                                                                  ).order_by(Show.id).limit(batch_size).all()
+        if not shows:
+            break
+        connection = db.session.connection()
+        connection.execute(Show.__table__.delete().where(Show.id.in_([i.id for i in shows])))
+        #the delete bypasses the ORM, so recount the venue, its artists and its area in the same
+        #transaction, and let the commit listeners know about it
+        refresh_show_counters(connection, Venue, Venue.id == venue_id)
+        artists = {i.artist_id for i in shows} - {None}
+        if artists:
+            refresh_show_counters(connection, Artist, Artist.id.in_(artists))
+        if area is not None:
+            refresh_areas(connection, [area])
+        for show in shows:
+            record_change(db.session, Change('delete', Show, show.id, {'venue_id': venue_id, 'artist_id': show.artist_id}))
+        done += len(shows)
+        report_progress(job_id, done, max(total, done + 1))
+        db.session.commit()
+    venue = db.session.query(Venue).get(venue_id)
+    if venue is not None:
+        #unlink the genres first, they're shared with other venues and artists
+        venue.genres = []
+        db.session.flush()
+        db.session.delete(venue)
+    report_progress(job_id, done + 1, done + 1)
+    db.session.commit()
+
+#----------------------------------------------------------------------------#
+# Bulk Import.
+#----------------------------------------------------------------------------#
+# `flask import <kind> <file>` loads venues, artists, shows, albums (with their songs)
+# or songs from a CSV or JSONL file. Rows are read and written in batches, one
+# transaction per batch: genres are resolved by name for the whole batch, shows are
+# checked for overlaps with one query per batch, and rows are written with COPY on
+# Postgres or executemany elsewhere. Rejected rows are reported with their reason.
+
+# lists in CSV cells (genres, album songs) are separated by this
+IMPORT_LIST_SEPARATOR = ';'
+
+def import_text(value):
+    return str(value).strip() if value is not None and str(value).strip() != '' else None
+
+def import_bool(value):
+    if isinstance(value, bool):
+        return value
+    stripped = import_text(value)
+    if stripped is None:
+        return False
+    if stripped.lower() in ('1', 'true', 'yes', 'y', 't'):
+        return True
+    if stripped.lower() in ('0', 'false', 'no', 'n', 'f'):
+        return False
+    raise ValueError(f'{value!r} is not a boolean')
+
+def import_datetime(value):
+    stripped = import_text(value)
+    return local_time(dateutil.parser.parse(stripped)) if stripped is not None else None
+
+def import_int(value):
+    stripped = import_text(value)
+    return int(stripped) if stripped is not None else None
+
+def import_list(value):
+    if isinstance(value, list):
+        return [import_text(i) for i in value if import_text(i)]
+    stripped = import_text(value)
+    return [i.strip() for i in stripped.split(IMPORT_LIST_SEPARATOR) if i.strip()] if stripped else []
+
+# each kind of file: its model and its fields as (name, converter, required)
+IMPORT_KINDS = {
+    'venues': (Venue, [
+        ('name', import_text, True), ('city', import_text, True), ('state', import_text, True),
+        ('address', import_text, True), ('phone', import_text, True), ('image_link', import_text, False),
+        ('facebook_link', import_text, False), ('website', import_text, False),
+        ('seeking_talent', import_bool, False), ('seeking_description', import_text, False),
+        ('genres', import_list, False),
+    ]),
+    'artists': (Artist, [
+        ('name', import_text, True), ('city', import_text, True), ('state', import_text, True),
+        ('phone', import_text, True), ('image_link', import_text, False),
+        ('facebook_link', import_text, False), ('website', import_text, False),
+        ('seeking_venue', import_bool, False), ('seeking_description', import_text, False),
+        ('genres', import_list, False),
+    ]),
+    'shows': (Show, [
+        ('venue_id', import_int, True), ('artist_id', import_int, True),
+        ('start_time', import_datetime, True), ('end_time', import_datetime, True),
+    ]),
+    'albums': (Album, [
+        ('artist_id', import_int, True), ('name', import_text, True),
+        ('release_date', import_datetime, False), ('songs', import_list, False),
+    ]),
+    'songs': (Song, [
+        ('artist_id', import_int, True), ('album_id', import_int, False), ('name', import_text, True),
+        ('release_date', import_datetime, False),
+    ]),
+}
+
+# temporary table the shows of a batch are loaded into to be checked against the booked shows
+import_shows = db.Table('import_shows', db.MetaData(),
+    db.Column('n', db.Integer, primary_key=True),
+    db.Column('venue_id', db.Integer),
+    db.Column('artist_id', db.Integer),
+    db.Column('start_time', db.DateTime),
+    db.Column('end_time', db.DateTime),
+    db.Column('earliest', db.DateTime),
+    prefixes=['TEMPORARY']
+)
+
+class ImportReject(Exception):
+    """Raised for a row that can't be imported."""
+
+def read_rows(path, format):
+    #(line number, row dict) of every row of a CSV or JSONL file
+    with open(path, newline='') as file:
+        if format == 'csv':
+            for n, row in enumerate(csv.DictReader(file), start=2):
+                yield n, row
+        else:
+            for n, line in enumerate(file, start=1):
+                if line.strip():
+                    try:
+                        yield n, json.loads(line)
+                    except ValueError as e:
+                        yield n, ImportReject(f'invalid JSON: {e}')
+
+def parse_row(fields, row):
+    if isinstance(row, ImportReject):
+        raise row
+    if not isinstance(row, dict):
+        raise ImportReject(f'not an object: {json.dumps(row)[:100]}')
+    values = {}
+    for name, convert, required in fields:
+        try:
+            values[name] = convert(row.get(name))
+        except (ValueError, TypeError, OverflowError) as e:
+            raise ImportReject(f'invalid {name}: {e}')
+        if required and values[name] is None:
+            raise ImportReject(f'missing {name}')
+    return values
+
+# characters escaped in COPY's text format
+COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+def copy_value(value):
+    #a value in COPY's text format: None is \N, so it's read back as NULL and empty strings stay empty
+    if value is None:
+        return '\\N'
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value).translate(COPY_ESCAPES)
+
+def copy_buffer(columns, rows):
+    #the rows as a COPY FROM STDIN input in text format, one tab separated line per row
+    return io.StringIO(''.join('\t'.join(copy_value(row[i]) for i in columns) + '\n' for row in rows))
+
+def bulk_insert(connection, table, rows):
+    #insert rows with COPY on Postgres and executemany elsewhere
+    if not rows:
+        return
+    if connection.dialect.name != 'postgresql':
+        connection.execute(table.insert(), rows)
+        return
+    columns = list(rows[0])
+    cursor = connection.connection.cursor()
+    cursor.copy_expert('COPY "%s" (%s) FROM STDIN' % (
+        table.name, ', '.join(f'"{i}"' for i in columns)), copy_buffer(columns, rows))
+
+def bulk_insert_ids(connection, model, rows):
+    #insert rows of a model and return their new ids, in order
+    if not rows:
+        return []
+    table = model.__table__
+    if connection.dialect.name == 'postgresql':
+        ids = [i for (i,) in connection.execute(text(
+            "SELECT nextval(pg_get_serial_sequence(:table, 'id')) FROM generate_series(1, :n)"),
+            table=f'"{table.name}"', n=len(rows))]
+        bulk_insert(connection, table, [dict(row, id=id) for row, id in zip(rows, ids)])
+        return ids
+    #the batch holds SQLite's write lock, so the new rows got the highest ids
+    bulk_insert(connection, table, rows)
+    return sorted(i for (i,) in connection.execute(
+        select([table.c.id]).order_by(table.c.id.desc()).limit(len(rows))))
+
+def existing_ids(connection, model, ids):
+    ids = {i for i in ids if i is not None}
+    if not ids:
+        return set()
+    return {i for (i,) in connection.execute(select([model.__table__.c.id]).where(model.__table__.c.id.in_(ids)))}
+
+def resolve_genres(connection, names):
+    #ids of the genres with the given names, creating the missing ones
+    names = set(names)
+    if not names:
+        return {}
+    genres = Genre.__table__
+    found = dict(connection.execute(select([genres.c.name, genres.c.id]).where(genres.c.name.in_(names))).fetchall())
+    missing = sorted(names - set(found))
+    if missing:
+        bulk_insert(connection, genres, [{'name': i} for i in missing])
+        found.update(connection.execute(select([genres.c.name, genres.c.id]).where(genres.c.name.in_(missing))).fetchall())
+    return found
+
+def import_entities(connection, model, rows):
+    #insert venues or artists with their genres
+    genres_table, key = SEARCH_GENRES[model]
+    genre_ids = resolve_genres(connection, [j for i in rows for j in i['genres']])
+    ids = bulk_insert_ids(connection, model, [{k: v for k, v in i.items() if k != 'genres'} for i in rows])
+    bulk_insert(connection, genres_table, [{key: id, 'genre_id': genre_ids[j]}
+                                           for id, i in zip(ids, rows) for j in dict.fromkeys(i['genres'])])
+    update_search_index(connection, model, ids)
+    return ids
+
+def check_show_rows(connection, rows):
+    #reasons (by row index) to reject shows of a batch: unknown venue or artist, invalid times,
+    #overlaps with booked shows (one query for the batch) or with earlier shows of the batch
+    rejects = {}
+    venues = existing_ids(connection, Venue, [i['venue_id'] for i in rows])
+    artists = existing_ids(connection, Artist, [i['artist_id'] for i in rows])
+    longest = timedelta(hours=app.config['MAX_SHOW_HOURS'])
+    for n, row in enumerate(rows):
+        if row['venue_id'] not in venues:
+            rejects[n] = f"unknown venue {row['venue_id']}"
+        elif row['artist_id'] not in artists:
+            rejects[n] = f"unknown artist {row['artist_id']}"
+        elif row['start_time'] >= row['end_time']:
+            rejects[n] = 'start_time must be before end_time'
+        elif row['end_time'] - row['start_time'] > longest:
+            rejects[n] = f"shows can't be longer than {app.config['MAX_SHOW_HOURS']} hours"
+    candidates = [dict(row, n=n, earliest=row['start_time'] - longest) for n, row in enumerate(rows) if n not in rejects]
+    if candidates:
+        import_shows.create(connection)
+        try:
+            bulk_insert(connection, import_shows, candidates)
+            batch = import_shows.alias('batch')
+            conflicts = select([batch.c.n, case([(Show.venue_id == batch.c.venue_id, 'venue')], else_='artist')]
+                ).select_from(batch.join(Show.__table__, and_(
+                    (Show.venue_id == batch.c.venue_id) | (Show.artist_id == batch.c.artist_id),
+                    Show.start_time > batch.c.earliest,
+                    Show.start_time < batch.c.end_time,
+                    Show.end_time > batch.c.start_time)))
+            for n, side in connection.execute(conflicts):
+                rejects.setdefault(n, f'the {side} is already booked at that time')
+        finally:
+            import_shows.drop(connection)
+    #shows of the same batch are checked against each other in order of start time
+    booked = {}
+    for row in sorted((i for i in candidates if i['n'] not in rejects), key=lambda i: (i['start_time'], i['n'])):
+        for side in ('venue', 'artist'):
+            if booked.get((side, row[side + '_id']), row['start_time']) > row['start_time']:
+                rejects[row['n']] = f'the {side} is booked by an earlier row of the file at that time'
+                break
+        else:
+            for side in ('venue', 'artist'):
+                booked[(side, row[side + '_id'])] = row['end_time']
+    return rejects
+
+def import_batch(connection, kind, rows):
+    #write a batch of parsed rows, returning the reasons to reject some of them by row index
+    model, fields = IMPORT_KINDS[kind]
+    rejects = {}
+    if kind in ('venues', 'artists'):
+        ids = import_entities(connection, model, rows)
+        if kind == 'venues':
+            refresh_areas(connection, {(i['city'], i['state']) for i in rows})
+    elif kind == 'shows':
+        rejects = check_show_rows(connection, rows)
+        rows = [i for n, i in enumerate(rows) if n not in rejects]
+        bulk_insert(connection, Show.__table__, rows)
+        add_show_counters(connection, rows)
+        count_new_shows(connection, rows)
+        ids = [None] * len(rows)
+    else:
+        artists = existing_ids(connection, Artist, [i['artist_id'] for i in rows])
+        albums = existing_ids(connection, Album, [i.get('album_id') for i in rows])
+        for n, row in enumerate(rows):
+            if row['artist_id'] not in artists:
+                rejects[n] = f"unknown artist {row['artist_id']}"
+            elif row.get('album_id') is not None and row['album_id'] not in albums:
+                rejects[n] = f"unknown album {row['album_id']}"
+        rows = [i for n, i in enumerate(rows) if n not in rejects]
+        if kind == 'albums':
+            ids = bulk_insert_ids(connection, Album, [{k: v for k, v in i.items() if k != 'songs'} for i in rows])
+            bulk_insert(connection, Song.__table__, [{'album_id': id, 'artist_id': i['artist_id'], 'name': j,
+                                                      'release_date': i['release_date']}
+                                                     for id, i in zip(ids, rows) for j in i['songs']])
+        else:
+            ids = bulk_insert_ids(connection, Song, rows)
+    #let the commit listeners (autocomplete, caches) know about the new rows
+    for id, row in zip(ids, rows):
+        record_change(db.session, Change('insert', model, id, dict(row, id=id)))
+    return rejects
+
+@app.cli.command('import')
+@click.argument('kind', type=click.Choice(sorted(IMPORT_KINDS)))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'format', type=click.Choice(['csv', 'jsonl']),
+              help='File format, guessed from the extension by default.')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows written per transaction.')
+@click.option('--rejects', 'rejects_path', type=click.Path(dir_okay=False),
+              help='Write the rejected rows with their reason to this JSONL file.')
+def import_command(kind, path, format, batch_size, rejects_path):
+    """Import venues, artists, shows, albums or songs from a CSV or JSONL file."""
+    format = format or ('jsonl' if path.endswith(('.jsonl', '.json', '.ndjson')) else 'csv')
+    fields = IMPORT_KINDS[kind][1]
+    rows = read_rows(path, format)
+    rejects_file = open(rejects_path, 'w') if rejects_path else None
+    imported = rejected = 0
+
+    def reject(line, row, reason):
+        nonlocal rejected
+        rejected += 1
+        if rejects_file:
+            rejects_file.write(json.dumps({'line': line, 'reason': reason,
+                                           'row': row if isinstance(row, dict) else None}, default=str) + '\n')
+        else:
+            click.echo(f'line {line}: {reason}', err=True)
+
+    try:
+        for number, chunk in enumerate(iter(lambda: list(islice(rows, batch_size)), []), start=1):
+            parsed = []
+            for line, row in chunk:
+                try:
+                    parsed.append((line, row, parse_row(fields, row)))
+                except ImportReject as e:
+                    reject(line, row, str(e))
+            try:
+                batch_rejects = import_batch(db.session.connection(), kind, [i[2] for i in parsed])
+                db.session.commit()
+            except Exception as e:
+                #a batch that fails as a whole (e.g. a show booked concurrently) is rejected as a whole
+                db.session.rollback()
+                batch_rejects = {n: f'batch failed: {e}' for n in range(len(parsed))}
+            for n, reason in sorted(batch_rejects.items()):
+                reject(parsed[n][0], parsed[n][1], reason)
+            imported += len(parsed) - len(batch_rejects)
+            click.echo(f'batch {number}: {imported} rows imported, {rejected} rejected so far')
+    finally:
+        if rejects_file:
+            rejects_file.close()
+        db.session.close()
+    click.echo(f'done: {imported} {kind} imported, {rejected} rows rejected')
+
+#----------------------------------------------------------------------------#
+# Export.
+#----------------------------------------------------------------------------#
+# tables are dumped as NDJSON or CSV, optionally gzipped, by `flask export` and
+# /export/<table>. Rows are read from a server-side cursor in primary key order and
+# encoded batch by batch, so memory doesn't grow with the table. Each export is bounded
+# by a watermark, the highest id when it started, which is passed back as after_id to
+# export only the rows added since; shows, albums and songs can also be exported from a time on.
+# Increments are insert only: they never carry edited or deleted rows. Venues and artists
+# are edited (along with their genres) after they're added, so those tables can only be
+# exported in full, and rows deleted since (a deleted venue's shows) only disappear from a
+# full export.
+
+# each table: its table, the id its watermark follows, the column filtered by a time watermark
+# and whether its rows never change once added, so it can be exported incrementally
+EXPORT_TABLES = OrderedDict([
+    ('genres', (Genre.__table__, 'id', None, True)),
+    ('venues', (Venue.__table__, 'id', None, False)),
+    ('artists', (Artist.__table__, 'id', None, False)),
+    ('venue_genres', (venue_genres, 'venue_id', None, False)),
+    ('artist_genres', (artist_genres, 'artist_id', None, False)),
+    ('shows', (Show.__table__, 'id', 'start_time', True)),
+    ('albums', (Album.__table__, 'id', 'release_date', True)),
+    ('songs', (Song.__table__, 'id', 'release_date', True)),
+])
+
+EXPORT_FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+def export_watermark(connection, name):
+    #highest id of the table, the upper bound of an export and the after_id of the next one
+    table, key, time_column, incremental = EXPORT_TABLES[name]
+    return connection.execute(select([func.max(table.c[key])])).scalar()
+
+def export_rows(connection, name, watermark, after_id=None, since=None):
+    #batches of the rows of a table up to the watermark, in primary key order, from a server-side cursor
+    table, key, time_column, incremental = EXPORT_TABLES[name]
+    if since is not None and time_column is None:
+        raise ValueError(f'{name} have no time to export from')
+    if after_id is not None and not incremental:
+        raise ValueError(f'{name} are edited after they are added, they can only be exported in full')
+    if watermark is None:
+        #empty table
+        return
+    query = select([table]).where(table.c[key] <= watermark).order_by(*table.primary_key.columns)
+    if after_id is not None:
+        query = query.where(table.c[key] > after_id)
+    if since is not None:
+        query = query.where(table.c[time_column] >= since)
+    result = connection.execution_options(stream_results=True).execute(query)
+    batch_size = app.config['STREAM_BATCH_SIZE']
+    try:
+        for rows in iter(lambda: result.fetchmany(batch_size), []):
+            yield rows
+    finally:
+        result.close()
+
+def export_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def encode_rows(columns, batches, format):
+    #text chunks of the rows, one per batch; csv starts with a header line
+    if format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        for rows in batches:
+            writer.writerows([export_value(i) for i in row] for row in rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+        return
+    for rows in batches:
+        if orjson is not None:
+            yield b''.join(orjson.dumps(dict(zip(columns, row))) + b'\n' for row in rows).decode()
+        else:
+            yield ''.join(json.dumps(dict(zip(columns, row)), default=json_default) + '\n' for row in rows)
+
+def export_chunks(connection, name, format, compress, watermark, after_id=None, since=None):
+    #bytes of a table's export, gzipped as it goes when compress is set
+    columns = [str(i.name) for i in EXPORT_TABLES[name][0].columns]
+    rows = export_rows(connection, name, watermark, after_id, since)
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    try:
+        for chunk in encode_rows(columns, rows, format):
+            yield compressor.compress(chunk.encode()) if compressor else chunk.encode()
+        if compressor:
+            yield compressor.flush()
+    finally:
+        #close the cursor now when the export is abandoned half way
+        rows.close()
+
+def export_filename(name, format, compress):
+    return f'{name}.{format}' + ('.gz' if compress else '')
+
+@app.cli.command('export')
+@click.argument('tables', nargs=-1, type=click.Choice(list(EXPORT_TABLES)))
+@click.option('--format', 'format', type=click.Choice(list(EXPORT_FORMATS)), default='ndjson', show_default=True)
+@click.option('--gzip', 'compress', is_flag=True, help='Gzip the files.')
+@click.option('--output-dir', type=click.Path(file_okay=False), default='.', show_default=True)
+@click.option('--after-id', type=int, help="Only export rows added after this watermark (a previous export's), "
+                                           "for the tables whose rows aren't edited.")
+@click.option('--since', type=click.DateTime(), help='Only export shows, albums or songs from this time on.')
+def export_command(tables, format, compress, output_dir, after_id, since):
+    """Export tables (all of them by default) to one file each."""
+    os.makedirs(output_dir, exist_ok=True)
+    for name in tables or EXPORT_TABLES:
+        if since is not None and EXPORT_TABLES[name][2] is None:
+            raise click.UsageError('--since only applies to ' +
+                                   ', '.join(i for i, v in EXPORT_TABLES.items() if v[2]))
+        if after_id is not None and not EXPORT_TABLES[name][3]:
+            raise click.UsageError('--after-id only applies to ' +
+                                   ', '.join(i for i, v in EXPORT_TABLES.items() if v[3]))
+        path = os.path.join(output_dir, export_filename(name, format, compress))
+        with db.engine.connect() as connection, open(path, 'wb') as file:
+            #one transaction per table, so the rows are read from a single snapshot
+            with connection.begin():
+                watermark = export_watermark(connection, name)
+                for chunk in export_chunks(connection, name, format, compress, watermark, after_id, since):
+                    file.write(chunk)
+        click.echo(f'{path}: watermark {watermark}')
+
 #----------------------------------------------------------------------------#
 # Filters.
 #----------------------------------------------------------------------------#
 
+# patterns and locale are parsed once instead of on every call
+DATETIME_PATTERNS = {
+    'full': babel.dates.parse_pattern("EEEE MMMM, d, y 'at' h:mma"),
+    'medium': babel.dates.parse_pattern("EE MM, dd, y h:mma"),
+}
+DATETIME_LOCALE = babel.Locale.parse('en_US')
+
+@functools.lru_cache(maxsize=app.config['DATETIME_FORMAT_CACHE_SIZE'])
+def format_datetime_cached(date, format):
+  #naive datetimes are stored in APP_TIMEZONE, aware ones are converted to it
+  date = local_time(date)
+  date = APP_TIMEZONE.localize(date) if hasattr(APP_TIMEZONE, 'localize') else date.replace(tzinfo=APP_TIMEZONE)
+  pattern = DATETIME_PATTERNS.get(format) or babel.dates.parse_pattern(format)
+  return pattern.apply(date, DATETIME_LOCALE)
+
 def format_datetime(value, format='medium'):
-  date = dateutil.parser.parse(value)
-  if format == 'full':
-      format="EEEE MMMM, d, y 'at' h:mma"
-  elif format == 'medium':
-      format="EE MM, dd, y h:mma"
-  return babel.dates.format_datetime(date, format, locale='en_US.UTF-8')
+  if value is None:
+      return ''
+  #strings are still accepted, datetimes are formatted without being reparsed
+  if isinstance(value, str):
+      value = dateutil.parser.parse(value)
+  return format_datetime_cached(value, format)
 
 app.jinja_env.filters['datetime'] = format_datetime
 
+def stream_template(template_name, **context):
+  #render a template as a stream of chunks sent while it renders (flask's own from 2.2 on)
+  app.update_template_context(context)
+  template = app.jinja_env.get_template(template_name)
+  return Response(stream_with_context(template.generate(context)), mimetype='text/html')
+
+#----------------------------------------------------------------------------#
+# Instrumentation.
+#----------------------------------------------------------------------------#
+# every request counts its SQL statements and times them, its template rendering and
+# itself. The timings go out in a Server-Timing header, are added to per endpoint
+# totals served at /metrics/endpoints, and requests slower than SLOW_REQUEST_MS are
+# logged with their slowest statement.
+
+class RequestStats:
+    """SQL and template timings of the current request."""
+
+    __slots__ = ('start', 'queries', 'db_time', 'render_time', 'slowest', 'slowest_time')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.render_time = 0.0
+        self.slowest = None
+        self.slowest_time = 0.0
+
+    def statement(self, statement, seconds):
+        self.queries += 1
+        self.db_time += seconds
+        if seconds > self.slowest_time:
+            self.slowest, self.slowest_time = statement, seconds
+
+def request_stats():
+    return g.get('request_stats') if has_request_context() else None
+
+# the start time is kept on the statement's execution context, which is dropped with it when
+# the statement fails (after_cursor_execute only runs for statements that succeed)
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement(connection, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.statement_start = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def end_statement(connection, cursor, statement, parameters, context, executemany):
+    start = getattr(context, 'statement_start', None)
+    stats = request_stats()
+    if start is not None and stats is not None:
+        stats.statement(statement, time.perf_counter() - start)
+
+class TimedTemplate(app.jinja_env.template_class):
+    """Template adding the time it takes to render to the request's stats."""
+
+    def render(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            self.add_render_time(start)
+
+    def generate(self, *args, **kwargs):
+        #streamed templates are timed chunk by chunk, as the response is sent
+        chunks = super().generate(*args, **kwargs)
+        while True:
+            start = time.perf_counter()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            finally:
+                self.add_render_time(start)
+            yield chunk
+
+    def add_render_time(self, start):
+        stats = request_stats()
+        if stats is not None:
+            stats.render_time += time.perf_counter() - start
+
+app.jinja_env.template_class = TimedTemplate
+
+class EndpointStats:
+    """Request counts and timing totals of each endpoint."""
+
+    def __init__(self):
+        self.endpoints = {}
+        self.lock = threading.Lock()
+
+    def add(self, endpoint, total, stats):
+        with self.lock:
+            entry = self.endpoints.get(endpoint)
+            if entry is None:
+                entry = self.endpoints[endpoint] = {'requests': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'db_ms': 0.0,
+                                                    'render_ms': 0.0, 'queries': 0, 'max_queries': 0,
+                                                    'slowest_statement': None, 'slowest_statement_ms': 0.0}
+            entry['requests'] += 1
+            entry['total_ms'] += total * 1000
+            entry['max_ms'] = max(entry['max_ms'], total * 1000)
+            entry['db_ms'] += stats.db_time * 1000
+            entry['render_ms'] += stats.render_time * 1000
+            entry['queries'] += stats.queries
+            entry['max_queries'] = max(entry['max_queries'], stats.queries)
+            if stats.slowest_time * 1000 > entry['slowest_statement_ms']:
+                entry['slowest_statement'] = stats.slowest
+                entry['slowest_statement_ms'] = stats.slowest_time * 1000
+
+    def report(self):
+        #endpoints by total time spent in them, with their averages
+        with self.lock:
+            entries = {k: dict(v) for k, v in self.endpoints.items()}
+        for entry in entries.values():
+            for key in ('total_ms', 'db_ms', 'render_ms'):
+                entry['mean_' + key] = round(entry[key] / entry['requests'], 3)
+            entry['mean_queries'] = round(entry['queries'] / entry['requests'], 3)
+            for key in ('total_ms', 'max_ms', 'db_ms', 'render_ms', 'slowest_statement_ms'):
+                entry[key] = round(entry[key], 3)
+        return OrderedDict(sorted(entries.items(), key=lambda i: -i[1]['total_ms']))
+
+endpoint_stats = EndpointStats()
+
+@app.before_request
+def start_request_stats():
+    g.request_stats = RequestStats()
+
+@app.after_request
+def add_server_timing(response):
+    #the headers of a streamed response go out before it's rendered, its timings only reach
+    #/metrics/endpoints and the slow request log
+    stats = request_stats()
+    if stats is not None and response.is_streamed:
+        response.headers['Server-Timing'] = 'render;desc="streamed, see /metrics/endpoints"'
+    elif stats is not None:
+        total = time.perf_counter() - stats.start
+        response.headers['Server-Timing'] = (
+            f'db;dur={stats.db_time * 1000:.3f};desc="{stats.queries} queries", '
+            f'render;dur={stats.render_time * 1000:.3f}, '
+            f'total;dur={total * 1000:.3f}')
+    return response
+
+@app.teardown_request
+def record_request_stats(error=None):
+    #runs once a streamed response is sent, so its totals include the whole stream
+    stats = request_stats()
+    if stats is None:
+        return
+    total = time.perf_counter() - stats.start
+    endpoint = request.endpoint or '<unmatched>'
+    endpoint_stats.add(endpoint, total, stats)
+    if total * 1000 >= app.config['SLOW_REQUEST_MS']:
+        app.logger.warning('slow request %s %s %.1fms', request.method, request.path, total * 1000, extra={'fields': {
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'endpoint': endpoint,
+            'total_ms': round(total * 1000, 3),
+            'db_ms': round(stats.db_time * 1000, 3),
+            'render_ms': round(stats.render_time * 1000, 3),
+            'queries': stats.queries,
+            'slowest_statement': stats.slowest,
+            'slowest_statement_ms': round(stats.slowest_time * 1000, 3),
+        }})
+
+class JsonFormatter(Formatter):
+    """Formats log records as JSON lines, with the fields passed as extra={'fields': ...}."""
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'message': record.getMessage(),
+            'location': f'{record.pathname}:{record.lineno}',
+        }
+        data.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
 #----------------------------------------------------------------------------#
 # Controllers.
 #----------------------------------------------------------------------------#
 
 @app.route('/')
+@replica_reads
 def index():
-    #get the most recently listed 5 venues
-    venue_data = Venue.query.order_by(Venue.id.desc()).limit(5).all()
-    venues = [i.venue_dict() for i in venue_data]
-    #get the most recently listed 5 artists
-    artist_data = Artist.query.order_by(Artist.id.desc()).limit(5).all()
-    artists = [i.artist_dict() for i in artist_data]
-    return render_template('pages/home.html', venues=venues, artists=artists)
+    #the listings of the 5 most recently listed venues and artists are rendered from their
+    #cards and shared from the page cache, only the layout around them is rendered per request
+    def render():
+        venues = CARD_PROJECTIONS[Venue].records(CARD_PROJECTIONS[Venue].query().order_by(Venue.id.desc()).limit(5))
+        artists = CARD_PROJECTIONS[Artist].records(CARD_PROJECTIONS[Artist].query().order_by(Artist.id.desc()).limit(5))
+        return (render_template('pages/home_listings.html', venues=venues, artists=artists),
+                {('venue', i.id) for i in venues} | {('artist', i.id) for i in artists},
+                None)
+    return render_template('pages/home.html', listings=Markup(cached_fragment(HOME_LISTINGS, render)))
 
 
 #  Venues
 #  ----------------------------------------------------------------
 @app.route('/venues')
+@replica_reads
 def venues():
-    #get distinct city and states of venues
-    data = [{"city":i.city, 
-             "state":i.state
-             } for i in Venue.query.distinct('city', 'state').order_by('state', 'city').all()]
-    #for each distinct city and state, get data of the venues in those city/state
-    for i in range(0, len(data)):
-        data[i]['venues'] = [{"id": j.id,
-            "name": j.name,
-            "num_upcoming_shows": j.num_upcoming_shows
-            } for j in db.session.query(Venue.id, Venue.name, func.sum(case([(Show.start_time > func.now(), 1)], else_=0)).label('num_upcoming_shows')).outerjoin(Show).filter(Venue.city==data[i]['city']).group_by(Venue).order_by('name').all()]
+    #get every city and state with the venues in it, optionally limiting the venues listed per area
+    per_area = request.args.get('per_area', app.config['VENUES_PER_AREA'], type=int)
+    if per_area is not None and per_area < 0:
+        abort(400)
+    data = venue_areas(per_area=per_area)
     return render_template('pages/venues.html', areas=data);
 
 @app.route('/venues/search', methods=['POST'])
+@replica_reads
 def search_venues():
     # seach for Hop should return "The Musical Hop".
     # search for "Music" should return "The Musical Hop" and "Park Square Live Music & Coffee"
+    # search also matches city, state and genres, best matches first
     search_term = request.form.get('search_term', '')
-    response = {'data':[i.venue_dict() for i in Venue.query.filter(Venue.name.ilike(f'%{search_term}%')).all()]}
-    response['count'] = len(response['data'])
-    return render_template('pages/search_venues.html', results=response, search_term=request.form.get('search_term', ''))
+    venue_data, next_cursor, total = search_page(Venue, search_term, request.form.get('after'))
+    response = {'data':card_dicts(Venue, venue_data)}
+    response['count'] = total
+    return render_template('pages/search_venues.html', results=response, search_term=request.form.get('search_term', ''),
+                           next_cursor=next_cursor, limit=page_size())
 
 @app.route('/venues/<int:venue_id>')
+@replica_reads
 def show_venue(venue_id):
-    # shows the venue page with the given venue_id
-    venue_data = Venue.query.get(venue_id)
-    data = venue_data.venue_dict()
-    return render_template('pages/show_venue.html', venue=data)
+    # shows the venue page with the given venue_id, from the page cache when it's current
+    def render():
+        venue_data = query_for(Venue, 'venue_detail').get(venue_id)
+        if venue_data is None:
+            abort(404)
+        data = venue_data.venue_dict()
+        shows = data['upcoming_shows'] + data['past_shows']
+        return (render_template('pages/show_venue.html', venue=data),
+                {('artist', i.artist_id) for i in shows},
+                next_show_time(data['upcoming_shows']))
+    return cached_page(('venue', venue_id), render)
 
 #  Create Venue
 #  ----------------------------------------------------------------
@@ -242,23 +2569,21 @@ def show_venue(venue_id):
 def create_venue_form():
     #render form
     form = VenueForm()
-    #get the genres that are in the database and put them as the choices for the genre part of the form
-    genre_choices = Genre.query.order_by('name').all()
-    form.genres.choices = [(i.id, i.name) for i in genre_choices] + [(0, 'Other')]
+    #get the genres from the cached catalog and put them as the choices for the genre part of the form
+    form.genres.choices = genre_catalog.choices()
     return render_template('forms/new_venue.html', form=form)
 
 @app.route('/venues/create', methods=['POST'])
 def create_venue_submission():
     #render form
     form = VenueForm(request.form)
-    #get the genres that are in the database and put them as the choices for the genre part of the form
-    genre_choices = Genre.query.order_by('name').all()
-    form.genres.choices = [(i.id, i.name) for i in genre_choices] + [(0, 'Other')]
+    #get the genres from the cached catalog and put them as the choices for the genre part of the form
+    form.genres.choices = genre_catalog.choices(request.form.getlist('genres'))
     error = False   
     if form.validate_on_submit():
         try:
-            #get table objects of the selected genres
-            genre_data = Genre.query.filter(Genre.id.in_(form.genres.data)).order_by('id').all()
+            #get table objects of the selected genres from the catalog
+            genre_data = genre_catalog.genres(form.genres.data)
             #enter new genre into database
             if 0 in form.genres.data:
                 new_genre = Genre(name = form.other_genre.data)
@@ -299,21 +2624,24 @@ def create_venue_submission():
       
 #  Delete Venue
 #  ----------------------------------------------------------------
-@app.route('/venues/<venue_id>', methods=['DELETE'])
+@app.route('/venues/<int:venue_id>', methods=['DELETE'])
 def delete_venue(venue_id):
-    try:
-        #find venue record to delete and delete
-        venue = db.session.query(Venue).get(venue_id)
-        db.session.delete(venue)
-        db.session.commit()
-        result = {'success': True}
-    except:
-        db.session.rollback()
-        result = {'success': False}
-    finally:
-        db.session.close()
-    #return result so the page can either error or reroute
-    return jsonify(result)
+    #the venue and its shows are deleted by a background job, the page polls its status
+    if db.session.query(Venue.id).filter(Venue.id == venue_id).first() is None:
+        return jsonify({'success': False}), 404
+    job = job_runner.enqueue('delete_venue', venue_id=venue_id)
+    status_url = url_for('job_status', job_id=job.id)
+    return jsonify({'success': True, 'job_id': job.id, 'status_url': status_url}), 202, {'Location': status_url}
+
+#  Jobs
+#  ----------------------------------------------------------------
+@app.route('/jobs/<int:job_id>')
+def job_status(job_id):
+    # status and progress of a background job
+    job = db.session.query(Job).get(job_id)
+    if job is None:
+        return jsonify({'error': f'job {job_id} not found'}), 404
+    return jsonify(job.job_dict())
 
 #  Update Venue
 #  ----------------------------------------------------------------
@@ -321,9 +2649,8 @@ def delete_venue(venue_id):
 def edit_venue(venue_id):
     #render form
     form = VenueForm()
-    #get the genres that are in the database and put them as the choices for the genre part of the form
-    genre_choices = Genre.query.order_by('name').all()
-    form.genres.choices = [(i.id, i.name) for i in genre_choices] + [(0, 'Other')]
+    #get the genres from the cached catalog and put them as the choices for the genre part of the form
+    form.genres.choices = genre_catalog.choices()
     venue = Venue.query.get(venue_id)
     #populating form with values from venue
     form.name.default = venue.name
@@ -344,15 +2671,14 @@ def edit_venue(venue_id):
 def edit_venue_submission(venue_id):
     #render form
     form = VenueForm(request.form)
-    #get the genres that are in the database and put them as the choices for the genre part of the forms
-    genre_choices = Genre.query.order_by('name').all()
-    form.genres.choices = [(i.id, i.name) for i in genre_choices] + [(0, 'Other')]
+    #get the genres from the cached catalog and put them as the choices for the genre part of the forms
+    form.genres.choices = genre_catalog.choices(request.form.getlist('genres'))
     venue = Venue.query.get(venue_id)
     error = False 
     if form.validate_on_submit():
         try:
-            #get table objects of the selected genres
-            genre_data = Genre.query.filter(Genre.id.in_(form.genres.data)).order_by('id').all()
+            #get table objects of the selected genres from the catalog
+            genre_data = genre_catalog.genres(form.genres.data)
             #update venue record
             venueobj = db.session.query(Venue).get(venue_id)
             venueobj.name = form.name.data
@@ -390,26 +2716,43 @@ def edit_venue_submission(venue_id):
 #  Artists
 #  ----------------------------------------------------------------
 @app.route('/artists')
+@replica_reads
 def artists():
-    #get all artists
-    data = Artist.query.order_by('name').all()
-    return render_template('pages/artists.html', artists=data)
+    #get a page of artists, ordered by name or, with ?sort=popular, by upcoming shows
+    popular = request.args.get('sort') == 'popular'
+    keys = [Artist.num_upcoming_shows, Artist.id] if popular else [Artist.name, Artist.id]
+    data, next_cursor = keyset_page(Artist.query, keys, request.args.get('after'), descending=popular)
+    return render_template('pages/artists.html', artists=data, next_cursor=next_cursor, limit=page_size(),
+                           sort='popular' if popular else None)
 
 @app.route('/artists/search', methods=['POST'])
+@replica_reads
 def search_artists():
     # seach for "A" should return "Guns N Petals", "Matt Quevado", and "The Wild Sax Band".
     # search for "band" should return "The Wild Sax Band".
+    # search also matches words by prefix ("gun pet" returns "Guns N Petals"), city, state and genres,
+    # best matches first
     search_term = request.form.get('search_term', '')
-    response = {'data':[i.artist_dict() for i in Artist.query.filter(Artist.name.ilike(f'%{search_term}%')).all()]}
-    response['count'] = len(response['data'])
-    return render_template('pages/search_artists.html', results=response, search_term=request.form.get('search_term', ''))
+    artist_data, next_cursor, total = search_page(Artist, search_term, request.form.get('after'))
+    response = {'data':card_dicts(Artist, artist_data)}
+    response['count'] = total
+    return render_template('pages/search_artists.html', results=response, search_term=request.form.get('search_term', ''),
+                           next_cursor=next_cursor, limit=page_size())
 
 @app.route('/artists/<int:artist_id>')
+@replica_reads
 def show_artist(artist_id):
-  # shows the artist page with the given artist_id
-  artist_data = Artist.query.get(artist_id)
-  data = artist_data.artist_dict()
-  return render_template('pages/show_artist.html', artist=data)
+  # shows the artist page with the given artist_id, from the page cache when it's current
+  def render():
+      artist_data = query_for(Artist, 'artist_detail').get(artist_id)
+      if artist_data is None:
+          abort(404)
+      data = artist_data.artist_dict()
+      shows = data['upcoming_shows'] + data['past_shows']
+      return (render_template('pages/show_artist.html', artist=data),
+              {('venue', i.venue_id) for i in shows},
+              next_show_time(data['upcoming_shows']))
+  return cached_page(('artist', artist_id), render)
 
 #  Create Artist
 #  ----------------------------------------------------------------
@@ -417,23 +2760,21 @@ def show_artist(artist_id):
 def create_artist_form():
     #render form
     form = ArtistForm()
-    #get the genres that are in the database and put them as the choices for the genre part of the form
-    genre_choices = Genre.query.order_by('name').all()
-    form.genres.choices = [(i.id, i.name) for i in genre_choices] + [(0, 'Other')]
+    #get the genres from the cached catalog and put them as the choices for the genre part of the form
+    form.genres.choices = genre_catalog.choices()
     return render_template('forms/new_artist.html', form=form)
 
 @app.route('/artists/create', methods=['POST'])
 def create_artist_submission():
     #render form
     form = ArtistForm(request.form)
-    #get the genres that are in the database and put them as the choices for the genre part of the form
-    genre_choices = Genre.query.order_by('name').all()
-    form.genres.choices = [(i.id, i.name) for i in genre_choices] + [(0, 'Other')]
+    #get the genres from the cached catalog and put them as the choices for the genre part of the form
+    form.genres.choices = genre_catalog.choices(request.form.getlist('genres'))
     error = False   
     if form.validate_on_submit():
         try:
-            #get table objects of the selected genres
-            genre_data = Genre.query.filter(Genre.id.in_(form.genres.data)).order_by('id').all()
+            #get table objects of the selected genres from the catalog
+            genre_data = genre_catalog.genres(form.genres.data)
             #if there's a new genre, add it to the database
             if 0 in form.genres.data:
                 new_genre = Genre(name = form.other_genre.data)
@@ -476,9 +2817,8 @@ def create_artist_submission():
 def edit_artist(artist_id):
     #render form
     form = ArtistForm()
-    #get the genres that are in the database and put them as the choices for the genre part of the form
-    genre_choices = Genre.query.order_by('name').all()
-    form.genres.choices = [(i.id, i.name) for i in genre_choices] + [(0, 'Other')]
+    #get the genres from the cached catalog and put them as the choices for the genre part of the form
+    form.genres.choices = genre_catalog.choices()
     artist = Artist.query.get(artist_id)
     #populating form with values from Artist
     form.name.default = artist.name
@@ -498,15 +2838,14 @@ def edit_artist(artist_id):
 def edit_artist_submission(artist_id):
     #render form
     form = ArtistForm(request.form)
-    #get the genres that are in the database and put them as the choices for the genre part of the form
-    genre_choices = Genre.query.order_by('name').all()
-    form.genres.choices = [(i.id, i.name) for i in genre_choices] + [(0, 'Other')]
+    #get the genres from the cached catalog and put them as the choices for the genre part of the form
+    form.genres.choices = genre_catalog.choices(request.form.getlist('genres'))
     artist = Artist.query.get(artist_id)
     error = False 
     if form.validate_on_submit():
         try:
-            #get table objects of the selected genres
-            genre_data = Genre.query.filter(Genre.id.in_(form.genres.data)).order_by('id').all()
+            #get table objects of the selected genres from the catalog
+            genre_data = genre_catalog.genres(form.genres.data)
             #update artist record in database
             artistobj = db.session.query(Artist).get(artist_id)
             artistobj.name = form.name.data
@@ -543,10 +2882,18 @@ def edit_artist_submission(artist_id):
 #  Shows
 #  ----------------------------------------------------------------
 @app.route('/shows')
+@replica_reads
 def shows():
-  # displays list of shows at /shows
-  data = [i.show_dict() for i in Show.query.all()]        
-  return render_template('pages/shows.html', shows=data)
+  # displays a page of shows at /shows, ordered by start time.
+  # with ?stream=1 every show is listed, streamed from a server-side cursor as the page renders
+  projection = SHOW_PROJECTIONS['listing']
+  if request.args.get('stream', type=int):
+      query = projection.query().order_by(Show.start_time, Show.id
+                ).execution_options(stream_results=True).yield_per(app.config['STREAM_BATCH_SIZE'])
+      return stream_template('pages/shows.html', shows=(projection.record._make(i) for i in query))
+  show_data, next_cursor = keyset_page(projection.query(), [Show.start_time, Show.id], request.args.get('after'))
+  data = projection.records(show_data)
+  return render_template('pages/shows.html', shows=data, next_cursor=next_cursor, limit=page_size())
 
 @app.route('/shows/create')
 def create_shows():
@@ -561,57 +2908,102 @@ def create_show_submission():
     form = ShowForm(request.form)
     error = False   
     if form.validate_on_submit():
-        #check to make sure the selected times for the selected venue don't overlap with a booking 
-        #for that venue already. If it is, then flash message and stay on page
-        if db.session.query(db.exists().where((Show.venue_id == form.venue_id.data) &
-        (((form.start_time.data >= Show.start_time) &
-        (form.start_time.data <= Show.end_time)) |
-        ((form.end_time.data >= Show.start_time) &
-        (form.end_time.data <= Show.end_time)) |
-        (Show.start_time.between(form.start_time.data, form.end_time.data)) |
-        (Show.end_time.between(form.start_time.data, form.end_time.data))
-        ))).scalar():
-            flash('''The venue is unavailable during the entered times, please check availability on the Venue's page''')
+        conflict = None
+        invalid = None
+        try:
+            #book the show, unless the selected times overlap with a booking for the
+            #selected venue or artist already
+            book_show(int(form.venue_id.data), int(form.artist_id.data), form.start_time.data, form.end_time.data)
+            db.session.commit()
+        except BookingConflict as e:
+            db.session.rollback()
+            conflict = e.side
+        except InvalidBooking as e:
+            db.session.rollback()
+            invalid = str(e)
+        except:
+            db.session.rollback()
+            app.logger.exception('show could not be listed')
+            error = True
+        finally:
+            db.session.close()
+        if conflict == 'venue':
+            #if the venue is booked, flash message and stay on page
+            flash('''The venue is unavailable during the entered times, please pick one of the free times listed below the form''')
             return render_template('forms/new_show.html', form=form)
-        #check to make sure the selected times for the selected artist don't overlap with a booking 
-        #for that artist already. If it is, then flash message and stay on page
-        elif db.session.query(db.exists().where((Show.artist_id == form.artist_id.data) &
-        (((form.start_time.data >= Show.start_time) &
-        (form.start_time.data <= Show.end_time)) |
-        ((form.end_time.data >= Show.start_time) &
-        (form.end_time.data <= Show.end_time)) |
-        (Show.start_time.between(form.start_time.data, form.end_time.data)) |
-        (Show.end_time.between(form.start_time.data, form.end_time.data))
-        ))).scalar():
-            flash('''The artist is unavailable during the entered times, please check availability on the Artist's page''')
+        elif conflict == 'artist':
+            #if the artist is booked, flash message and stay on page
+            flash('''The artist is unavailable during the entered times, please pick one of the free times listed below the form''')
+            return render_template('forms/new_show.html', form=form)
+        elif invalid:
+            #if the show can't be booked, flash the reason and stay on page
+            flash('Show could not be listed: ' + invalid + '.')
+            return render_template('forms/new_show.html', form=form)
+        elif error:
+            #if there's an error, flash message and stay on page
+            flash('An error occurred. Show could not be listed.')
             return render_template('forms/new_show.html', form=form)
         else:
-            try:
-                #if show isn't overlapping and can be booked, then create record for show and put in database
-                show = Show(venue_id = form.venue_id.data,
-                            artist_id = form.artist_id.data,
-                            start_time = form.start_time.data,
-                            end_time = form.end_time.data
-                            )
-                db.session.add(show)
-                db.session.commit()
-            except:
-                db.session.rollback()
-                error = True
-            finally:
-                db.session.close()
-            if error:
-                #if there's an error, flash message and stay on page
-                flash('An error occurred. Show could not be listed.')
-                return render_template('forms/new_show.html', form=form)
-            else:
-                # on successful db insert, flash success and show home page
-                flash('Show was successfully listed!')
-                return render_template('pages/home.html')
+            # on successful db insert, flash success and show home page
+            flash('Show was successfully listed!')
+            return render_template('pages/home.html')
     else:
-        flash('An error occurred. Show could not be listed.')
+        #flash why the form was rejected and stay on page
+        for field, errors in form.errors.items():
+            flash(f'Show could not be listed: {field} - {errors[0]}')
         return render_template('forms/new_show.html', form=form)   
 
+#  Availability
+#  ----------------------------------------------------------------
+def availability_time(name):
+    # a time argument in ISO 8601, times with an offset are converted to APP_TIMEZONE
+    return local_time(datetime.fromisoformat(request.args[name]))
+
+def availability_response(sides):
+    # free and busy times between ?from= (now by default) and ?to= (AVAILABILITY_DAYS later by default)
+    # of the (side, id) venues/artists together, keeping the free times at least ?min_slot= minutes long
+    for side, id in sides:
+        model = Venue if side == 'venue' else Artist
+        if db.session.query(model.id).filter(model.id == id).first() is None:
+            return api_error(f'{side} {id} not found', 404)
+    try:
+        start = availability_time('from') if request.args.get('from') else \
+            request_now().replace(second=0, microsecond=0)
+        end = availability_time('to') if request.args.get('to') else \
+            start + timedelta(days=app.config['AVAILABILITY_DAYS'])
+    except ValueError:
+        return api_error('from and to must be ISO 8601 times', 400)
+    if end <= start:
+        return api_error('to must be after from', 400)
+    if end - start > timedelta(days=app.config['AVAILABILITY_MAX_DAYS']):
+        return api_error(f"at most {app.config['AVAILABILITY_MAX_DAYS']} days can be looked up at once", 400)
+    min_slot = request.args.get('min_slot', 0)
+    if not str(min_slot).isdigit():
+        return api_error('min_slot must be a number of minutes', 400)
+    busy = busy_intervals(sides, start, end)
+    free = free_intervals(busy, start, end, timedelta(minutes=int(min_slot)))
+    return api_response({'from': start, 'to': end,
+                         'busy': [{'start': i, 'end': j} for i, j in busy],
+                         'free': [{'start': i, 'end': j} for i, j in free]})
+
+@app.route('/venues/<int:venue_id>/availability')
+@replica_reads
+def venue_availability(venue_id):
+    # the venue's availability, together with an artist's with ?artist_id=
+    sides = [('venue', venue_id)]
+    if request.args.get('artist_id', type=int):
+        sides.append(('artist', request.args.get('artist_id', type=int)))
+    return availability_response(sides)
+
+@app.route('/artists/<int:artist_id>/availability')
+@replica_reads
+def artist_availability(artist_id):
+    # the artist's availability, together with a venue's with ?venue_id=
+    sides = [('artist', artist_id)]
+    if request.args.get('venue_id', type=int):
+        sides.append(('venue', request.args.get('venue_id', type=int)))
+    return availability_response(sides)
+
 #  Albums
 #  ----------------------------------------------------------------
 @app.route('/artist/<artist_id>/create_album')
@@ -705,6 +3097,109 @@ def create_song_submission(artist_id):
         flash('An error occurred. Show could not be listed.')
         return render_template('forms/new_song.html', form=form)   
 
+#  Autocomplete
+#  ----------------------------------------------------------------
+@app.route('/autocomplete')
+def autocomplete():
+    # suggests venue, artist and genre names matching q, served from memory.
+    # type limits the suggestions to one kind of name
+    query = request.args.get('q', '')
+    limit = max(1, min(request.args.get('limit', app.config['SUGGESTION_LIMIT'], type=int), app.config['MAX_PAGE_SIZE']))
+    kinds = request.args.getlist('type') or list(SUGGESTION_MODELS)
+    indexes = suggestion_catalog.get()
+    return jsonify({i: indexes[i].suggest(query, limit) for i in kinds if i in indexes})
+
+#  API
+#  ----------------------------------------------------------------
+@app.route('/api/v1/<resource>')
+@replica_reads
+def api_collection(resource):
+    # a page of the resource's records ordered by id, with the cursor of the next page
+    try:
+        model, projection, fields, include = api_request(resource)
+    except ApiError as e:
+        return api_error(e.message, e.status)
+    #?sort=popular orders venues and artists by their upcoming show counters, most first
+    if request.args.get('sort'):
+        keys, descending = [model.num_upcoming_shows, model.id], True
+    else:
+        keys, descending = [model.id], False
+    rows, next_cursor = keyset_page(projection.query(), keys, request.args.get('after'), descending=descending)
+    records = projection.records(rows)
+    return api_response({'data': api_dicts(model, records, fields, include), 'next': next_cursor})
+
+@app.route('/api/v1/<resource>/<int:id>')
+@replica_reads
+def api_detail(resource, id):
+    # a single record of the resource
+    try:
+        model, projection, fields, include = api_request(resource)
+    except ApiError as e:
+        return api_error(e.message, e.status)
+    records = projection.records(projection.query().filter(model.id == id))
+    if not records:
+        return api_error(f'{resource} {id} not found', 404)
+    return api_response({'data': api_dicts(model, records, fields, include)[0]})
+
+#  Metrics
+#  ----------------------------------------------------------------
+@app.route('/metrics/pool')
+def pool_metrics_view():
+    # counters of each engine's connection pool
+    return jsonify({name: metrics.snapshot() for name, metrics in pool_metrics.items()})
+
+@app.route('/metrics/endpoints')
+def endpoint_metrics_view():
+    # request counts and timings of each endpoint, the most time consuming first
+    return jsonify(endpoint_stats.report())
+
+#  Export
+#  ----------------------------------------------------------------
+@app.route('/export/<name>')
+@replica_reads
+def export_table(name):
+    # streams a table as NDJSON or CSV (?format=), gzipped with ?gzip=1, from ?after_id= and ?since=.
+    # the X-Export-Watermark header is the after_id of the next incremental export
+    if name not in EXPORT_TABLES:
+        return api_error(f'unknown table {name}', 404)
+    format = request.args.get('format', 'ndjson')
+    if format not in EXPORT_FORMATS:
+        return api_error(f'unknown format {format}', 400)
+    compress = bool(request.args.get('gzip', type=int))
+    after_id = request.args.get('after_id', type=int)
+    since = request.args.get('since')
+    try:
+        since = datetime.fromisoformat(since) if since else None
+    except ValueError:
+        return api_error(f'invalid since {since}', 400)
+    if since is not None and EXPORT_TABLES[name][2] is None:
+        return api_error(f'{name} have no time to export from', 400)
+    if after_id is not None and not EXPORT_TABLES[name][3]:
+        return api_error(f'{name} are edited after they are added, they can only be exported in full', 400)
+    connection = db.get_engine(app, bind=g.get('replica')).connect()
+    transaction = connection.begin()
+    try:
+        watermark = export_watermark(connection, name)
+    except Exception:
+        connection.close()
+        raise
+
+    def generate():
+        chunks = export_chunks(connection, name, format, compress, watermark, after_id, since)
+        try:
+            yield from chunks
+        finally:
+            chunks.close()
+            transaction.rollback()
+            connection.close()
+
+    filename = export_filename(name, format, compress)
+    response = Response(stream_with_context(generate()),
+                        mimetype='application/gzip' if compress else EXPORT_FORMATS[format])
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    response.headers['X-Export-Watermark'] = '' if watermark is None else str(watermark)
+    return response
+
 #  Error Handlers
 #  ----------------------------------------------------------------
 @app.errorhandler(404)
@@ -717,14 +3212,12 @@ def server_error(error):
 
 
 if not app.debug:
-    file_handler = FileHandler('error.log')
-    file_handler.setFormatter(
-        Formatter('%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]')
-    )
+    #structured log of errors, slow requests and pool metrics, one JSON object per line
+    log_handler = FileHandler(app.config['LOG_FILE']) if app.config['LOG_FILE'] else logging.StreamHandler()
+    log_handler.setFormatter(JsonFormatter())
     app.logger.setLevel(logging.INFO)
-    file_handler.setLevel(logging.INFO)
-    app.logger.addHandler(file_handler)
-    app.logger.info('errors')
+    log_handler.setLevel(logging.INFO)
+    app.logger.addHandler(log_handler)
 
 #----------------------------------------------------------------------------#
 # Launch.
@@ -0,0 +1,202 @@
+"""Benchmark every page against synthetic datasets and report the results as JSON.
+
+    python benchmark.py [--scales 1,10] [--venues 50] [--artists 50] [--shows-per-venue 10]
+                        [--albums-per-artist 2] [--songs-per-album 8] [--genres 20]
+                        [--repeat 20] [--database sqlite:///benchmark.db] [--output results.json]
+
+For each scale the database is emptied and filled with a seeded synthetic dataset
+(venue, artist, show, album and song counts are multiplied by the scale, genres aren't).
+Every GET page, filled in with a venue and an artist of the dataset, and both search
+forms are then requested --repeat times through the test client. Each route is reported
+with its p50/p95 latency, the number of queries it issued and the peak memory allocated
+while it ran. The database given with --database is emptied, so it defaults to a local
+SQLite file rather than the configured one.
+"""
+import argparse, json, platform, random, sys, time, tracemalloc
+from datetime import datetime, timedelta
+from sqlalchemy import event, text
+from app import (app, db, page_cache, Venue, Artist, Show, Album, Song, import_entities,
+                 bulk_insert, bulk_insert_ids, refresh_areas, refresh_show_counters)
+
+WORDS = ['Blue', 'Velvet', 'Electric', 'Golden', 'Midnight', 'Silver', 'Lost', 'Wild', 'Neon', 'Hollow',
+         'Echo', 'Static', 'Paper', 'Iron', 'Crystal', 'Lunar', 'Copper', 'Red', 'Quiet', 'Northern']
+PLACES = [('San Francisco', 'CA'), ('New York', 'NY'), ('Austin', 'TX'), ('Portland', 'OR'),
+          ('Seattle', 'WA'), ('Chicago', 'IL'), ('Nashville', 'TN'), ('Denver', 'CO')]
+# rows inserted per statement while loading a dataset
+LOAD_BATCH = 1000
+
+def batches(rows):
+    for i in range(0, len(rows), LOAD_BATCH):
+        yield rows[i:i + LOAD_BATCH]
+
+def reset_database():
+    db.session.remove()
+    if db.engine.dialect.name == 'sqlite':
+        db.session.execute(text('DROP TABLE IF EXISTS search_index'))
+        db.session.commit()
+    db.drop_all()
+    db.create_all()
+
+def load_dataset(counts, seed):
+    #fill the empty database with a synthetic dataset of the given counts. Shows are given
+    #distinct three hour slots, half of them past, so no venue or artist is double booked
+    rng = random.Random(seed)
+    name = lambda: ' '.join(rng.sample(WORDS, 2))
+    genres = [f'Genre {i}' for i in range(counts['genres'])]
+    connection = db.session.connection()
+    ids = {}
+    for model, kind in ((Venue, 'venues'), (Artist, 'artists')):
+        ids[kind] = []
+        for batch in batches(list(range(counts[kind]))):
+            rows = []
+            for n in batch:
+                city, state = rng.choice(PLACES)
+                row = {'name': f'{name()} {n}', 'city': city, 'state': state, 'phone': '555-555-5555',
+                       'image_link': None, 'facebook_link': None, 'website': None, 'seeking_description': None,
+                       'genres': rng.sample(genres, min(len(genres), rng.randint(1, 3)))}
+                if model is Venue:
+                    row.update(address=f'{n} Main St', seeking_talent=rng.random() < 0.5)
+                else:
+                    row.update(seeking_venue=rng.random() < 0.5)
+                rows.append(row)
+            ids[kind] += import_entities(connection, model, rows)
+    total = counts['venues'] * counts['shows_per_venue']
+    first = datetime.now().replace(microsecond=0) - timedelta(hours=3 * (total // 2))
+    slots = list(range(total))
+    rng.shuffle(slots)
+    shows = [{'venue_id': ids['venues'][n // counts['shows_per_venue']], 'artist_id': rng.choice(ids['artists']),
+              'start_time': first + timedelta(hours=3 * slot), 'end_time': first + timedelta(hours=3 * slot + 2)}
+             for n, slot in enumerate(slots)] if ids['artists'] else []
+    for batch in batches(shows):
+        bulk_insert(connection, Show.__table__, batch)
+    albums = [{'artist_id': artist_id, 'name': name(), 'release_date': first + timedelta(days=rng.randint(0, 3650))}
+              for artist_id in ids['artists'] for _ in range(counts['albums_per_artist'])]
+    for batch in batches(albums):
+        album_ids = bulk_insert_ids(connection, Album, batch)
+        bulk_insert(connection, Song.__table__, [
+            {'album_id': album_id, 'artist_id': album['artist_id'], 'name': name(), 'release_date': album['release_date']}
+            for album_id, album in zip(album_ids, batch) for _ in range(counts['songs_per_album'])])
+    for model in (Venue, Artist):
+        refresh_show_counters(connection, model)
+    refresh_areas(connection)
+    db.session.commit()
+    return ids
+
+def sample_requests(venue_id, artist_id):
+    #(method, url, form data) of every page that can be requested with the sample ids
+    args = {'venue_id': venue_id, 'artist_id': artist_id, 'resource': 'venues', 'id': venue_id, 'name': 'shows'}
+    requests = []
+    with app.test_request_context():
+        for rule in sorted(app.url_map.iter_rules(), key=lambda i: i.rule):
+            if rule.endpoint == 'static' or 'GET' not in rule.methods or not rule.arguments.issubset(args):
+                continue
+            url = rule.build({i: args[i] for i in rule.arguments}, append_unknown=False)[1]
+            requests.append(('GET', url, None))
+    requests.append(('GET', '/shows?stream=1', None))
+    term = WORDS[0]
+    requests += [('POST', '/venues/search', {'search_term': term}), ('POST', '/artists/search', {'search_term': term})]
+    return requests
+
+def percentile(values, p):
+    #nearest rank percentile
+    values = sorted(values)
+    return values[max(0, -(-len(values) * p // 100) - 1)]
+
+def measure(client, requests, repeat):
+    queries = {'count': 0}
+
+    def count(*args):
+        queries['count'] += 1
+
+    results = {}
+    event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        for method, url, data in requests:
+            #one request to warm up the caches (page cache, genre catalog, suggestions)
+            response = client.open(url, method=method, data=data)
+            response.get_data()
+            times = []
+            queries['count'] = 0
+            for _ in range(repeat):
+                start = time.perf_counter()
+                response = client.open(url, method=method, data=data)
+                response.get_data()
+                times.append(time.perf_counter() - start)
+            query_count = queries['count'] / repeat
+            #memory is measured on a separate request, tracing slows everything down
+            tracemalloc.start()
+            client.open(url, method=method, data=data).get_data()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results[f'{method} {url}'] = {
+                'status': response.status_code,
+                'p50_ms': round(percentile(times, 50) * 1000, 3),
+                'p95_ms': round(percentile(times, 95) * 1000, 3),
+                'mean_ms': round(sum(times) / len(times) * 1000, 3),
+                'queries': query_count,
+                'peak_memory_kib': round(peak / 1024, 1),
+            }
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark every page against synthetic datasets.')
+    parser.add_argument('--scales', default='1', help='comma separated dataset size multipliers')
+    parser.add_argument('--venues', type=int, default=50)
+    parser.add_argument('--artists', type=int, default=50)
+    parser.add_argument('--shows-per-venue', type=int, default=10)
+    parser.add_argument('--albums-per-artist', type=int, default=2)
+    parser.add_argument('--songs-per-album', type=int, default=8)
+    parser.add_argument('--genres', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=20, help='timed requests per route')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-page-cache', action='store_true', help='render the detail pages on every request')
+    parser.add_argument('--database', default='sqlite:///benchmark.db', help='database to fill, it is emptied first')
+    parser.add_argument('--output', help='write the results to this file instead of stdout')
+    options = parser.parse_args()
+
+    app.config.update(SQLALCHEMY_DATABASE_URI=options.database, SQLALCHEMY_BINDS={}, WTF_CSRF_ENABLED=False,
+                      DB_POOL_LOG_INTERVAL=0, SLOW_REQUEST_MS=float('inf'))
+    if options.no_page_cache:
+        app.config['PAGE_CACHE_MAX_BYTES'] = 0
+    report = {
+        'generated_at': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'repeat': options.repeat,
+        'page_cache': not options.no_page_cache,
+        'datasets': [],
+    }
+    for scale in (int(i) for i in options.scales.split(',')):
+        counts = {
+            'venues': options.venues * scale,
+            'artists': options.artists * scale,
+            'shows_per_venue': options.shows_per_venue,
+            'albums_per_artist': options.albums_per_artist,
+            'songs_per_album': options.songs_per_album,
+            'genres': options.genres,
+        }
+        with app.app_context():
+            report['database'] = db.engine.dialect.name
+            reset_database()
+            start = time.perf_counter()
+            ids = load_dataset(counts, options.seed)
+            load_seconds = time.perf_counter() - start
+            page_cache.clear()
+            #a venue and an artist from the middle of the dataset
+            venue_id = ids['venues'][len(ids['venues']) // 2] if ids['venues'] else 1
+            artist_id = ids['artists'][len(ids['artists']) // 2] if ids['artists'] else 1
+            db.session.remove()
+        print(f'scale {scale}: {counts} loaded in {load_seconds:.1f}s', file=sys.stderr)
+        routes = measure(app.test_client(), sample_requests(venue_id, artist_id), options.repeat)
+        report['datasets'].append({'scale': scale, 'counts': counts, 'load_seconds': round(load_seconds, 3),
+                                   'routes': routes})
+    output = json.dumps(report, indent=2)
+    if options.output:
+        with open(options.output, 'w') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
@@ -7,8 +7,87 @@ basedir = os.path.abspath(os.path.dirname(__file__))
 DEBUG = True
 
 # Connect to the database
-SQLALCHEMY_DATABASE_URI = 'postgresql://postgres@localhost:5432/fyyurapp'
+SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'postgresql://postgres@localhost:5432/fyyurapp')
+
+# Connection pool: connections kept open, extra connections opened under load, seconds
+# to wait for a free connection, whether to test connections before use and seconds
+# after which they're reopened. Statements running longer than DB_STATEMENT_TIMEOUT_MS
+# are cancelled (0 disables it, Postgres only)
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 30000))
+
+# Read replicas: comma separated database URLs the read only pages are served from,
+# picked in turn ('round_robin') or by fewest connections in use ('least_load'). A
+# client that wrote reads from the primary for REPLICA_MAX_LAG seconds after
+REPLICA_URLS = [i for i in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if i]
+SQLALCHEMY_BINDS = {f'replica_{n}': url for n, url in enumerate(REPLICA_URLS, start=1)}
+REPLICA_SELECTION = os.environ.get('REPLICA_SELECTION', 'round_robin')
+REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG', 5))
+
+# Seconds between pool metrics log lines (0 disables them), and the wait for a
+# connection, in seconds, above which a checkout is logged as a warning
+DB_POOL_LOG_INTERVAL = int(os.environ.get('DB_POOL_LOG_INTERVAL', 60))
+DB_POOL_SLOW_WAIT = float(os.environ.get('DB_POOL_SLOW_WAIT', 1))
 
 locale.setlocale(locale.LC_ALL, 'en_US.UTF-8')
 BABEL_DEFAULT_LOCALE = 'en'
-BABEL_DEFAULT_TIMEZONE = 'UTC'
\ No newline at end of file
+# Timezone of the stored show times: pages render them in it, "now" and times given with
+# an offset are converted to it
+BABEL_DEFAULT_TIMEZONE = 'UTC'
+
+# Number of upcoming and of past shows listed on a venue or artist page
+SHOWS_PER_SECTION = 20
+
+# Number of venues listed per city/state on the venues page (None lists all of them)
+VENUES_PER_AREA = None
+
+# Default and maximum number of rows per page on paginated listings
+PAGE_SIZE = 30
+MAX_PAGE_SIZE = 100
+
+# Number of autocomplete suggestions returned per kind of name
+SUGGESTION_LIMIT = 10
+
+# Seconds the genre catalog of the forms is served from memory before it's reloaded, so
+# the genres committed by other processes (other workers, `flask import`) show up
+GENRE_CATALOG_TTL = 60
+
+# Seconds the autocomplete indexes are served before they're rebuilt, for the same reason
+SUGGESTION_INDEX_TTL = 300
+
+# Longest show that can be booked; bounds the window searched for overlapping bookings
+MAX_SHOW_HOURS = 24
+
+# Memory cap of the rendered venue/artist page cache (0 disables it), and how long a
+# cached page may be served before it's rendered again
+PAGE_CACHE_MAX_BYTES = 32 * 1024 * 1024
+PAGE_CACHE_TTL = 300
+
+# Number of formatted datetimes kept by the datetime template filter
+DATETIME_FORMAT_CACHE_SIZE = 4096
+
+# Rows fetched per round trip when streaming a listing from a server-side cursor
+STREAM_BATCH_SIZE = 500
+
+# Requests taking longer than this many milliseconds are logged with their SQL timings
+SLOW_REQUEST_MS = int(os.environ.get('SLOW_REQUEST_MS', 500))
+
+# File of the JSON lines log when not in debug mode (stderr when empty)
+LOG_FILE = os.environ.get('LOG_FILE', 'error.log')
+
+# Background jobs: worker threads, attempts before a job fails, seconds between retries
+# (times the attempt), seconds after which a running job is considered abandoned, and
+# rows deleted per transaction
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_MAX_ATTEMPTS = 3
+JOB_RETRY_DELAY = 5
+JOB_STALE_SECONDS = 600
+JOB_BATCH_SIZE = 500
+
+# Days of free and busy times returned by the availability endpoints by default, and at most
+AVAILABILITY_DAYS = 7
+AVAILABILITY_MAX_DAYS = 92
@@ -0,0 +1,134 @@
+"""Run EXPLAIN on every query issued by the app's pages and flag sequential scans.
+
+    python explain.py [--min-rows 1000]
+
+Every GET page (filled in with the first venue and artist of the database) and both
+search forms are requested through the test client while their SELECT statements are
+recorded, on the primary and on every replica. Each statement is then explained on the
+database it ran on, and a sequential scan of a table holding at least --min-rows rows is
+reported. On SQLite a scan that a LIMIT stops early (in rowid or index order, without a
+sort) isn't a full scan, so keyset pages aren't flagged. Exits with status 1 if any was
+found, so it can run as a check before deploying.
+"""
+import argparse, json, sys
+from sqlalchemy import event
+from app import app, db, Venue, Artist, replica_binds
+
+# values for the url arguments of the routes
+def sample_args():
+    venue = Venue.query.order_by(Venue.id).first()
+    artist = Artist.query.order_by(Artist.id).first()
+    args = {}
+    if venue:
+        args['venue_id'] = venue.id
+    if artist:
+        args['artist_id'] = artist.id
+    return args, venue, artist
+
+def sample_requests():
+    #(method, url, form data) of every page that can be requested with the sample data
+    with app.test_request_context():
+        args, venue, artist = sample_args()
+        requests = []
+        for rule in app.url_map.iter_rules():
+            if rule.endpoint == 'static' or 'GET' not in rule.methods:
+                continue
+            if not rule.arguments.issubset(args):
+                continue
+            url = rule.build({i: args[i] for i in rule.arguments}, append_unknown=False)[1]
+            requests.append(('GET', url, None))
+        for url, sample in (('/venues/search', venue), ('/artists/search', artist)):
+            term = sample.name.split()[0] if sample else 'a'
+            requests.append(('POST', url, {'search_term': term}))
+    return requests
+
+def engines():
+    #the primary's engine and those of the replicas the reads can be routed to
+    return [db.engine] + [db.get_engine(app, bind=i) for i in replica_binds()]
+
+def capture_statements(requests):
+    #the distinct SELECT statements issued by each request, with their parameters and engine
+    statements = []
+    current = {}
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            statements.append((current['request'], statement, parameters, conn.engine))
+
+    client = app.test_client()
+    for engine in engines():
+        event.listen(engine, 'before_cursor_execute', record)
+    try:
+        for method, url, data in requests:
+            current['request'] = f'{method} {url}'
+            client.open(url, method=method, data=data)
+    finally:
+        for engine in engines():
+            event.remove(engine, 'before_cursor_execute', record)
+    seen = set()
+    unique = []
+    for request, statement, parameters, engine in statements:
+        if (request, statement, engine) not in seen:
+            seen.add((request, statement, engine))
+            unique.append((request, statement, parameters, engine))
+    return unique
+
+def table_sizes(connection):
+    if connection.dialect.name == 'postgresql':
+        return {name: int(rows) for name, rows in
+                connection.execute("SELECT relname, reltuples FROM pg_class WHERE relkind = 'r'")}
+    return {name: connection.execute(f'SELECT count(*) FROM "{name}"').scalar()
+            for name in db.metadata.tables}
+
+def scanned_tables(connection, statement, parameters):
+    #tables read by a sequential scan in the plan of the statement
+    if connection.dialect.name == 'postgresql':
+        plan = connection.execute('EXPLAIN (FORMAT JSON) ' + statement, parameters).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        tables = []
+        nodes = [plan[0]['Plan']]
+        while nodes:
+            node = nodes.pop()
+            if node['Node Type'] == 'Seq Scan':
+                tables.append(node['Relation Name'])
+            nodes.extend(node.get('Plans', []))
+        return tables
+    #SQLite reports "SCAN <table>" for a full table scan and "SEARCH" or "USING ... INDEX" otherwise.
+    #a scan in rowid order ("USING INTEGER PRIMARY KEY" on older versions) stops at the LIMIT
+    #unless the rows are sorted or grouped first
+    details = [row[-1] for row in connection.execute('EXPLAIN QUERY PLAN ' + statement, parameters)]
+    words = statement.upper().split()
+    bounded = 'LIMIT' in words and 'GROUP' not in words and not any('TEMP B-TREE' in i for i in details)
+    tables = []
+    for detail in map(str.split, details):
+        if detail[0] == 'SCAN' and 'INDEX' not in detail and not bounded:
+            tables.append(detail[2] if detail[1] == 'TABLE' else detail[1])
+    return tables
+
+def main():
+    parser = argparse.ArgumentParser(description='Flag sequential scans in the queries of every page.')
+    parser.add_argument('--min-rows', type=int, default=1000,
+                        help='only flag scans of tables with at least this many rows')
+    options = parser.parse_args()
+    with app.app_context():
+        statements = capture_statements(sample_requests())
+        flagged = 0
+        for engine in engines():
+            with engine.connect() as connection:
+                sizes = table_sizes(connection)
+                for request, statement, parameters, ran_on in statements:
+                    if ran_on is not engine:
+                        continue
+                    for table in scanned_tables(connection, statement, parameters):
+                        #scans of subqueries and CTEs aren't table scans
+                        rows = sizes.get(table.strip('"'))
+                        if rows is not None and rows >= options.min_rows:
+                            flagged += 1
+                            print(f'{request}: sequential scan of {table} ({rows} rows) on {engine.url.database}')
+                            print('    ' + ' '.join(statement.split())[:200])
+        print(f'{len(statements)} statements explained, {flagged} sequential scans flagged')
+    sys.exit(1 if flagged else 0)
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,7 @@
 from datetime import datetime
 from flask_wtf import Form
 from wtforms import StringField, SelectField, SelectMultipleField, DateTimeField, BooleanField
-from wtforms.validators import DataRequired, URL, Optional
+from wtforms.validators import DataRequired, URL, Optional, Regexp, ValidationError
 
 class RequiredIfOther(DataRequired):
     """Validator which makes a field required if another field is set and has a truthy value."""
@@ -20,10 +20,10 @@ class RequiredIfOther(DataRequired):
 
 class ShowForm(Form):
     artist_id = StringField(
-        'artist_id'
+        'artist_id', validators=[DataRequired(), Regexp(r'^\s*\d+\s*$', message='Not a valid ID.')]
     )
     venue_id = StringField(
-        'venue_id'
+        'venue_id', validators=[DataRequired(), Regexp(r'^\s*\d+\s*$', message='Not a valid ID.')]
     )
     start_time = DateTimeField(
         'start_time',
@@ -36,12 +36,9 @@ class ShowForm(Form):
         default=datetime.today()
     )
 
-    def validate_on_submit(self):
-        result = super(ShowForm, self).validate()
-        if (self.start_time.data >= self.end_time.data):
-            return False
-        else:
-            return result
+    def validate_end_time(self, field):
+        if self.start_time.data and field.data and field.data <= self.start_time.data:
+            raise ValidationError('The end time must be after the start time.')
 
 class VenueForm(Form):
     name = StringField(
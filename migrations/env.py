@@ -27,6 +27,19 @@ config.set_main_option(
         'SQLALCHEMY_DATABASE_URI').replace('%', '%%'))
 target_metadata = current_app.extensions['migrate'].db.metadata
 
+# the search index (search_vector columns on Postgres, the search_index FTS5
+# table on SQLite) and the name trigram indexes aren't mapped on the models, keep
+# autogenerate from dropping them. The show booking exclusion constraints aren't
+# reflected, so autogenerate doesn't see them
+def include_object(object, name, type_, reflected, compare_to):
+    if type_ == 'column' and name == 'search_vector':
+        return False
+    if type_ == 'index' and name.endswith(('_search_vector', '_name_trgm')):
+        return False
+    if type_ == 'table' and name.startswith('search_index'):
+        return False
+    return True
+
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
 # my_important_option = config.get_main_option("my_important_option")
@@ -47,7 +60,8 @@ def run_migrations_offline():
     """
     url = config.get_main_option("sqlalchemy.url")
     context.configure(
-        url=url, target_metadata=target_metadata, literal_binds=True
+        url=url, target_metadata=target_metadata, literal_binds=True,
+        include_object=include_object
     )
 
     with context.begin_transaction():
@@ -83,6 +97,7 @@ def run_migrations_online():
             connection=connection,
             target_metadata=target_metadata,
             process_revision_directives=process_revision_directives,
+            include_object=include_object,
             **current_app.extensions['migrate'].configure_args
         )
 
@@ -0,0 +1,56 @@
+"""add search index
+
+Revision ID: 3f1c2a9b7d40
+Revises: b58316b1b0a2
+Create Date: 2026-10-18 09:12:40.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a9b7d40'
+down_revision = 'b58316b1b0a2'
+branch_labels = None
+depends_on = None
+
+# searchable table, its genre association table and key column
+SEARCHABLE = [
+    ('Venue', 'venue_genres', 'venue_id'),
+    ('Artist', 'artist_genres', 'artist_id'),
+]
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        for table, genres, key in SEARCHABLE:
+            op.execute(f'ALTER TABLE "{table}" ADD COLUMN search_vector tsvector')
+            op.execute(f'''
+                UPDATE "{table}" SET search_vector =
+                    setweight(to_tsvector('simple', coalesce(name, '')), 'A') ||
+                    setweight(to_tsvector('simple', coalesce(city, '') || ' ' || coalesce(state, '') || ' ' ||
+                        coalesce((SELECT string_agg(g.name, ' ') FROM {genres} a JOIN "Genre" g ON g.id = a.genre_id
+                                  WHERE a.{key} = "{table}".id), '')), 'B')''')
+            op.create_index(f'ix_{table}_search_vector', table, ['search_vector'], postgresql_using='gin')
+    elif dialect == 'sqlite':
+        op.execute('CREATE VIRTUAL TABLE IF NOT EXISTS search_index '
+                   'USING fts5(kind UNINDEXED, entity_id UNINDEXED, name, city, state, genres)')
+        for table, genres, key in SEARCHABLE:
+            op.execute(f'''
+                INSERT INTO search_index (kind, entity_id, name, city, state, genres)
+                SELECT '{table}', e.id, e.name, e.city, e.state,
+                       (SELECT group_concat(g.name, ' ') FROM {genres} a JOIN "Genre" g ON g.id = a.genre_id
+                        WHERE a.{key} = e.id)
+                FROM "{table}" e''')
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        for table, genres, key in SEARCHABLE:
+            op.drop_index(f'ix_{table}_search_vector', table_name=table)
+            op.drop_column(table, 'search_vector')
+    elif dialect == 'sqlite':
+        op.execute('DROP TABLE IF EXISTS search_index')
@@ -0,0 +1,48 @@
+"""add show booking indexes and constraints
+
+Revision ID: 7c2e5d1a9f63
+Revises: 3f1c2a9b7d40
+Create Date: 2026-10-18 11:02:17.530921
+
+"""
+from alembic import op
+from flask import current_app
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c2e5d1a9f63'
+down_revision = '3f1c2a9b7d40'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # bookings are only checked against shows starting at most MAX_SHOW_HOURS earlier, so longer
+    # shows booked before would never be found to conflict. They have to be split or shortened by hand first
+    bind = op.get_bind()
+    hours = current_app.config['MAX_SHOW_HOURS']
+    if bind.dialect.name == 'postgresql':
+        longer = f"end_time - start_time > interval '{hours} hours'"
+    else:
+        longer = f'(julianday(end_time) - julianday(start_time)) * 24 > {hours}'
+    ids = [i for (i,) in bind.execute(f'SELECT id FROM "Show" WHERE {longer} ORDER BY id')]
+    if ids:
+        raise RuntimeError(f'shows {", ".join(map(str, ids))} are longer than MAX_SHOW_HOURS ({hours} hours)')
+    op.create_index('ix_Show_venue_id_start_time', 'Show', ['venue_id', 'start_time'], unique=False)
+    op.create_index('ix_Show_artist_id_start_time', 'Show', ['artist_id', 'start_time'], unique=False)
+    if op.get_bind().dialect.name == 'postgresql':
+        # fails if overlapping shows were booked before, they have to be fixed by hand first
+        op.execute('CREATE EXTENSION IF NOT EXISTS btree_gist')
+        op.execute('ALTER TABLE "Show" ADD CONSTRAINT "Show_venue_id_no_overlap" '
+                   'EXCLUDE USING gist (venue_id WITH =, tsrange(start_time, end_time) WITH &&)')
+        op.execute('ALTER TABLE "Show" ADD CONSTRAINT "Show_artist_id_no_overlap" '
+                   'EXCLUDE USING gist (artist_id WITH =, tsrange(start_time, end_time) WITH &&)')
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.drop_constraint('Show_artist_id_no_overlap', 'Show')
+        op.drop_constraint('Show_venue_id_no_overlap', 'Show')
+    op.drop_index('ix_Show_artist_id_start_time', table_name='Show')
+    op.drop_index('ix_Show_venue_id_start_time', table_name='Show')
@@ -0,0 +1,31 @@
+"""add trigram indexes on venue and artist names
+
+Revision ID: 8e3a5c7b9d12
+Revises: 6c8d2f4e1a93
+Create Date: 2026-10-18 22:05:13.284170
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8e3a5c7b9d12'
+down_revision = '6c8d2f4e1a93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # serve the name substring part of search on Postgres
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        for table in ('Venue', 'Artist'):
+            op.create_index(f'ix_{table}_name_trgm', table, ['name'], postgresql_using='gin',
+                            postgresql_ops={'name': 'gin_trgm_ops'})
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        for table in ('Artist', 'Venue'):
+            op.drop_index(f'ix_{table}_name_trgm', table_name=table)
@@ -0,0 +1,39 @@
+"""add foreign key and listing indexes
+
+Revision ID: 9a4b6e2c1d85
+Revises: 7c2e5d1a9f63
+Create Date: 2026-10-18 13:40:52.207316
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a4b6e2c1d85'
+down_revision = '7c2e5d1a9f63'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # ### Show.venue_id and Show.artist_id are covered by ix_Show_venue_id_start_time and ix_Show_artist_id_start_time ###
+    op.create_index('ix_Album_artist_id', 'Album', ['artist_id'], unique=False)
+    op.create_index('ix_Song_album_id', 'Song', ['album_id'], unique=False)
+    op.create_index('ix_Song_artist_id', 'Song', ['artist_id'], unique=False)
+    op.create_index('ix_venue_genres_genre_id', 'venue_genres', ['genre_id'], unique=False)
+    op.create_index('ix_artist_genres_genre_id', 'artist_genres', ['genre_id'], unique=False)
+    op.create_index('ix_Venue_city_state', 'Venue', ['city', 'state'], unique=False)
+    op.create_index('ix_Artist_name_id', 'Artist', ['name', 'id'], unique=False)
+    op.create_index('ix_Show_start_time_id', 'Show', ['start_time', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_Show_start_time_id', table_name='Show')
+    op.drop_index('ix_Artist_name_id', table_name='Artist')
+    op.drop_index('ix_Venue_city_state', table_name='Venue')
+    op.drop_index('ix_artist_genres_genre_id', table_name='artist_genres')
+    op.drop_index('ix_venue_genres_genre_id', table_name='venue_genres')
+    op.drop_index('ix_Song_artist_id', table_name='Song')
+    op.drop_index('ix_Song_album_id', table_name='Song')
+    op.drop_index('ix_Album_artist_id', table_name='Album')
@@ -0,0 +1,876 @@
+"""Regression tests of the app.
+
+    python test_app.py -v
+
+The tests run against TEST_DATABASE_URL, a temporary SQLite database by default. Set it
+to an empty Postgres database to also cover the Postgres only paths (COPY, exclusion
+constraints, upserts); every table of that database is dropped. The replica routing tests
+read from TEST_REPLICA_URL, another temporary SQLite database by default.
+"""
+import babel.dates, csv, html, json, os, re, sqlite3, tempfile, threading, time, unittest
+from datetime import datetime, timedelta, timezone
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'TEST_DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'test.db'))
+REPLICA_URL = os.environ.get('TEST_REPLICA_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'replica.db'))
+
+from unittest import mock
+from sqlalchemy import event, text
+from sqlalchemy.engine.url import make_url
+import app as fyyur
+from app import (app, db, page_cache, genre_catalog, suggestion_catalog, Genre, Venue, Artist, Show, Album, Song,
+                 VenueAreaSummary, Job, Change, BookingConflict, book_show, bulk_insert, copy_buffer, refresh_areas,
+                 PageCache, PoolMetrics, MeteredQueuePool, pool_options, advance_shows, job_handlers, delete_venue_job, endpoint_stats, start_request_stats,
+                 request_stats)
+
+def in_zone(value, zone):
+    #a naive time of the app's timezone as an aware time of zone
+    app_zone = fyyur.APP_TIMEZONE
+    return (app_zone.localize(value) if hasattr(app_zone, 'localize') else value.replace(tzinfo=app_zone)).astimezone(zone)
+
+postgres_only = unittest.skipUnless(os.environ['DATABASE_URL'].startswith('postgres'), 'needs Postgres')
+
+
+class AppTestCase(unittest.TestCase):
+    """Runs each test in an app context, on an emptied database."""
+
+    def setUp(self):
+        self.config = dict(app.config)
+        app.config.update(TESTING=True, WTF_CSRF_ENABLED=False, DB_POOL_LOG_INTERVAL=0,
+                          SLOW_REQUEST_MS=float('inf'), SQLALCHEMY_BINDS={})
+        self.context = app.app_context()
+        self.context.push()
+        db.session.remove()
+        if db.engine.dialect.name == 'sqlite':
+            db.session.execute(text('DROP TABLE IF EXISTS search_index'))
+            db.session.commit()
+        db.drop_all()
+        db.create_all()
+        page_cache.clear()
+        genre_catalog.invalidate()
+        suggestion_catalog.invalidate()
+        self.client = app.test_client()
+        self.now = fyyur.local_now().replace(microsecond=0)
+
+    def tearDown(self):
+        db.session.remove()
+        self.context.pop()
+        app.config.clear()
+        app.config.update(self.config)
+
+    def add_venue(self, name='The Musical Hop', city='San Francisco', state='CA'):
+        venue = Venue(name=name, city=city, state=state, address='1015 Folsom Street', phone='123-123-1234',
+                      seeking_talent=False)
+        db.session.add(venue)
+        db.session.commit()
+        return venue.id
+
+    def add_artist(self, name='Guns N Petals', city='San Francisco', state='CA'):
+        artist = Artist(name=name, city=city, state=state, phone='326-123-5000', seeking_venue=False)
+        db.session.add(artist)
+        db.session.commit()
+        return artist.id
+
+    def statements(self, method, url, **kwargs):
+        #the response to a request and the SQL statements it ran
+        statements = []
+        record = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            response = self.client.open(url, method=method, **kwargs)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        return response, statements
+
+    def add_show(self, venue_id, artist_id, start_time, hours=2):
+        show = Show(venue_id=venue_id, artist_id=artist_id, start_time=start_time,
+                    end_time=start_time + timedelta(hours=hours))
+        db.session.add(show)
+        db.session.commit()
+        return show.id
+
+
+class BulkInsertTest(AppTestCase):
+
+    def test_copy_buffer_writes_none_as_null(self):
+        buffer = copy_buffer(['a', 'b', 'c'], [{'a': None, 'b': '', 'c': 'tab\there'}, {'a': 1, 'b': '\\N', 'c': None}])
+        self.assertEqual(buffer.getvalue(), '\\N\t\ttab\\there\n1\t\\\\N\t\\N\n')
+
+    def test_none_values_round_trip(self):
+        artist_id = self.add_artist()
+        bulk_insert(db.session.connection(), Song.__table__, [
+            {'artist_id': artist_id, 'album_id': None, 'name': 'Untitled', 'release_date': None}])
+        bulk_insert(db.session.connection(), Venue.__table__, [
+            {'name': 'Empty', 'city': 'Austin', 'state': 'TX', 'address': '', 'phone': '512-555-0100', 'image_link': None,
+             'facebook_link': None, 'website': None, 'seeking_talent': True, 'seeking_description': None}])
+        db.session.commit()
+        song = Song.query.one()
+        self.assertEqual((song.album_id, song.release_date), (None, None))
+        venue = Venue.query.filter_by(name='Empty').one()
+        self.assertEqual((venue.address, venue.image_link, venue.website), ('', None, None))
+
+
+class BookingTest(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.venue = self.add_venue()
+        self.artist = self.add_artist()
+        self.start = self.now + timedelta(days=1)
+
+    def book(self, venue_id=None, artist_id=None, start_time=None, hours=2):
+        start_time = start_time or self.start
+        form = {'venue_id': venue_id or self.venue, 'artist_id': artist_id or self.artist,
+                'start_time': start_time.strftime('%Y-%m-%d %H:%M:%S'),
+                'end_time': (start_time + timedelta(hours=hours)).strftime('%Y-%m-%d %H:%M:%S')}
+        return self.client.post('/shows/create', data=form).get_data(as_text=True)
+
+    def test_booking_and_conflicts(self):
+        self.assertIn('Show was successfully listed!', self.book())
+        self.assertIn('The venue is unavailable', self.book(start_time=self.start + timedelta(hours=1)))
+        other = self.add_venue('Park Square Live Music & Coffee')
+        self.assertIn('The artist is unavailable', self.book(other, start_time=self.start - timedelta(hours=1)))
+        #back to back shows don't overlap
+        self.assertIn('Show was successfully listed!', self.book(start_time=self.start + timedelta(hours=2)))
+        self.assertEqual(Show.query.count(), 2)
+
+    def test_rejected_bookings_say_why(self):
+        self.assertIn('shows can&#39;t be longer than 24 hours', self.book(hours=25))
+        self.assertIn('The end time must be after the start time.', self.book(hours=-1))
+        self.assertIn('there is no venue with the ID 999', self.book(venue_id=999))
+        self.assertIn('Not a valid ID.', self.book(venue_id='abc'))
+        self.assertEqual(Show.query.count(), 0)
+
+    @postgres_only
+    def test_concurrent_booking_is_a_conflict(self):
+        #the first booking isn't committed when the second one checks for overlaps, so the
+        #second one is rejected by the exclusion constraint once the first one commits
+        errors = []
+
+        def second():
+            with app.app_context():
+                try:
+                    book_show(self.venue, self.artist, self.start + timedelta(hours=1), self.start + timedelta(hours=3))
+                    db.session.commit()
+                except BookingConflict as e:
+                    errors.append(e.side)
+                finally:
+                    db.session.remove()
+
+        with db.engine.connect() as connection:
+            transaction = connection.begin()
+            connection.execute(Show.__table__.insert(), venue_id=self.venue, artist_id=self.artist,
+                               start_time=self.start, end_time=self.start + timedelta(hours=2))
+            thread = threading.Thread(target=second)
+            thread.start()
+            time.sleep(0.5)
+            transaction.commit()
+        thread.join()
+        self.assertEqual(errors, ['venue'])
+
+
+class ExportTest(AppTestCase):
+
+    def test_incremental_exports(self):
+        self.add_venue()
+        artist = self.add_artist()
+        db.session.add(Album(name='Petals', artist_id=artist))
+        db.session.commit()
+        response = self.client.get('/export/albums')
+        watermark = response.headers['X-Export-Watermark']
+        db.session.add(Album(name='Thorns', artist_id=artist))
+        db.session.commit()
+        response = self.client.get('/export/albums', query_string={'after_id': watermark})
+        self.assertEqual([i['name'] for i in map(json.loads, response.get_data(as_text=True).splitlines())],
+                         ['Thorns'])
+        #edited rows would be missed by an increment
+        for name in ('venues', 'artists', 'venue_genres', 'artist_genres'):
+            self.assertEqual(self.client.get(f'/export/{name}', query_string={'after_id': 1}).status_code, 400)
+
+
+class JobTest(AppTestCase):
+
+    def test_venue_delete_keeps_counts_current(self):
+        venue = self.add_venue('First')
+        self.add_venue('Second')
+        artist = self.add_artist()
+        for days in (1, 2, 3):
+            self.add_show(venue, artist, self.now + timedelta(days=days))
+        job = Job(kind='delete_venue', args=json.dumps({'venue_id': venue}))
+        db.session.add(job)
+        db.session.commit()
+        counts = []
+        report_progress = fyyur.report_progress
+
+        def record(*args):
+            #the counts as of each batch's commit
+            report_progress(*args)
+            counts.append((VenueAreaSummary.query.get(('San Francisco', 'CA')).upcoming_show_count,
+                           db.session.query(Venue.num_upcoming_shows).filter(Venue.id == venue).scalar(),
+                           db.session.query(Artist.num_upcoming_shows).filter(Artist.id == artist).scalar()))
+
+        app.config['JOB_BATCH_SIZE'] = 2
+        with mock.patch.object(fyyur, 'report_progress', record):
+            delete_venue_job(job.id, venue)
+        self.assertEqual(counts, [(1, 1, 1), (0, 0, 0), (0, None, 0)])
+        self.assertEqual(VenueAreaSummary.query.get(('San Francisco', 'CA')).venue_count, 1)
+
+    def test_run_jobs_retries_inline(self):
+        attempts = []
+
+        def flaky(job_id):
+            attempts.append(job_id)
+            if len(attempts) == 1:
+                raise RuntimeError('first attempt fails')
+
+        job_handlers['flaky'] = flaky
+        app.config.update(JOB_RETRY_DELAY=0.01)
+        try:
+            db.session.add(Job(kind='flaky', args='{}'))
+            db.session.commit()
+            result = app.test_cli_runner().invoke(args=['run-jobs'])
+        finally:
+            del job_handlers['flaky']
+        self.assertIn(': done', result.output)
+        job = Job.query.one()
+        self.assertEqual((job.status, job.attempts), ('done', 2))
+
+
+class InstrumentationTest(AppTestCase):
+
+    def test_failed_statements_leave_no_timing_behind(self):
+        with app.test_request_context(), db.engine.connect() as connection:
+            start_request_stats()
+            for _ in range(3):
+                with self.assertRaises(Exception):
+                    connection.execute(text('SELECT * FROM missing_table'))
+            connection.execute(text('SELECT 1'))
+            self.assertEqual(request_stats().queries, 1)
+            self.assertFalse(connection.info.get('statement_start'))
+
+    def test_streamed_pages_are_timed(self):
+        venue, artist = self.add_venue(), self.add_artist()
+        self.add_show(venue, artist, self.now + timedelta(days=1))
+        endpoint_stats.endpoints.clear()
+        response = self.client.get('/shows?stream=1')
+        self.assertIn('Guns N Petals', response.get_data(as_text=True))
+        self.assertIn('streamed', response.headers['Server-Timing'])
+        entry = endpoint_stats.report()['shows']
+        self.assertGreater(entry['render_ms'], 0)
+        self.assertGreater(entry['queries'], 0)
+
+
+class AreaSummaryTest(AppTestCase):
+
+    def areas(self):
+        return {(i.city, i.state): (i.venue_count, i.upcoming_show_count, i.next_show_time)
+                for i in VenueAreaSummary.query.all()}
+
+    def test_venue_changes_recount_areas(self):
+        first = self.add_venue('First')
+        second = self.add_venue('Second')
+        artist = self.add_artist()
+        start = self.now + timedelta(days=1)
+        self.add_show(first, artist, start)
+        self.assertEqual(self.areas(), {('San Francisco', 'CA'): (2, 1, start)})
+        Venue.query.get(second).city = 'Oakland'
+        db.session.commit()
+        self.assertEqual(self.areas(), {('San Francisco', 'CA'): (1, 1, start), ('Oakland', 'CA'): (1, 0, None)})
+        db.session.delete(Venue.query.get(second))
+        db.session.commit()
+        self.assertEqual(self.areas(), {('San Francisco', 'CA'): (1, 1, start)})
+
+    def test_shows_flushed_with_their_venue_count_once(self):
+        artist = self.add_artist()
+        start = self.now + timedelta(days=1)
+        venue = Venue(name='First', city='Austin', state='TX', address='1 Main St', phone='512-555-0100',
+                      seeking_talent=False)
+        db.session.add(Show(venue=venue, artist_id=artist, start_time=start, end_time=start + timedelta(hours=2)))
+        db.session.commit()
+        self.assertEqual(self.areas(), {('Austin', 'TX'): (1, 1, start)})
+        #moved to another area along with a new show
+        venue.city = 'Dallas'
+        db.session.add(Show(venue=venue, artist_id=artist, start_time=start + timedelta(days=1),
+                            end_time=start + timedelta(days=1, hours=2)))
+        db.session.commit()
+        self.assertEqual(self.areas(), {('Dallas', 'TX'): (1, 2, start)})
+
+    def test_listing_recounts_started_shows(self):
+        venue, artist = self.add_venue(), self.add_artist()
+        start = self.now + timedelta(hours=1)
+        self.add_show(venue, artist, start)
+        self.add_show(venue, artist, start + timedelta(days=1))
+        later = self.now + timedelta(hours=2)
+        with mock.patch.object(fyyur, 'local_now', return_value=later), app.test_request_context('/venues'):
+            area, = fyyur.venue_areas()
+        self.assertEqual((area['upcoming_shows_count'], area['next_show_time']), (1, start + timedelta(days=1)))
+        self.assertEqual(area['venues'], [{'id': venue, 'name': 'The Musical Hop', 'num_upcoming_shows': 1}])
+
+    def test_recount_replaces_existing_rows(self):
+        self.add_venue()
+        db.session.add(VenueAreaSummary(city='Nowhere', state='NV', venue_count=3, upcoming_show_count=0))
+        VenueAreaSummary.query.get(('San Francisco', 'CA')).venue_count = 5
+        db.session.commit()
+        refresh_areas(db.session.connection(), [('San Francisco', 'CA'), ('Nowhere', 'NV')])
+        db.session.commit()
+        self.assertEqual(self.areas(), {('San Francisco', 'CA'): (1, 0, None)})
+
+    def test_venues_per_area(self):
+        for name in ('Alpha', 'Beta', 'Gamma'):
+            self.add_venue(name)
+        page = lambda **args: self.client.get('/venues', query_string=args).get_data(as_text=True)
+        self.assertIn('Gamma', page())
+        self.assertIn('Beta', page(per_area=2))
+        self.assertNotIn('Gamma', page(per_area=2))
+        self.assertNotIn('Alpha', page(per_area=0))
+        self.assertIn('San Francisco', page(per_area=0))
+        self.assertEqual(self.client.get('/venues?per_area=-1').status_code, 400)
+
+    @postgres_only
+    def test_concurrent_recounts_of_a_new_area(self):
+        #the second transaction waits for the first one's summary row instead of colliding on its key
+        def add_venue(connection, name):
+            transaction = connection.begin()
+            connection.execute(Venue.__table__.insert(), name=name, city='Austin', state='TX',
+                               address='1 Main St', phone='512-555-0100', seeking_talent=False)
+            refresh_areas(connection, [('Austin', 'TX')])
+            return transaction
+
+        errors = []
+
+        def second():
+            try:
+                with db.engine.connect() as connection:
+                    add_venue(connection, 'Second').commit()
+            except Exception as e:
+                errors.append(e)
+
+        with db.engine.connect() as connection:
+            transaction = add_venue(connection, 'First')
+            thread = threading.Thread(target=second)
+            thread.start()
+            time.sleep(0.5)
+            transaction.commit()
+        thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(self.areas(), {('Austin', 'TX'): (2, 0, None)})
+
+
+class AvailabilityTest(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.venue = self.add_venue()
+        self.artist = self.add_artist()
+        self.other_artist = self.add_artist('Matt Quevado')
+        self.day = (self.now + timedelta(days=2)).replace(hour=0, minute=0, second=0)
+        #overlapping shows of two artists at the venue, and one back to back with them
+        self.add_show(self.venue, self.artist, self.day + timedelta(hours=10))
+        self.add_show(self.venue, self.other_artist, self.day + timedelta(hours=11))
+        self.add_show(self.venue, self.artist, self.day + timedelta(hours=13))
+
+    def availability(self, url, **args):
+        args.setdefault('from', self.day.isoformat())
+        args.setdefault('to', (self.day + timedelta(days=1)).isoformat())
+        return self.client.get(url, query_string=args)
+
+    def test_busy_shows_are_merged(self):
+        response = self.availability(f'/venues/{self.venue}/availability')
+        self.assertEqual(response.status_code, 200)
+        hours = lambda i: [[(datetime.fromisoformat(j[k]) - self.day) / timedelta(hours=1) for k in ('start', 'end')]
+                           for j in response.get_json()[i]]
+        self.assertEqual(hours('busy'), [[10, 15]])
+        self.assertEqual(hours('free'), [[0, 10], [15, 24]])
+        response = self.availability(f'/artists/{self.other_artist}/availability', min_slot=600,
+                                     **{'from': (self.day + timedelta(hours=2)).isoformat()})
+        self.assertEqual(hours('busy'), [[11, 13]])
+        self.assertEqual(hours('free'), [[13, 24]])
+
+    def test_times_with_an_offset(self):
+        start = self.day + timedelta(hours=9)
+        response = self.availability(f'/venues/{self.venue}/availability',
+                                     **{'from': in_zone(start, timezone.utc).isoformat()})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(datetime.fromisoformat(response.get_json()['from']), start)
+
+    def test_times_are_in_the_app_timezone(self):
+        #the free slots and the show pages agree on the wall-clock times, whatever the server's timezone
+        tokyo = babel.dates.get_timezone('Asia/Tokyo')
+        with mock.patch.object(fyyur, 'APP_TIMEZONE', tokyo):
+            fyyur.format_datetime_cached.cache_clear()
+            start = datetime(2030, 5, 1, 1, 0, tzinfo=timezone.utc)
+            response = self.availability(f'/venues/{self.venue}/availability',
+                                         **{'from': start.isoformat(), 'to': (start + timedelta(days=1)).isoformat()})
+            slot = datetime.fromisoformat(response.get_json()['from'])
+            self.assertEqual(slot, datetime(2030, 5, 1, 10, 0))
+            self.assertEqual(fyyur.format_datetime(slot), fyyur.format_datetime(start))
+            self.assertIn('10:00AM', fyyur.format_datetime(start))
+            offset = fyyur.local_now() - datetime.now(timezone.utc).replace(tzinfo=None)
+            self.assertEqual(round(offset / timedelta(hours=1)), 9)
+        fyyur.format_datetime_cached.cache_clear()
+
+    def test_invalid_arguments(self):
+        url = f'/venues/{self.venue}/availability'
+        self.assertEqual(self.availability(url, min_slot=-30).status_code, 400)
+        self.assertEqual(self.availability(url, **{'from': 'tomorrow'}).status_code, 400)
+        self.assertEqual(self.availability(url, to=self.day.isoformat()).status_code, 400)
+        self.assertEqual(self.availability('/venues/0/availability').status_code, 404)
+
+
+class ShowCounterTest(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.venue = self.add_venue()
+        self.quiet = self.add_artist('Guns N Petals')
+        self.busy = self.add_artist('Matt Quevado')
+        for days in (1, 2, -1):
+            self.add_show(self.venue, self.busy, self.now + timedelta(days=days))
+        self.add_show(self.venue, self.quiet, self.now + timedelta(days=3))
+
+    def test_search_cards_read_the_counters(self):
+        response, statements = self.statements('POST', '/artists/search', data={'search_term': 'Matt'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Matt Quevado', response.data)
+        self.assertFalse([i for i in statements if '"Show"' in i])
+
+    def test_sort_by_popularity(self):
+        response = self.client.get('/artists?sort=popular&limit=1')
+        self.assertIn(b'Matt Quevado', response.data)
+        self.assertNotIn(b'Guns N Petals', response.data)
+        response = self.client.get('/api/v1/artists', query_string={'sort': 'popular', 'limit': 1,
+                                                                     'fields': 'name', 'include': 'show_counts'})
+        page = response.get_json()
+        self.assertEqual(page['data'], [{'name': 'Matt Quevado',
+                                         'show_counts': {'upcoming_shows_count': 2, 'past_shows_count': 1}}])
+        response = self.client.get('/api/v1/artists', query_string={'sort': 'popular', 'after': page['next'],
+                                                                     'fields': 'name'})
+        self.assertEqual(response.get_json(), {'data': [{'name': 'Guns N Petals'}], 'next': None})
+        self.assertEqual(self.client.get('/api/v1/shows?sort=popular').status_code, 400)
+
+    def counters(self, model, id):
+        db.session.expire_all()
+        record = model.query.get(id)
+        return record.num_upcoming_shows, record.num_past_shows, record.next_show_time
+
+    def test_counters_follow_shows(self):
+        self.assertEqual(self.counters(Artist, self.busy), (2, 1, self.now + timedelta(days=1)))
+        self.assertEqual(self.counters(Venue, self.venue), (3, 1, self.now + timedelta(days=1)))
+        db.session.delete(Show.query.filter_by(artist_id=self.busy, start_time=self.now + timedelta(days=1)).one())
+        db.session.commit()
+        self.assertEqual(self.counters(Artist, self.busy), (1, 1, self.now + timedelta(days=2)))
+        #once the next show has started advance_shows moves it to the past counters
+        advance_shows(db.session.connection(), self.now + timedelta(days=2, hours=1))
+        db.session.commit()
+        self.assertEqual(self.counters(Artist, self.busy), (0, 2, None))
+        self.assertEqual(self.counters(Venue, self.venue), (1, 2, self.now + timedelta(days=3)))
+
+    def test_check_show_counters(self):
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=['check-show-counters', '--dry-run'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('0 venue counters drifted', result.output)
+        self.assertIn('0 artist counters drifted', result.output)
+        db.session.execute(Artist.__table__.update().where(Artist.__table__.c.id == self.quiet).values(
+            num_upcoming_shows=5))
+        db.session.commit()
+        result = runner.invoke(args=['check-show-counters'])
+        self.assertIn(f'1 artist counters drifted: {self.quiet}', result.output)
+        self.assertEqual(self.counters(Artist, self.quiet)[0], 1)
+        result = runner.invoke(args=['check-show-counters', '--dry-run'])
+        self.assertIn('0 artist counters drifted', result.output)
+
+
+class GenreCatalogTest(AppTestCase):
+
+    def add_genre(self, name):
+        #a genre committed by another process, which this one isn't told about
+        with db.engine.begin() as connection:
+            return connection.execute(Genre.__table__.insert(), name=name).inserted_primary_key[0]
+
+    def test_form_renders_from_the_catalog(self):
+        self.add_genre('Jazz')
+        self.client.get('/venues/create')
+        response, statements = self.statements('GET', '/venues/create')
+        self.assertIn(b'Jazz', response.data)
+        self.assertEqual(statements, [])
+
+    def test_reloads(self):
+        self.add_genre('Jazz')
+        self.client.get('/artists/create')
+        self.add_genre('Blues')
+        self.assertNotIn(b'Blues', self.client.get('/artists/create').data)
+        db.session.add(Genre(name='Folk'))
+        db.session.commit()
+        page = self.client.get('/artists/create').data
+        self.assertIn(b'Blues', page)
+        self.assertIn(b'Folk', page)
+        self.add_genre('Soul')
+        app.config['GENRE_CATALOG_TTL'] = 0
+        self.assertIn(b'Soul', self.client.get('/artists/create').data)
+
+    def test_submitting_a_genre_added_elsewhere(self):
+        venue = self.add_venue()
+        self.client.get(f'/venues/{venue}/edit')
+        genre = self.add_genre('Jazz')
+        response = self.client.post(f'/venues/{venue}/edit', data={
+            'name': 'The Musical Hop', 'city': 'San Francisco', 'state': 'CA', 'address': '1015 Folsom Street',
+            'phone': '123-123-1234', 'genres': [str(genre)]})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual([i.name for i in Venue.query.get(venue).genres], ['Jazz'])
+
+
+class SuggestionTest(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.hop = self.add_venue('The Musical Hop')
+        self.park = self.add_venue('Park Square Live Music & Coffee')
+        self.add_artist('Guns N Petals')
+
+    def suggest(self, q, kind='venue'):
+        response = self.client.get('/autocomplete', query_string={'q': q, 'type': kind})
+        return [i['name'] for i in response.get_json()[kind]]
+
+    def test_matches(self):
+        self.assertEqual(self.suggest('mus'), ['Park Square Live Music & Coffee', 'The Musical Hop'])
+        self.assertEqual(self.suggest('the mus'), ['The Musical Hop'])
+        self.assertEqual(self.suggest('hop'), ['The Musical Hop'])
+        self.assertEqual(self.suggest('coffee park'), ['Park Square Live Music & Coffee'])
+        self.assertEqual(self.suggest('usic'), [])
+        self.assertEqual(self.suggest('pet', 'artist'), ['Guns N Petals'])
+
+    def test_renames_and_deletes(self):
+        self.suggest('mus')
+        Venue.query.get(self.hop).name = 'The Dueling Pianos Bar'
+        db.session.commit()
+        self.assertEqual(self.suggest('mus'), ['Park Square Live Music & Coffee'])
+        self.assertEqual(self.suggest('duel'), ['The Dueling Pianos Bar'])
+        db.session.delete(Venue.query.get(self.park))
+        db.session.commit()
+        self.assertEqual(self.suggest('mus'), [])
+
+    def test_commits_during_the_build(self):
+        add = fyyur.SuggestionIndex.add
+        committed = []
+
+        def add_and_commit(index, id, name):
+            if not committed:
+                committed.append(True)
+                fyyur.update_suggestions([Change('insert', Venue, 99, {'id': 99, 'name': 'Late Night Music'})])
+            add(index, id, name)
+
+        with mock.patch.object(fyyur.SuggestionIndex, 'add', add_and_commit):
+            self.assertIn('Late Night Music', self.suggest('late'))
+        self.assertEqual(self.suggest('late'), ['Late Night Music'])
+
+    def test_names_from_other_processes(self):
+        self.suggest('mus')
+        with db.engine.begin() as connection:
+            connection.execute(Venue.__table__.insert(), name='The Music Box', city='Austin', state='TX',
+                               address='1 Main St', phone='512-555-0100', seeking_talent=False)
+        self.assertNotIn('The Music Box', self.suggest('mus'))
+        app.config['SUGGESTION_INDEX_TTL'] = 0
+        self.assertIn('The Music Box', self.suggest('mus'))
+
+
+class PaginationTest(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        venue, artist = self.add_venue(), self.add_artist()
+        #two shows share a start time, the id breaks the tie
+        self.shows = [self.add_show(venue, artist, self.now + timedelta(days=days)) for days in (3, 1, 2, 2, 4)]
+
+    def test_api_cursors(self):
+        ids, cursor = [], None
+        for _ in range(5):
+            query = {'limit': 2, 'fields': 'id'}
+            if cursor:
+                query['after'] = cursor
+            page = self.client.get('/api/v1/shows', query_string=query).get_json()
+            ids += [i['id'] for i in page['data']]
+            cursor = page['next']
+            if cursor is None:
+                break
+        self.assertEqual(ids, sorted(self.shows))
+        self.assertIsNone(cursor)
+        #a malformed cursor starts from the first page
+        page = self.client.get('/api/v1/shows', query_string={'limit': 2, 'fields': 'id', 'after': 'nonsense'})
+        self.assertEqual([i['id'] for i in page.get_json()['data']], sorted(self.shows)[:2])
+
+    def test_shows_pages(self):
+        #follow the next page links until the last page, every show is listed once
+        seen, url = [], '/shows?limit=2'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            page = response.data.decode()
+            seen += re.findall(r'<h4>(.*?)</h4>', page)
+            next_page = re.search(r'<a href="(/shows\?after=[^"]+)"', page)
+            url = html.unescape(next_page.group(1)) if next_page else None
+        self.assertEqual(len(seen), 5)
+        self.assertEqual(len(set(seen)), 4)
+
+
+class ImportTest(AppTestCase):
+
+    def write_csv(self, rows):
+        path = os.path.join(tempfile.mkdtemp(), 'rows.csv')
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+        return path
+
+    def test_import_with_rejects(self):
+        venue, artist = self.add_venue(), self.add_artist()
+        start = self.now + timedelta(days=1)
+        row = lambda venue_id, start_time, hours=2: {
+            'venue_id': venue_id, 'artist_id': artist, 'start_time': start_time.isoformat(),
+            'end_time': (start_time + timedelta(hours=hours)).isoformat()}
+        path = self.write_csv([row(venue, start), row(venue, start + timedelta(days=1)),
+                               {'venue_id': 'x', 'artist_id': artist, 'start_time': '', 'end_time': ''}])
+        rejects = os.path.join(os.path.dirname(path), 'rejects.jsonl')
+        result = app.test_cli_runner().invoke(args=['import', 'shows', path, '--rejects', rejects])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('done: 2 shows imported, 1 rows rejected', result.output)
+        with open(rejects) as f:
+            self.assertEqual([i['line'] for i in map(json.loads, f)], [4])
+        self.assertEqual(Show.query.count(), 2)
+        db.session.expire_all()
+        self.assertEqual(Venue.query.get(venue).num_upcoming_shows, 2)
+
+    def test_jsonl_lines_that_are_not_objects(self):
+        artist = self.add_artist()
+        path = os.path.join(tempfile.mkdtemp(), 'albums.jsonl')
+        with open(path, 'w') as f:
+            for row in ([1, 2], None, 'x', {'artist_id': artist, 'name': 'Greatest Hits'}):
+                f.write(json.dumps(row) + '\n')
+        result = app.test_cli_runner().invoke(args=['import', 'albums', path])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('done: 1 albums imported, 3 rows rejected', result.output)
+        self.assertIn('line 1: not an object', result.output)
+
+    def test_times_with_an_offset(self):
+        venue, artist = self.add_venue(), self.add_artist()
+        start = in_zone(self.now + timedelta(days=1), timezone(timedelta(hours=2)))
+        path = self.write_csv([{'venue_id': venue, 'artist_id': artist, 'start_time': start.isoformat(),
+                                'end_time': (start + timedelta(hours=2)).isoformat()}])
+        result = app.test_cli_runner().invoke(args=['import', 'shows', path])
+        self.assertIn('done: 1 shows imported, 0 rows rejected', result.output)
+        self.assertEqual(Show.query.one().start_time, self.now + timedelta(days=1))
+
+
+class PoolMetricsTest(AppTestCase):
+
+    def test_endpoint(self):
+        self.client.get('/venues')
+        metrics = self.client.get('/metrics/pool').get_json()
+        primary = metrics[db.engine.url.__to_string__(hide_password=True)]
+        self.assertGreater(primary['checkouts'], 0)
+        self.assertEqual(primary['timeouts'], 0)
+
+    def test_exhausted_pool(self):
+        pool = MeteredQueuePool(lambda: sqlite3.connect(':memory:'), pool_size=1, max_overflow=1, timeout=0.05)
+        pool.metrics = metrics = PoolMetrics('test', pool)
+        first, second = pool.connect(), pool.connect()
+        with self.assertLogs(app.logger, 'WARNING'):
+            self.assertRaises(fyyur.exc.TimeoutError, pool.connect)
+        first.close()
+        snapshot = metrics.snapshot()
+        self.assertEqual({k: snapshot[k] for k in ('checkouts', 'checked_out', 'peak_checked_out', 'peak_overflow',
+                                                   'timeouts', 'connects', 'size', 'overflow')},
+                         {'checkouts': 2, 'checked_out': 1, 'peak_checked_out': 2, 'peak_overflow': 1,
+                          'timeouts': 1, 'connects': 2, 'size': 1, 'overflow': 1})
+        second.close()
+
+    def test_pool_options(self):
+        options = pool_options(app.config, make_url('postgresql://localhost/fyyur'))
+        self.assertEqual(options['poolclass'], MeteredQueuePool)
+        self.assertEqual(options['pool_size'], app.config['DB_POOL_SIZE'])
+        self.assertEqual(options['connect_args'],
+                         {'options': f"-c statement_timeout={app.config['DB_STATEMENT_TIMEOUT_MS']}"})
+        self.assertEqual(pool_options(app.config, make_url('sqlite:///fyyur.db')), {})
+
+
+class DatetimeFilterTest(AppTestCase):
+
+    def test_formats(self):
+        fyyur.format_datetime_cached.cache_clear()
+        value = datetime(2030, 5, 21, 21, 30)
+        with mock.patch.object(fyyur.dateutil.parser, 'parse', wraps=fyyur.dateutil.parser.parse) as parse:
+            self.assertEqual(fyyur.format_datetime(value, 'full'), 'Tuesday May, 21, 2030 at 9:30PM')
+            self.assertEqual(fyyur.format_datetime(value), 'Tue 05, 21, 2030 9:30PM')
+            self.assertEqual(fyyur.format_datetime(value, 'y-MM-dd'), '2030-05-21')
+            parse.assert_not_called()
+            #strings are still parsed
+            self.assertEqual(fyyur.format_datetime('2030-05-21T21:30:00'), 'Tue 05, 21, 2030 9:30PM')
+        self.assertEqual(fyyur.format_datetime(None), '')
+        fyyur.format_datetime(value)
+        info = fyyur.format_datetime_cached.cache_info()
+        self.assertEqual((info.hits, info.misses), (2, 3))
+
+    def test_times_with_an_offset_are_shown_in_the_app_timezone(self):
+        value = in_zone(datetime(2030, 5, 21, 21, 30), timezone(timedelta(hours=-7)))
+        self.assertEqual(fyyur.format_datetime(value), 'Tue 05, 21, 2030 9:30PM')
+
+
+class HomePageTest(AppTestCase):
+
+    def test_listings(self):
+        venue, artist = self.add_venue(), self.add_artist()
+        self.add_show(venue, artist, self.now + timedelta(days=1))
+        response, statements = self.statements('GET', '/')
+        self.assertIn(b'The Musical Hop', response.data)
+        self.assertIn(b'Guns N Petals', response.data)
+        self.assertFalse([i for i in statements if '"Show"' in i])
+        self.assertEqual(self.statements('GET', '/')[1], [])
+        #a new venue is listed right away
+        self.add_venue('Park Square Live Music & Coffee')
+        self.assertIn(b'Park Square Live Music', self.client.get('/').data)
+
+
+class PageCacheTest(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.venue, self.artist = self.add_venue(), self.add_artist()
+        self.start = self.now + timedelta(hours=1)
+        self.add_show(self.venue, self.artist, self.start)
+
+    def test_pages_are_served_until_a_change(self):
+        url = f'/artists/{self.artist}'
+        self.client.get(url)
+        response, statements = self.statements('GET', url)
+        self.assertEqual((response.status_code, statements), (200, []))
+        #a show at another venue changes the artist's page, not the pages of other artists
+        other = self.add_venue('Park Square Live Music & Coffee')
+        unrelated = self.add_artist('Matt Quevado')
+        self.client.get(f'/artists/{unrelated}')
+        self.add_show(other, self.artist, self.start + timedelta(days=1))
+        response, statements = self.statements('GET', url)
+        self.assertIn(b'Park Square Live Music', response.data)
+        self.assertNotEqual(statements, [])
+        self.assertEqual(self.statements('GET', f'/artists/{unrelated}')[1], [])
+
+    def test_pages_go_stale_when_their_next_show_starts(self):
+        app.config['PAGE_CACHE_TTL'] = 24 * 3600
+        url = f'/venues/{self.venue}'
+        self.client.get(url)
+        with mock.patch.object(fyyur, 'local_now', return_value=self.start - timedelta(minutes=1)):
+            self.assertEqual(self.statements('GET', url)[1], [])
+        with mock.patch.object(fyyur, 'local_now', return_value=self.start + timedelta(minutes=1)):
+            self.assertNotEqual(self.statements('GET', url)[1], [])
+
+    def test_least_recently_used_pages_are_evicted(self):
+        cache = PageCache(max_bytes=10)
+        stale_at = self.now + timedelta(hours=1)
+        cache.set('a', 'aaaa', stale_at, {'a'})
+        cache.set('b', 'bbbb', stale_at, {'b'})
+        cache.get('a', self.now)
+        cache.set('c', 'cccc', stale_at, {'c'})
+        self.assertEqual([cache.get(i, self.now) for i in 'abc'], ['aaaa', None, 'cccc'])
+        self.assertEqual(cache.size, 8)
+        cache.invalidate('a')
+        self.assertEqual((cache.get('a', self.now), cache.size), (None, 4))
+
+
+class ReplicaTest(AppTestCase):
+    """Reads and writes against a primary and a replica holding different data."""
+
+    def setUp(self):
+        super().setUp()
+        app.config.update(SQLALCHEMY_BINDS={'replica_1': REPLICA_URL}, PAGE_CACHE_MAX_BYTES=0)
+        self.replica = db.get_engine(app, bind='replica_1')
+        if self.replica.dialect.name == 'sqlite':
+            self.replica.execute(text('DROP TABLE IF EXISTS search_index'))
+        db.metadata.drop_all(self.replica)
+        db.metadata.create_all(self.replica)
+        self.venue = self.add_venue('Primary Hop')
+        with self.replica.begin() as connection:
+            connection.execute(Venue.__table__.insert(), id=self.venue, name='Replica Hop', city='San Francisco',
+                               state='CA', address='1015 Folsom Street', phone='123-123-1234', seeking_talent=False)
+
+    def test_pages_read_from_the_replica(self):
+        self.assertIn(b'Replica Hop', self.client.get(f'/venues/{self.venue}').data)
+        app.config['SQLALCHEMY_BINDS'] = {}
+        self.assertIn(b'Primary Hop', self.client.get(f'/venues/{self.venue}').data)
+
+    def test_writes_and_the_reads_after_them_use_the_primary(self):
+        with app.test_request_context(f'/venues/{self.venue}'):
+            fyyur.g.replica = 'replica_1'
+            self.assertEqual(Venue.query.get(self.venue).name, 'Replica Hop')
+            db.session.add(Artist(name='Guns N Petals', city='San Francisco', state='CA', phone='326-123-5000',
+                                  seeking_venue=False))
+            db.session.flush()
+            db.session.expire_all()
+            self.assertEqual(Venue.query.get(self.venue).name, 'Primary Hop')
+            self.assertEqual(Artist.query.count(), 1)
+            db.session.rollback()
+        db.session.remove()
+        with app.test_request_context(f'/venues/{self.venue}'):
+            fyyur.g.replica = 'replica_1'
+            db.session.execute(Venue.__table__.update().values(name='Renamed Hop'))
+            db.session.commit()
+        db.session.remove()
+        self.assertEqual(self.replica.execute(text('SELECT name FROM "Venue"')).scalar(), 'Replica Hop')
+        self.assertEqual(Venue.query.get(self.venue).name, 'Renamed Hop')
+
+    def test_clients_read_their_writes(self):
+        response = self.client.post(f'/venues/{self.venue}/edit', data={
+            'name': 'Edited Hop', 'city': 'San Francisco', 'state': 'CA', 'address': '1015 Folsom Street',
+            'phone': '123-123-1234', 'genres': ['0'], 'other_genre': 'Jazz'})
+        self.assertEqual(response.status_code, 302)
+        self.assertIn(b'Edited Hop', self.client.get(f'/venues/{self.venue}').data)
+        #until the replica has had time to catch up
+        with self.client.session_transaction() as client_session:
+            client_session['primary_until'] = 0
+        self.assertIn(b'Replica Hop', self.client.get(f'/venues/{self.venue}').data)
+
+
+class SearchTest(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.add_venue('The Musical Hop')
+        self.add_venue('Park Square Live Music & Coffee')
+        artist = self.add_artist('Guns N Petals')
+        album = Album(name='Petals', artist_id=artist)
+        db.session.add(album)
+        db.session.flush()
+        db.session.add_all([Song(name='Thorns', artist_id=artist, album_id=album.id),
+                            Song(name='Single', artist_id=artist)])
+        db.session.commit()
+        self.client.get('/')
+
+    def search(self, kind, term):
+        response = self.client.post(f'/{kind}/search', data={'search_term': term})
+        return [line.strip()[4:-5] for line in response.get_data(as_text=True).splitlines() if '<h5>' in line]
+
+    def test_matches(self):
+        self.add_artist('Matt Quevado', 'New York', 'NY')
+        self.add_artist('The Wild Sax Band')
+        self.assertEqual(self.search('venues', 'Hop'), ['The Musical Hop'])
+        self.assertEqual(sorted(self.search('venues', 'Music')),
+                         ['Park Square Live Music &amp; Coffee', 'The Musical Hop'])
+        self.assertEqual(sorted(self.search('artists', 'A')), ['Guns N Petals', 'Matt Quevado', 'The Wild Sax Band'])
+        self.assertEqual(self.search('artists', 'band'), ['The Wild Sax Band'])
+        #words by prefix, names by substring, ranked after
+        self.assertEqual(self.search('artists', 'gun pet'), ['Guns N Petals'])
+        self.assertEqual(sorted(self.search('venues', 'usic')), ['Park Square Live Music &amp; Coffee', 'The Musical Hop'])
+        self.add_venue('Shopping Hall')
+        self.assertEqual(self.search('venues', 'hop'), ['The Musical Hop', 'Shopping Hall'])
+        self.assertEqual(self.search('artists', 'new york'), ['Matt Quevado'])
+        self.assertEqual(self.search('venues', '&'), ['Park Square Live Music &amp; Coffee'])
+        self.assertEqual(self.search('venues', '%'), [])
+
+    def test_cards_load_no_relationships(self):
+        response, statements = self.statements('POST', '/artists/search', data={'search_term': 'guns'})
+        self.assertIn(b'Guns N Petals', response.data)
+        self.assertEqual(len(statements), 2)
+        self.assertFalse([i for i in statements if '"Album"' in i or '"Song"' in i or '"Genre"' in i])
+
+
+if __name__ == '__main__':
+    unittest.main()